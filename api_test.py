@@ -3,8 +3,12 @@ import json
 import base64
 import random
 
-def generate_random_json_data():
-    """Generates random JSON data for testing."""
+def generate_random_json_data(advice_rows=None, previous_reports_count=None):
+    """Generates random JSON data for testing.
+
+    advice_rows / previous_reports_count fix the table and history sizes
+    (default: a small random amount), so benchmarks can scale the payload.
+    """
     # ... (Same random data generation logic as in the previous JavaScript example)
     names = ["Alice", "Bob", "Charlie", "David", "Eve", "Frank", "Grace", "Henry", "Ivy", "Jack"]
     uhids = [str(random.randint(100000, 999999)) for _ in range(10)]
@@ -14,7 +18,10 @@ def generate_random_json_data():
     med_names = ["Medicine A", "Medicine B", "Medicine C", "Medicine D"]
     dosages = ["1 tablet", "2 capsules", "1 ml", "1 spray"]
     details = ["Take with food", "Take at night", "Use as directed"]
-    reports = ["Consultation on 2024-01-10: Normal", "Report from 2024-02-15: Improved"]
+    reports = [
+        {"date": "2024-01-10", "hospital": "Random Hospital", "consultation": "Normal"},
+        {"date": "2024-02-15", "hospital": "Random Hospital", "consultation": "Improved"},
+    ]
 
     patient_data = {
         "name": random.choice(names),
@@ -58,10 +65,13 @@ def generate_random_json_data():
             "name": random.choice(med_names),
             "dosage": random.choice(dosages),
             "details": random.choice(details),
-        } for _ in range(random.randint(1, 3))
+        } for _ in range(advice_rows if advice_rows is not None else random.randint(1, 3))
     ]
 
-    previous_reports = random.sample(reports, random.randint(0, 2))
+    if previous_reports_count is None:
+        previous_reports = random.sample(reports, random.randint(0, 2))
+    else:
+        previous_reports = [dict(random.choice(reports)) for _ in range(previous_reports_count)]
 
 
     json_data = {
@@ -75,22 +85,24 @@ def generate_random_json_data():
     return json_data
 
 
-json_data = generate_random_json_data()  # Generate random JSON
+if __name__ == "__main__":
+    json_data = generate_random_json_data()  # Generate random JSON
 
-url = "http://127.0.0.1:8000/generate_report"  # Or your actual URL
-headers = {"Content-Type": "application/json"}
+    url = "http://127.0.0.1:8000/generate_report"  # Or your actual URL
+    # Ask for the base64 JSON encoding; the endpoint sends a raw PDF by default
+    headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
-response = requests.post(url, data=json.dumps(json_data), headers=headers)
+    response = requests.post(url, data=json.dumps(json_data), headers=headers)
 
-if response.status_code == 200:
-    data = response.json()
-    pdf_base64 = data["pdf_data"]
+    if response.status_code == 200:
+        data = response.json()
+        pdf_base64 = data["pdf_data"]
 
-    pdf_bytes = base64.b64decode(pdf_base64)
-    with open("patient_report.pdf", "wb") as f:
-        f.write(pdf_bytes)
+        pdf_bytes = base64.b64decode(pdf_base64)
+        with open("patient_report.pdf", "wb") as f:
+            f.write(pdf_bytes)
 
-    print("PDF downloaded successfully!")
-else:
-    print(f"Error: {response.status_code}")
-    print(response.text)
\ No newline at end of file
+        print("PDF downloaded successfully!")
+    else:
+        print(f"Error: {response.status_code}")
+        print(response.text)
\ No newline at end of file
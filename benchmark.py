@@ -0,0 +1,297 @@
+"""
+In-process benchmarks for the report rendering pipeline.
+
+    python benchmark.py run [--quick] [--output baseline.json]
+    python benchmark.py compare baseline.json [current.json] [--threshold 0.15]
+
+`run` times each case (median of --repeat runs), then renders it once more
+under tracemalloc for peak memory, and saves latency, pages, bytes and peak
+memory as JSON. `compare` re-runs the suite (or loads a second result file)
+and exits non-zero when a case got slower, larger or hungrier than the
+threshold allows.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import fpdf
+from PIL import Image
+
+from api_test import generate_random_json_data
+
+ADVICE_ROWS = (1, 100, 1000, 10000)
+PREVIOUS_REPORTS = (0, 100, 1000, 5000)
+QUICK_ADVICE_ROWS = (1, 100, 1000)
+QUICK_PREVIOUS_REPORTS = (0, 100, 1000)
+SEED = 1234
+SLOW_CASE_SECONDS = 2
+
+
+def payload(advice_rows=0, previous_reports=0):
+    """Synthetic report data of a given size, identical for every run"""
+    random.seed(SEED)
+    data = generate_random_json_data(advice_rows, previous_reports)
+    # A fixed creation date keeps the output bytes comparable between runs
+    data["creation_date"] = "2024-01-01T00:00:00"
+    return data
+
+
+def bench_main_report(rows):
+    data = payload(advice_rows=rows)
+
+    def run():
+        report = r_g.MainPatientReport(data)
+        pdf = report.generate_main_report()
+        return report.page_no(), len(pdf)
+    return run
+
+
+def bench_previous_reports(count):
+    data = payload(previous_reports=count)
+
+    def run():
+        report = r_g.PreviousPatientReport(data)
+        pdf = report.generate_report()
+        return report.page_no(), len(pdf)
+    return run
+
+
+def large_logo_path(width=3000):
+    """A photo-like PNG logo far beyond print resolution, written once to the temp directory"""
+    path = os.path.join(tempfile.gettempdir(), f"bench_logo_{width}.png")
+    if not os.path.exists(path):
+        size = (width, width)
+        channels = (Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100),
+                    Image.linear_gradient("L").resize(size), Image.effect_noise(size, 40))
+        Image.merge("RGB", channels).save(path)
+    return path
+
+
+def bench_large_logo():
+    logo = large_logo_path()
+    data = dict(payload(advice_rows=10), logo_data=logo, watermark_logo=logo)
+
+    def run():
+        report = r_g.MainPatientReport(data)
+        pdf = report.generate_main_report()
+        return report.page_no(), len(pdf)
+    return run
+
+
+def bench_create_table(rows):
+    data = payload(advice_rows=rows)
+    table_data = [["S.No.", "Medicine Name", "Dosage", "Details"]] + [
+        [str(i + 1), med["name"], med["dosage"], med["details"]]
+        for i, med in enumerate(data["advice_data"])
+    ]
+
+    def run():
+        report = r_g.MainPatientReport(data)
+        report.add_page()
+        report.set_font(report.report_font_family, "B", 14)  # as left by the "Advice" heading in the main report
+        report.create_table(table_data, align_data='C', align_header='C', cell_width='even')
+        return report.page_no(), None
+    return run
+
+
+def bench_compaction(preset):
+    data = dict(payload(advice_rows=100, previous_reports=500), compaction=preset)
+
+    def run():
+        report = r_g.CombinedPatientReport(data)
+        pdf = report.generate_combined_report()
+        return report.page_no(), len(pdf)
+    return run
+
+
+def bench_watermark_image():
+    data = payload()
+
+    def run():
+        report = r_g.PatientReport(data)
+        image = report.create_watermark_image()
+        return None, len(image.getvalue())
+    return run
+
+
+def bench_rounded_rect(count):
+    data = payload()
+
+    def run():
+        report = r_g.PreviousPatientReport(data)
+        report.add_page()
+        for i in range(count):
+            report.rounded_rect(10, 10 + (i % 250), 190, 20, 5, 'F')
+        return report.page_no(), None
+    return run
+
+
+def cases(quick=False):
+    """(name, run) pairs making up the suite"""
+    advice_rows = QUICK_ADVICE_ROWS if quick else ADVICE_ROWS
+    previous_reports = QUICK_PREVIOUS_REPORTS if quick else PREVIOUS_REPORTS
+    for rows in advice_rows:
+        yield f"main_report/advice={rows}", bench_main_report(rows)
+    # Logo decoding is cached after the warm-up run; this tracks what the image costs in every PDF
+    yield "main_report/large_logo", bench_large_logo()
+    for count in previous_reports:
+        yield f"previous_reports/consultations={count}", bench_previous_reports(count)
+    for rows in advice_rows:
+        yield f"create_table/rows={rows}", bench_create_table(rows)
+    for preset in r_g.COMPACTION_PRESETS:
+        # Same document under each preset: compare bytes against latency to pick a default
+        yield f"compaction/{preset}", bench_compaction(preset)
+    yield "create_watermark_image", bench_watermark_image()
+    yield "rounded_rect/x1000", bench_rounded_rect(1000)
+
+
+def measure(run, repeat):
+    # Each render starts with a cold text memo, as a worker seeing new text would
+    r_g.text_measure_cache.clear()
+    start = time.perf_counter()
+    run()  # warm-up: imports, font tables, decoded logo
+    if time.perf_counter() - start > SLOW_CASE_SECONDS:
+        repeat = 1  # large cases take seconds each; one timed run is enough
+
+    latencies = []
+    for _ in range(repeat):
+        r_g.text_measure_cache.clear()
+        start = time.perf_counter()
+        pages, size = run()
+        latencies.append(time.perf_counter() - start)
+
+    # Peak memory is measured separately, tracemalloc slows everything down
+    r_g.text_measure_cache.clear()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "latency_ms": round(statistics.median(latencies) * 1000, 3),
+        "latency_min_ms": round(min(latencies) * 1000, 3),
+        "repeat": repeat,
+        "pages": pages,
+        "bytes": size,
+        "peak_memory_bytes": peak,
+    }
+
+
+def run_suite(quick=False, repeat=3, only=None):
+    results = {}
+    for name, run in cases(quick):
+        if only and not any(part in name for part in only):
+            continue
+        result = measure(run, repeat)
+        results[name] = result
+        print(f"{name:42} {result['latency_ms']:10.1f} ms  {result['pages'] or '-':>5} pages  "
+              f"{result['bytes'] or '-':>9} bytes  {result['peak_memory_bytes'] / 1024:9.0f} KB peak",
+              file=sys.stderr)
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "fpdf2": fpdf.__version__,
+            "platform": platform.platform(),
+            "render_version": r_g.RENDER_VERSION,
+            "watermark_mode": r_g.WATERMARK_MODE,
+            "pdf_compaction": r_g.PDF_COMPACTION,
+            "image_dpi": r_g.IMAGE_DPI,
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Print a comparison table; return the list of regressions"""
+    regressions = []
+    print(f"{'case':42} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, base in baseline["results"].items():
+        now = current["results"].get(name)
+        if now is None:
+            continue
+        change = now["latency_ms"] / base["latency_ms"] - 1 if base["latency_ms"] else 0.0
+        flags = []
+        if change > threshold:
+            flags.append("SLOWER")
+        if base["bytes"] and now["bytes"] and now["bytes"] > base["bytes"] * (1 + threshold):
+            flags.append(f"bytes {base['bytes']} -> {now['bytes']}")
+        if base["pages"] is not None and now["pages"] != base["pages"]:
+            flags.append(f"pages {base['pages']} -> {now['pages']}")
+        if now["peak_memory_bytes"] > base["peak_memory_bytes"] * (1 + threshold):
+            flags.append(f"peak memory {base['peak_memory_bytes'] // 1024} -> {now['peak_memory_bytes'] // 1024} KB")
+        print(f"{name:42} {base['latency_ms']:10.1f} {now['latency_ms']:10.1f} {change:+8.1%}  {' '.join(flags)}")
+        if flags:
+            regressions.append((name, flags))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the PDF rendering pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the suite and save results")
+    run_parser.add_argument("--output", default="bench_baseline.json")
+
+    compare_parser = commands.add_parser("compare", help="compare against a saved baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current", nargs="?", help="saved results to compare instead of running the suite")
+    compare_parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative increase (default 0.15)")
+    compare_parser.add_argument("--output", help="also save the new results here")
+
+    for sub in (run_parser, compare_parser):
+        sub.add_argument("--quick", action="store_true", help="skip the largest payloads")
+        sub.add_argument("--repeat", type=int, default=3, help="timed runs per case (median is reported)")
+        sub.add_argument("--only", action="append", help="run only cases whose name contains this (repeatable)")
+
+    args = parser.parse_args(argv)
+    # Result files are relative to where the command was run, the report assets to this file:
+    # r_g mounts static/ when imported and renders logo.jpg by relative path
+    for name in ("output", "baseline", "current"):
+        if getattr(args, name, None):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    global r_g
+    import r_g
+
+    if args.command == "run":
+        results = run_suite(args.quick, args.repeat, args.only)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved {len(results['results'])} results to {args.output}", file=sys.stderr)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if args.current:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        only = args.only or None
+        current = run_suite(args.quick or baseline["meta"].get("quick", False), args.repeat, only)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+    if baseline["meta"].get("render_version") != current["meta"].get("render_version"):
+        print("note: RENDER_VERSION differs, output size and page changes are expected", file=sys.stderr)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        return 1
+    print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
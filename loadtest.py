@@ -0,0 +1,410 @@
+"""
+Load and soak tests for the HTTP service.
+
+    python loadtest.py run [--concurrency 8] [--duration 60] [--output load.json]
+    python loadtest.py soak [--duration 3600] [--report-every 60] [--max-rss-growth 64]
+
+Boots r_g:app with uvicorn on a free local port (or targets a running
+server with --url) and drives /generate_main_report and
+/generate_previous_reports from --concurrency client threads, picking
+payload sizes by the weights in PAYLOAD_MIX. Every payload carries a fresh
+UHID so renders miss the result cache like real traffic; --reuse-payloads
+measures the cached path instead.
+
+`run` reports throughput, latency percentiles and error rates per payload
+class, and the RSS of the server and each render worker sampled over time.
+`soak` keeps the load up for longer, prints one line per --report-every
+seconds and exits non-zero when a process grew by more than
+--max-rss-growth MB after the warm-up.
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+from api_test import generate_random_json_data
+
+# name, endpoint, advice rows, previous reports, weight
+PAYLOAD_MIX = (
+    ("main/small", "/generate_main_report", 5, 0, 50),
+    ("main/medium", "/generate_main_report", 40, 0, 20),
+    ("main/large", "/generate_main_report", 300, 0, 5),
+    ("previous/small", "/generate_previous_reports", 0, 10, 15),
+    ("previous/medium", "/generate_previous_reports", 0, 100, 8),
+    ("previous/large", "/generate_previous_reports", 0, 1000, 2),
+)
+PERCENTILES = (50, 90, 99)
+REQUEST_TIMEOUT = 120  # seconds
+SEED = 1234
+STARTUP_TIMEOUT = 60  # seconds
+
+
+def payload_bases(only=None):
+    """{name: (endpoint, payload, weight)} for the classes in PAYLOAD_MIX, identical for every run"""
+    random.seed(SEED)
+    bases = {}
+    for name, endpoint, advice_rows, previous_reports, weight in PAYLOAD_MIX:
+        if only and not any(part in name for part in only):
+            continue
+        data = generate_random_json_data(advice_rows, previous_reports)
+        data["creation_date"] = "2024-01-01T00:00:00"
+        bases[name] = (endpoint, data, weight)
+    return bases
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(render_workers=None):
+    """Start uvicorn as the Procfile does and wait for /ready; returns (process, base url)"""
+    port = free_port()
+    env = dict(os.environ)
+    if render_workers is not None:
+        env["RENDER_WORKERS"] = str(render_workers)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "r_g:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/ready", timeout=1).status_code == 200:
+                return process, url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Server not ready after {STARTUP_TIMEOUT}s")
+
+
+def stop_server(process):
+    """Stop the server; returns how many render workers outlived it and had to be killed"""
+    workers = child_pids(process.pid)
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    leaked = 0
+    for pid in workers:
+        if rss_bytes(pid) is not None:
+            os.kill(pid, signal.SIGKILL)
+            leaked += 1
+    return leaked
+
+
+def rss_bytes(pid):
+    """Resident set size of a process from /proc, or None where that is unavailable"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def child_pids(pid):
+    """Direct children of a process (the render workers of the server)"""
+    children = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return children
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces; the parent pid is the second field after it
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+class MemorySampler(threading.Thread):
+    """Samples the RSS of the server and its render workers every `interval` seconds"""
+
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []  # {"t": seconds since start, "rss": {label: bytes}}
+        self.started_at = time.monotonic()
+        self.stopped = threading.Event()
+
+    def sample(self):
+        rss = {"server": rss_bytes(self.pid)}
+        for child in child_pids(self.pid):
+            rss[f"worker-{child}"] = rss_bytes(child)
+        rss = {label: value for label, value in rss.items() if value is not None}
+        if rss:
+            self.samples.append({"t": round(time.monotonic() - self.started_at, 1), "rss": rss})
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+    def latest(self):
+        return self.samples[-1]["rss"] if self.samples else {}
+
+
+class LoadGenerator:
+    """Client threads sending weighted random payloads until the deadline or request limit"""
+
+    def __init__(self, url, bases, concurrency, reuse_payloads=False):
+        self.url = url
+        self.bases = bases
+        self.concurrency = concurrency
+        self.reuse_payloads = reuse_payloads
+        self.names = list(bases)
+        self.weights = [bases[name][2] for name in self.names]
+        self.results = []  # (finished at, class, status, latency seconds, response bytes)
+        self.sent = 0
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def body(self, name, number):
+        data = self.bases[name][1]
+        if not self.reuse_payloads:
+            data = dict(data, patient_data=dict(data["patient_data"], uhid=f"LT{number:09d}"))
+        return json.dumps(data).encode()
+
+    def client(self, rng, deadline, limit):
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            with self._lock:
+                if limit and self.sent >= limit:
+                    return
+                self.sent += 1
+                number = self.sent
+            name = rng.choices(self.names, self.weights)[0]
+            body = self.body(name, number)
+            start = time.monotonic()
+            try:
+                response = session.post(self.url + self.bases[name][0], data=body, timeout=REQUEST_TIMEOUT,
+                                        headers={"Content-Type": "application/json"})
+                status, size = response.status_code, len(response.content)
+            except requests.RequestException as e:
+                status, size = type(e).__name__, 0
+            finished = time.monotonic()
+            with self._lock:
+                self.results.append((finished, name, status, finished - start, size))
+
+    def start(self, duration, limit=None):
+        deadline = time.monotonic() + duration
+        self.threads = [
+            threading.Thread(target=self.client, args=(random.Random(SEED + i), deadline, limit), daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def running(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+def summarize(results, seconds):
+    """Throughput, error rate and latency percentiles, overall and per payload class"""
+    def stats(rows):
+        latencies = sorted(row[3] for row in rows if row[2] == 200)
+        statuses = {}
+        for row in rows:
+            statuses[str(row[2])] = statuses.get(str(row[2]), 0) + 1
+        errors = len(rows) - len(latencies)
+        summary = {
+            "requests": len(rows),
+            "throughput_rps": round(len(rows) / seconds, 2) if seconds else 0.0,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "statuses": statuses,
+            "bytes": sum(row[4] for row in rows),
+        }
+        for pct in PERCENTILES:
+            value = percentile(latencies, pct)
+            summary[f"p{pct}_ms"] = round(value * 1000, 1) if value is not None else None
+        summary["max_ms"] = round(latencies[-1] * 1000, 1) if latencies else None
+        summary["mean_ms"] = round(statistics.fmean(latencies) * 1000, 1) if latencies else None
+        return summary
+
+    by_class = {}
+    for row in results:
+        by_class.setdefault(row[1], []).append(row)
+    return {"overall": stats(results), "classes": {name: stats(rows) for name, rows in sorted(by_class.items())}}
+
+
+def memory_summary(samples, warmup):
+    """Per process: RSS at the first sample after the warm-up, at the end, and the peak"""
+    summary = {}
+    for sample in samples:
+        for label, rss in sample["rss"].items():
+            entry = summary.setdefault(label, {"first_bytes": rss, "peak_bytes": rss})
+            if sample["t"] <= warmup or "settled_bytes" not in entry:
+                entry["settled_bytes"] = rss
+            entry["last_bytes"] = rss
+            entry["peak_bytes"] = max(entry["peak_bytes"], rss)
+    for entry in summary.values():
+        entry["growth_bytes"] = entry["last_bytes"] - entry["settled_bytes"]
+    return summary
+
+
+def format_summary(name, s):
+    percentiles = "  ".join(f"p{pct} {s[f'p{pct}_ms'] or '-':>8}" for pct in PERCENTILES)
+    return (f"{name:18} {s['requests']:7} req {s['throughput_rps']:8.2f} req/s  {percentiles}  "
+            f"max {s['max_ms'] or '-':>8} ms  errors {s['error_rate']:6.2%}")
+
+
+def format_memory(rss):
+    return "  ".join(f"{label} {value / 1024 / 1024:.0f} MB" for label, value in sorted(rss.items()))
+
+
+def print_report(report):
+    summary = report["summary"]
+    print(format_summary("overall", summary["overall"]), file=sys.stderr)
+    for name, s in summary["classes"].items():
+        print(format_summary(name, s), file=sys.stderr)
+    for label, entry in sorted(report["memory"].items()):
+        print(f"{label:18} rss settled {entry['settled_bytes'] / 1024 / 1024:7.1f} MB  "
+              f"last {entry['last_bytes'] / 1024 / 1024:7.1f} MB  peak {entry['peak_bytes'] / 1024 / 1024:7.1f} MB  "
+              f"growth {entry['growth_bytes'] / 1024 / 1024:+7.1f} MB", file=sys.stderr)
+
+
+def run_load(args, report_every=None):
+    bases = payload_bases(args.only)
+    if not bases:
+        raise SystemExit("No payload class matches --only")
+    process = None
+    url = args.url
+    if not url:
+        process, url = start_server(args.render_workers)
+    sampler = MemorySampler(process.pid, args.sample_every) if process else None
+    try:
+        if sampler:
+            sampler.sample()
+            sampler.start()
+        load = LoadGenerator(url.rstrip("/"), bases, args.concurrency, args.reuse_payloads)
+        started = time.monotonic()
+        load.start(args.duration, args.requests)
+        reported, next_report = 0, started + (report_every or args.duration + 1)
+        while load.running():
+            time.sleep(0.2)
+            if report_every and time.monotonic() >= next_report:
+                # One line per interval: the requests finished since the previous line
+                window = load.results[reported:]
+                reported += len(window)
+                s = summarize(window, report_every)["overall"]
+                memory = format_memory(sampler.latest()) if sampler else ""
+                print(format_summary(f"{time.monotonic() - started:.0f}s", s) + "  " + memory, file=sys.stderr)
+                next_report += report_every
+        load.join()
+        seconds = time.monotonic() - started
+    finally:
+        try:
+            if sampler:
+                sampler.stop()
+        finally:
+            if process:
+                leaked = stop_server(process)
+                if leaked:
+                    print(f"{leaked} render worker(s) outlived the server and were killed", file=sys.stderr)
+
+    warmup = args.duration * args.warmup_fraction
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "url": args.url or "local",
+            "concurrency": args.concurrency,
+            "duration_s": round(seconds, 1),
+            "render_workers": args.render_workers,
+            "reuse_payloads": args.reuse_payloads,
+            "mix": {name: weight for name, (_, _, weight) in bases.items()},
+        },
+        "summary": summarize(load.results, seconds),
+        "memory": memory_summary(sampler.samples, warmup) if sampler else {},
+        "memory_samples": sampler.samples if sampler else [],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load and soak test the report service")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="drive load for a while and report latency and throughput")
+    run_parser.set_defaults(duration=60, report_every=None)
+    soak_parser = commands.add_parser("soak", help="long run with periodic reports and an RSS growth check")
+    soak_parser.set_defaults(duration=3600)
+    soak_parser.add_argument("--report-every", type=float, default=60, help="seconds between progress lines")
+    soak_parser.add_argument("--max-rss-growth", type=float, default=64,
+                             help="MB a process may grow after the warm-up before the soak fails (default 64)")
+
+    for sub in (run_parser, soak_parser):
+        sub.add_argument("--url", help="target a running server instead of booting one (no memory samples)")
+        sub.add_argument("--concurrency", type=int, default=8, help="client threads (default 8)")
+        sub.add_argument("--duration", type=float, help="seconds to run")
+        sub.add_argument("--requests", type=int, help="stop after this many requests")
+        sub.add_argument("--render-workers", type=int, help="RENDER_WORKERS for the booted server")
+        sub.add_argument("--only", action="append", help="send only payload classes whose name contains this")
+        sub.add_argument("--reuse-payloads", action="store_true", help="send identical payloads (result cache hits)")
+        sub.add_argument("--sample-every", type=float, default=1, help="seconds between RSS samples")
+        sub.add_argument("--warmup-fraction", type=float, default=0.1,
+                         help="share of the run before RSS growth is measured (default 0.1)")
+        sub.add_argument("--output", help="save the results as JSON")
+
+    args = parser.parse_args(argv)
+    report = run_load(args, args.report_every)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}", file=sys.stderr)
+
+    if args.command == "soak":
+        limit = args.max_rss_growth * 1024 * 1024
+        grown = [label for label, entry in report["memory"].items() if entry["growth_bytes"] > limit]
+        if grown:
+            print(f"RSS grew by more than {args.max_rss_growth} MB: {', '.join(sorted(grown))}")
+            return 1
+        print("No RSS growth beyond the limit")
+    return 0
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # the server loads logo.jpg and static/ by relative path
+    sys.exit(main())
@@ -2,16 +2,63 @@ from fpdf import FPDF, XPos, YPos
 import textwrap
 import json
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, FileResponse, Response
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import base64
 from fastapi.staticfiles import StaticFiles
 from io import BytesIO
 from PIL import Image
-import math
+import os
+import tempfile
+import queue
+import codecs
+from datetime import datetime, timezone
+import hashlib
+import threading
+import asyncio
+import zipfile
+import re
+import signal
+import uuid
+import time
+import zlib
+import copy
+import functools
+import importlib.util
+import logging
+import argparse
+import random
+import sys
+import tracemalloc
+import warnings
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, defaultdict, deque
+from types import SimpleNamespace
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Annotated, List, Literal, Optional, Union
+from pydantic import AfterValidator, BaseModel, BeforeValidator, ConfigDict, Field, ValidationError
+from fontTools import subset as ftsubset, ttLib
+from fpdf.enums import TextEmphasis
+from fpdf.errors import FPDFException
+from fpdf.fonts import SubsetMap, TTFFont
+from fpdf.image_parsing import get_img_info
+from fpdf.line_break import BREAKING_SPACE_SYMBOLS_STR, SOFT_HYPHEN
+from fpdf.output import (LOGGER, CIDSystemInfo, OutputProducer, PDFFont, PDFPagesRoot, PDFResources, PDFXObject,
+                         _tt_font_widths)
+from fpdf.syntax import Name, PDFArray, PDFContentStream, PDFObject, create_dictionary_string as pdf_dict, iobj_ref as pdf_ref
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """Start the job queue and the startup warmup; stop the jobs and render workers on shutdown."""
+    job_queue.start()
+    warmup.start()
+    yield
+    job_queue.stop()
+    render_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -23,31 +70,1322 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Upper bound (in bytes of encoded image data) for the shared asset cache
+ASSET_CACHE_MAX_BYTES = int(os.environ.get("ASSET_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# Watermark rendering: "opacity" draws the original logo under a PDF graphics-state
+# alpha, "baked" rewrites the pixels with Pillow (original behaviour)
+WATERMARK_MODES = ("opacity", "baked")
+WATERMARK_MODE = os.environ.get("WATERMARK_MODE", "opacity")
+WATERMARK_ALPHA = 60  # 0-255
+
+# Logos wider than needed to print IMAGE_MAX_WIDTH_MM wide (the watermark, the largest
+# use) at IMAGE_DPI are downsampled and re-encoded when decoded; IMAGE_DPI=0 embeds them as given
+IMAGE_DPI = int(os.environ.get("IMAGE_DPI", 300))
+IMAGE_MAX_WIDTH_MM = 60
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", 90))  # for photographic logos
+
+# PDF compaction preset used when a request does not choose one, see COMPACTION_PRESETS
+PDF_COMPACTION = os.environ.get("PDF_COMPACTION", "none")
+DEFAULT_DEFLATE_LEVEL = 6  # zlib's default, what fpdf compresses streams with
+OBJECT_STREAM_SIZE = 100  # objects per compressed object stream
+
+# Unicode text: TrueType files for the report font. Without REPORT_FONT the core
+# helvetica font is used, which only covers Latin-1. Unset styles use the regular file.
+REPORT_FONT = os.environ.get("REPORT_FONT")
+REPORT_FONT_BOLD = os.environ.get("REPORT_FONT_BOLD")
+REPORT_FONT_ITALIC = os.environ.get("REPORT_FONT_ITALIC")
+# More TrueType files (os.pathsep separated) for characters the report font lacks,
+# e.g. a Devanagari or an Arabic-script font
+REPORT_FALLBACK_FONTS = [path for path in os.environ.get("REPORT_FALLBACK_FONTS", "").split(os.pathsep) if path]
+# HarfBuzz text shaping (optional uharfbuzz package): needed for joined or reordered
+# scripts such as Urdu and Hindi, and makes all text slower to lay out
+REPORT_TEXT_SHAPING = os.environ.get("REPORT_TEXT_SHAPING", "0") == "1"
+if (REPORT_FALLBACK_FONTS or REPORT_TEXT_SHAPING) and not REPORT_FONT:
+    raise ValueError("REPORT_FALLBACK_FONTS and REPORT_TEXT_SHAPING need REPORT_FONT")
+if REPORT_TEXT_SHAPING and importlib.util.find_spec("uharfbuzz") is None:
+    raise ValueError("REPORT_TEXT_SHAPING needs the uharfbuzz package")
+# Subsetted font programs kept per distinct (font file, glyph set)
+FONT_SUBSET_CACHE_ENTRIES = int(os.environ.get("FONT_SUBSET_CACHE_ENTRIES", 256))
+
+# Render worker pool: RENDER_WORKERS=0 renders in a thread of this process instead
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+RENDER_QUEUE_SIZE = int(os.environ.get("RENDER_QUEUE_SIZE", 16))  # waiting renders beyond busy workers
+RENDER_TIMEOUT = float(os.environ.get("RENDER_TIMEOUT", 25))  # seconds
+RENDER_RETRY_AFTER = int(os.environ.get("RENDER_RETRY_AFTER", 5))  # seconds, sent with 503
+# Previous consultations reports with at least this many entries are rendered in page-aligned
+# chunks on all render workers at once and merged (render_chunked); 0 disables. Not with
+# REPORT_FONT: each chunk would subset the fonts differently.
+CHUNKED_RENDER_MIN_REPORTS = int(os.environ.get("CHUNKED_RENDER_MIN_REPORTS", 1000))
+# Memory admission: renders on the pool may together hold RENDER_MEMORY_BUDGET bytes as estimated
+# from the request (estimate_render_memory; 0 disables). A render that does not fit waits for
+# running ones to finish; one estimated above RENDER_MEMORY_MAX_REQUEST is rejected with 413.
+RENDER_MEMORY_BUDGET = int(os.environ.get("RENDER_MEMORY_BUDGET", 512 * 1024 * 1024))
+RENDER_MEMORY_MAX_REQUEST = int(os.environ.get("RENDER_MEMORY_MAX_REQUEST", 256 * 1024 * 1024))
+# Share of renders whose peak memory is measured with tracemalloc, to calibrate the estimate
+# (/admin/render_memory). A traced render runs several times slower.
+RENDER_MEMORY_TRACE_RATE = float(os.environ.get("RENDER_MEMORY_TRACE_RATE", 0))
+# Concurrent renders per batch request; the pool still bounds the process-wide total
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", max(RENDER_WORKERS, 1)))
+
+# Rendered PDF cache; RESULT_CACHE_DIR enables the on-disk tier
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESULT_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+# Bump when a change alters rendered output, so cached PDFs are not reused
+RENDER_VERSION = "5"
+
+# Asynchronous jobs: records and results live in JOBS_DIR so they survive restarts. By default
+# jobs get half the render workers, leaving the rest to synchronous requests.
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "report_jobs"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", max(RENDER_WORKERS // 2, 1)))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 1000))  # queued jobs before POST /jobs answers 503
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", 3600))  # seconds per job render
+JOB_TTL = float(os.environ.get("JOB_TTL", 24 * 3600))  # seconds a finished job is kept
+JOB_PROGRESS_INTERVAL = 0.5  # seconds between progress updates from the render
+
+# Registered letterheads (see LetterheadStore), shared by the render workers and kept across restarts
+LETTERHEAD_DIR = os.environ.get("LETTERHEAD_DIR", os.path.join(tempfile.gettempdir(), "report_letterheads"))
+# Seconds a deleted letterhead's images are kept, for renders and queued jobs that already resolved them
+LETTERHEAD_IMAGE_GRACE = float(os.environ.get("LETTERHEAD_IMAGE_GRACE", 24 * 3600))
+
+# Startup warmup: preload assets and render one throwaway report of each kind, here and in
+# the render workers, before /ready reports ready. WARMUP_REQUEST is the report data used.
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+WARMUP_REQUEST = os.environ.get("WARMUP_REQUEST", "static/report_data.json")
+
+# Wrapped-text memo size (distinct text/font/size/width combinations per process)
+TEXT_MEASURE_CACHE_ENTRIES = int(os.environ.get("TEXT_MEASURE_CACHE_ENTRIES", 20000))
+
+# Streaming renders: chunks buffered between the request body / PDF output and the render thread
+STREAM_QUEUE_CHUNKS = int(os.environ.get("STREAM_QUEUE_CHUNKS", 8))
+# Response encodings: the raw PDF, the same bytes streamed in slices, or base64 in a JSON object
+OUTPUT_FORMATS = ("pdf", "stream", "base64")
+OUTPUT_CHUNK_BYTES = 3 * 64 * 1024  # a multiple of 3, so base64 chunks join without padding
+# Request bodies larger than this are validated off the event loop
+PARSE_IN_THREAD_BYTES = int(os.environ.get("PARSE_IN_THREAD_BYTES", 256 * 1024))
+
+
+# Request schema. Text fields accept strings and numbers (kept as text); null
+# or a missing field is an empty string. Unknown keys are ignored.
+Text = Annotated[str, BeforeValidator(lambda value: "" if value is None else value)]
+
+
+def check_image_source(value):
+    if value.startswith("data:") and "," not in value:
+        raise ValueError("data URI has no data, expected data:<type>;base64,<data>")
+    return value
+
+
+# File path, data URI or base64 image
+ImageSource = Annotated[str, AfterValidator(check_image_source)]
+
+
+class RequestModel(BaseModel):
+    model_config = ConfigDict(extra="ignore", coerce_numbers_to_str=True, frozen=True)
+
+
+class PatientData(RequestModel):
+    name: Text = ""
+    uhid: Text = ""
+    age: Text = ""
+    sex: Text = ""
+    date: Text = ""
+    chief_complaints: Text = ""
+    aggravating_factor: Text = ""
+    present_illness: Text = ""
+    family_history: Text = ""
+    surgical_history: Text = ""
+    examination: Text = ""
+    clinical_impression: Text = ""
+
+
+class HospitalFooter(RequestModel):
+    name: Text = ""
+    address: Text = ""
+    email: Text = ""
+    phone: Text = ""
+
+
+class HospitalData(RequestModel):
+    name: Text = ""
+    address: Text = ""
+    phone: Text = ""
+    email: Text = ""
+    website: Text = ""
+    emergency: Text = ""
+    footer: HospitalFooter = HospitalFooter()
+
+
+class DoctorData(RequestModel):
+    name: Text = ""
+    degree: Text = ""
+    speciality: Text = ""
+    mobile: Text = ""
+    email: Text = ""
+    pmc: Text = ""
+
+
+class Advice(RequestModel):
+    name: Text = ""
+    dosage: Text = ""
+    details: Text = ""
+
+
+class PreviousReport(RequestModel):
+    date: Text = ""
+    hospital: Text = ""
+    consultation: Text = ""
+
+
+class Compaction(RequestModel):
+    """Output size against render CPU; the cost shows up as the "compact" render stage"""
+    deflate_level: int = Field(DEFAULT_DEFLATE_LEVEL, ge=0, le=9)  # zlib level of page, form and PNG image streams
+    object_streams: bool = False  # pack dictionaries into compressed object streams, with an xref stream (PDF 1.5)
+    dedupe: bool = False  # share identical /Resources dictionaries and form XObjects
+    strip: bool = False  # leave out fonts no page uses and the obsolete /ProcSet entries
+
+
+COMPACTION_PRESETS = {
+    "none": Compaction(),
+    "standard": Compaction(object_streams=True, dedupe=True, strip=True),
+    "max": Compaction(deflate_level=9, object_streams=True, dedupe=True, strip=True),
+}
+if PDF_COMPACTION not in COMPACTION_PRESETS:
+    raise ValueError(f"PDF_COMPACTION must be one of {', '.join(COMPACTION_PRESETS)}")
+
+
+class Letterhead(RequestModel):
+    """The per-clinic part of a report request, registered once through POST /letterheads"""
+    hospital_data: HospitalData = HospitalData()
+    doctor_data: DoctorData = DoctorData()
+    # Data URI or base64, never a server file; None leaves the report request's default
+    logo_data: Optional[ImageSource] = None
+    watermark_logo: Optional[ImageSource] = None
+
+
+class ReportRequest(RequestModel):
+    patient_data: PatientData = PatientData()
+    hospital_data: HospitalData = HospitalData()
+    doctor_data: DoctorData = DoctorData()
+    advice_data: List[Advice] = []
+    previous_reports: List[PreviousReport] = []
+    logo_data: ImageSource = "logo.jpg"
+    watermark_logo: ImageSource = "logo.jpg"
+    watermark_mode: Optional[Literal[WATERMARK_MODES]] = None  # default WATERMARK_MODE
+    creation_date: Optional[datetime] = None  # fixes the PDF metadata date, for reproducible output
+    # Preset name or explicit settings; default PDF_COMPACTION
+    compaction: Union[Literal[tuple(COMPACTION_PRESETS)], Compaction, None] = None
+    # Registered letterhead id, resolved by apply_letterhead; not part of the rendered request
+    letterhead: Optional[str] = Field(None, exclude=True)
+
+
+def parse_report_request(data):
+    """ReportRequest from raw JSON (bytes or str), a dict, or an already parsed request; raises ValidationError."""
+    if isinstance(data, ReportRequest):
+        return data
+    if isinstance(data, (bytes, bytearray, str)):
+        return apply_letterhead(ReportRequest.model_validate_json(data))
+    return apply_letterhead(ReportRequest.model_validate(data))
+
+
+def apply_letterhead(request):
+    """Fill in the fields of the request's registered letterhead that the request does not set itself"""
+    if request.letterhead is None:
+        return request
+    fields = letterhead_store.get(request.letterhead)
+    if fields is None:
+        raise ValidationError.from_exception_data(ReportRequest.__name__, [{
+            "type": "value_error", "loc": ("letterhead",), "input": request.letterhead,
+            "ctx": {"error": ValueError(f"Unknown letterhead {request.letterhead}")},
+        }])
+    letterhead = Letterhead.model_validate(fields)
+    return request.model_copy(update={key: getattr(letterhead, key) for key in letterhead.model_fields_set
+                                      if key not in request.model_fields_set})
+
+
+def read_image_source(source, allow_paths=True):
+    """
+    Return the raw bytes of an image source.
+    source: file path (unless allow_paths is false), data URI / base64 string, bytes or BytesIO
+    """
+    if isinstance(source, BytesIO):
+        return source.getvalue()
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if source.startswith("data:"):
+        return base64.b64decode(source.partition(",")[2])
+    if allow_paths and os.path.exists(source):
+        with open(source, "rb") as f:
+            return f.read()
+    return base64.b64decode(source, validate=True)
+
+
+IMAGE_HEADER_BYTES = 64 * 1024  # enough of an encoded image for PIL to read its size
+
+
+def image_decode_memory(source):
+    """
+    Bytes needed to decode and normalize an image source: its pixels, half as much
+    again for the resampled copy, and the encoded data twice over. Only the start
+    of the image is read; an unreadable one counts its encoded size alone.
+    """
+    if source.startswith("data:") or not os.path.exists(source):
+        text = source.partition(",")[2] if source.startswith("data:") else source
+        encoded_size = len(text) * 3 // 4
+        try:
+            header = base64.b64decode(text[:IMAGE_HEADER_BYTES // 3 * 4])
+        except ValueError:
+            return 2 * encoded_size
+    else:
+        encoded_size = os.path.getsize(source)
+        with open(source, "rb") as f:
+            header = f.read(IMAGE_HEADER_BYTES)
+    try:
+        img = Image.open(BytesIO(header))
+    except Exception:
+        return 2 * encoded_size
+    return img.width * img.height * len(img.getbands()) * 3 // 2 + 2 * encoded_size
+
+
+def bake_watermark(img):
+    """Convert a PIL image to a greyscale RGBA watermark with fixed low opacity."""
+    img = img.convert("L").convert("RGBA")
+    watermark = Image.new("RGBA", img.size, (255, 255, 255, 0))
+    watermark.paste(img, (0, 0), img)
+    pixels = watermark.load()
+    for y in range(watermark.size[1]):
+        for x in range(watermark.size[0]):
+            r, g, b, a = pixels[x, y]
+            pixels[x, y] = (r, g, b, WATERMARK_ALPHA)
+    return watermark
+
+
+def normalize_image(data, dpi=IMAGE_DPI):
+    """
+    Image bytes no wider than IMAGE_MAX_WIDTH_MM needs at dpi. A larger image is
+    resampled and re-encoded: PNG (Flate in the PDF) when it has transparency or few
+    colours, as drawn artwork does, JPEG otherwise. Returns data itself when the
+    image is small enough already.
+    """
+    if not dpi:
+        return data
+    img = Image.open(BytesIO(data))
+    max_width = round(IMAGE_MAX_WIDTH_MM / 25.4 * dpi)
+    if img.width <= max_width:
+        return data
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    flat = has_alpha or (img.mode != "CMYK" and img.getcolors(256) is not None)  # PNG has no CMYK
+    icc_profile = img.info.get("icc_profile")
+    if img.mode not in ("L", "LA", "RGB", "RGBA", "CMYK"):
+        img = img.convert("RGBA" if has_alpha else "RGB")
+    img.thumbnail((max_width, img.height), Image.LANCZOS)  # for JPEGs, decodes at a reduced scale
+    out = BytesIO()
+    if flat:
+        img.save(out, format="PNG", icc_profile=icc_profile)
+    else:
+        img.save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, icc_profile=icc_profile)
+    return out.getvalue()
+
+
+def _decode_logo(data):
+    return get_img_info("logo", BytesIO(data))
+
+
+def _decode_watermark(data):
+    return get_img_info("watermark", bake_watermark(Image.open(BytesIO(data))))
+
+
+class AssetCache:
+    """
+    Process-wide LRU cache of decoded report images (logos and watermarks).
+
+    Entries are keyed by the SHA-256 of the image content plus a variant name
+    and hold fpdf image info (already encoded pixel data), so a logo that has
+    been seen before can be placed into any new document without decoding it.
+    Images are downsampled for print by normalize_image on the way in.
+    """
+
+    variants = {
+        "logo": _decode_logo,
+        "watermark": _decode_watermark,
+    }
+
+    def __init__(self, max_bytes=ASSET_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.normalized = 0
+        self.normalized_bytes_saved = 0  # source bytes minus the normalized image's
+        self._entries = OrderedDict()
+        # (path, mtime, size) -> digest, so known files are not re-read per request
+        self._path_digests = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, source):
+        """Return (digest, data) for a source; data is None if the digest was memoized."""
+        if isinstance(source, str) and not source.startswith("data:") and os.path.exists(source):
+            st = os.stat(source)
+            stat_key = (os.path.abspath(source), st.st_mtime_ns, st.st_size)
+            digest = self._path_digests.get(stat_key)
+            if digest:
+                return digest, None
+            data = read_image_source(source)
+            digest = hashlib.sha256(data).hexdigest()
+            self._path_digests[stat_key] = digest
+            return digest, data
+        data = read_image_source(source)
+        return hashlib.sha256(data).hexdigest(), data
+
+    def content_digest(self, source):
+        """SHA-256 of an image source's content"""
+        return self._digest(source)[0]
+
+    @staticmethod
+    def _entry_size(info):
+        return len(info.get("data") or b"") + len(info.get("smask") or b"") + len(info.get("pal") or b"")
+
+    def get(self, source, variant="logo"):
+        """Return (name, info) for the given image source and variant, decoding only on a miss."""
+        digest, data = self._digest(source)
+        key = (digest, variant)
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return f"{variant}-{digest}", info
+            self.misses += 1
+
+        if data is None:
+            data = read_image_source(source)
+        normalized = normalize_image(data)
+        info = self.variants[variant](normalized)
+        size = self._entry_size(info)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = info
+                self.current_bytes += size
+                if normalized is not data:
+                    self.normalized += 1
+                    self.normalized_bytes_saved += len(data) - len(normalized)
+                while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.current_bytes -= self._entry_size(evicted)
+                    self.evictions += 1
+        return f"{variant}-{digest}", info
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "normalized": self.normalized,
+                "normalized_bytes_saved": self.normalized_bytes_saved,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._path_digests.clear()
+            self.current_bytes = 0
+
+
+asset_cache = AssetCache()
+
+
+class SharedTTFFont(TTFFont):
+    """A document's handle on a TrueType font parsed once by FontCache"""
+
+    __slots__ = ()
+
+    def close(self):
+        pass  # the parsed tables belong to the cache
+
+
+class FontCache:
+    """
+    TrueType fonts for every document of the process. fpdf's add_font parses the
+    font file again for each document and subsets it again when writing it out;
+    here the glyph metrics and cmap are parsed once per file, and the subsetted
+    font program is kept per glyph set, so repeated renders only build a SubsetMap.
+    """
+
+    def __init__(self, max_entries=FONT_SUBSET_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._fonts = {}
+        self._subsets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _parsed(self, path):
+        font = self._fonts.get(path)
+        if font is None:
+            font = TTFFont(SimpleNamespace(fonts={}, str_alias_nb_pages=None), path, "", "")
+            font.close()
+            with self._lock:
+                font = self._fonts.setdefault(path, font)
+        return font
+
+    def preload(self, *paths):
+        for path in paths:
+            if path:
+                self._parsed(path)
+
+    def add_to(self, pdf, family, style, path):
+        """Register the font file as family/style in pdf, like pdf.add_font would"""
+        parsed = self._parsed(path)
+        font = SharedTTFFont.__new__(SharedTTFFont)
+        for slot in TTFFont.__slots__:
+            if slot != "hbfont":  # left unset: fpdf creates the HarfBuzz font on first shaping
+                setattr(font, slot, getattr(parsed, slot))
+        font.i = len(pdf.fonts) + 1
+        font.fontkey = f"{family.lower()}{style}"
+        font.emphasis = TextEmphasis.coerce(style)
+        font.desc = copy.copy(parsed.desc)  # gets the document's object id and font name
+        font.missing_glyphs = []
+        font.ttfont = None
+        identities = "\x00 \r\n"
+        if pdf.str_alias_nb_pages:
+            identities += "0123456789" + pdf.str_alias_nb_pages
+        font.subset = SubsetMap(font, [ord(char) for char in identities])
+        pdf.fonts[font.fontkey] = font
+        return font
+
+    def subset(self, path, glyph_names):
+        """(deflated font program, its length before compression, glyph id by glyph name)"""
+        key = (path, frozenset(glyph_names))
+        with self._lock:
+            entry = self._subsets.get(key)
+            if entry is not None:
+                self._subsets.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        ttfont = ttLib.TTFont(path, recalcTimestamp=False, fontNumber=0, lazy=True)
+        try:
+            # Same options as fpdf's own subsetting
+            options = ftsubset.Options(notdef_outline=True, recommended_glyphs=True)
+            options.drop_tables += ["FFTM", "GDEF", "GPOS", "GSUB", "MATH", "hdmx", "meta"]
+            subsetter = ftsubset.Subsetter(options)
+            subsetter.populate(glyphs=glyph_names)
+            subsetter.subset(ttfont)
+            glyph_ids = {name: ttfont.getGlyphID(name) for name in glyph_names}
+            output = BytesIO()
+            ttfont.save(output)
+        finally:
+            ttfont.close()
+        program = output.getvalue()
+        entry = (zlib.compress(program, DEFAULT_DEFLATE_LEVEL), len(program), glyph_ids)
+
+        with self._lock:
+            self._subsets[key] = entry
+            while len(self._subsets) > self.max_entries:
+                self._subsets.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "fonts": len(self._fonts),
+                "subsets": len(self._subsets),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+            self._subsets.clear()
+
+
+font_cache = FontCache()
+
+
+class PDFDeflatedFontStream(PDFContentStream):
+    """FontFile2 stream built from an already deflated font program"""
+
+    def __init__(self, contents, length1):
+        super().__init__(contents=contents)
+        self.filter = Name("FlateDecode")
+        self.length1 = length1
+
+
+class GlyphWidths(dict):
+    """Advance width (document units) of each character for one font at one size, filled on first use"""
+
+    def __init__(self, font, size_pt, k):
+        super().__init__()
+        self.cw = font.cw
+        self.by_ord = font.type == "TTF"  # TTF widths are keyed by code point, core fonts by character
+        self.size_pt = size_pt
+        self.k = k
+
+    def __missing__(self, char):
+        # Same arithmetic as fpdf's Fragment.get_width so wrap decisions agree to the last bit
+        width = self.cw[ord(char) if self.by_ord else char] * self.size_pt * 0.001 / self.k
+        self[char] = width
+        return width
+
+    def text_width(self, text):
+        return sum(self[c] for c in text)
+
+
+# Shared by every document: keyed by (font file or core font key, size in pt, scale factor)
+glyph_width_tables = {}
+
+
+def glyph_widths(font, size_pt, k):
+    key = (getattr(font, "ttffile", None) or font.fontkey, size_pt, k)
+    table = glyph_width_tables.get(key)
+    if table is None:
+        table = glyph_width_tables[key] = GlyphWidths(font, size_pt, k)
+    return table
+
+
+def wrap_text(text, widths, max_width):
+    """
+    Split text into the lines multi_cell prints when word wrapping within max_width
+    (the cell width minus cell margins). Mirrors fpdf's MultiLineBreak for a single
+    unstyled fragment: break at the last space, else mid-word; newlines force a break.
+    """
+    lines = []
+    start = 0
+    width = 0.0
+    last_space = None
+    i, n = 0, len(text)
+    while i < n:
+        char = text[i]
+        if char == "\n" or char == "\f":
+            lines.append(text[start:i])
+            i += 1
+            start, width, last_space = i, 0.0, None
+            continue
+        char_width = widths[char]
+        if width + char_width > max_width:
+            if char in BREAKING_SPACE_SYMBOLS_STR:
+                lines.append(text[start:i])
+                i += 1  # the space at the break is dropped
+            elif last_space is not None:
+                lines.append(text[start:last_space])
+                i = last_space + 1
+            elif not width:
+                raise FPDFException("Not enough horizontal space to render a single character")
+            else:
+                lines.append(text[start:i])
+            start, width, last_space = i, 0.0, None
+            continue
+        if char in BREAKING_SPACE_SYMBOLS_STR:
+            last_space = i
+        width += char_width
+        i += 1
+    if width:
+        lines.append(text[start:])
+    return lines or [""]
+
+
+class TextMeasureCache:
+    """
+    Process-wide LRU memo of wrapped text, keyed by (text, font, size, width).
+
+    Consultation templates and advice instructions repeat the same text across
+    reports, so each distinct paragraph is broken into lines once per worker.
+    """
+
+    def __init__(self, max_entries=TEXT_MEASURE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lines(self, text, font, size_pt, k, max_width):
+        """Lines multi_cell prints text on within max_width (cell width minus cell margins)"""
+        key = (text, getattr(font, "ttffile", None) or font.fontkey, size_pt, k, max_width)
+        with self._lock:
+            lines = self._entries.get(key)
+            if lines is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return lines
+            self.misses += 1
+
+        lines = tuple(wrap_text(text, glyph_widths(font, size_pt, k), max_width))
+
+        with self._lock:
+            self._entries[key] = lines
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return lines
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+text_measure_cache = TextMeasureCache()
+
+
+class PDFFormXObject(PDFContentStream):
+    def __init__(self, contents, width, height, resources, compress):
+        super().__init__(contents=contents, compress=compress)
+        self.type = Name("XObject")
+        self.subtype = Name("Form")
+        self.b_box = f"[0 0 {width:.2f} {height:.2f}]"
+        self.resources = resources
+
+
+OBJECT_END = b"\nendobj\n"
+STREAM_END = b"\nendstream" + OBJECT_END
+
+
+@functools.lru_cache(maxsize=64)
+def redeflate_image(data, level):
+    # Images come from the shared asset cache, so every document would recompress the same bytes
+    return zlib.compress(zlib.decompress(data), level)
+
+
+def redeflate_stream(pdf_obj, level):
+    """Re-encode a FlateDecode stream object at another zlib level"""
+    data = pdf_obj._contents
+    if isinstance(pdf_obj, PDFXObject) and isinstance(data, bytes):
+        data = redeflate_image(data, level)
+    else:
+        data = zlib.compress(zlib.decompress(data), level)
+    pdf_obj._contents = data
+    pdf_obj.length = len(data)
+
+
+def id_ranges(ids):
+    """[first id, count] runs of consecutive object ids, i.e. xref subsections"""
+    ranges = []
+    for obj_id in ids:
+        if ranges and ranges[-1][0] + ranges[-1][1] == obj_id:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([obj_id, 1])
+    return ranges
+
+
+def xref_stream(xref_id, entries, trailer, level):
+    """
+    Serialized cross-reference stream object number xref_id. entries maps object
+    ids to (type, field 2, field 3) rows; trailer lists trailer entries as PDF text.
+    """
+    ids = sorted(entries)
+    width = max((max(max(row[1] for row in entries.values()), xref_id).bit_length() + 7) // 8, 1)
+    rows = b"".join(kind.to_bytes(1, "big") + field.to_bytes(width, "big") + extra.to_bytes(2, "big")
+                    for kind, field, extra in (entries[i] for i in ids))
+    data = zlib.compress(rows, level)
+    lines = [f"{xref_id} 0 obj", "<<", "/Type /XRef", f"/Size {xref_id + 1}"]
+    ranges = id_ranges(ids)
+    if ranges != [[0, xref_id + 1]]:
+        lines.append("/Index [" + " ".join(f"{start} {count}" for start, count in ranges) + "]")
+    lines += [f"/W [1 {width} 2]", *trailer, "/Filter /FlateDecode", f"/Length {len(data)}", ">>", "stream\n"]
+    return "\n".join(lines).encode() + data + b"\nendstream\nendobj\n"
+
+
+# Previous consultations PDFs end with a comment holding what PreviousPatientReport.append_to
+# needs to continue them: the page tree, the last page's objects and where the text ended
+APPEND_STATE_MARKER = b"%ReportAppendState "
+APPEND_STATE_VERSION = 1
+
+
+def read_append_state(pdf_bytes):
+    """The append state of a rendered previous consultations PDF; ValueError if it has none"""
+    start = pdf_bytes.rfind(APPEND_STATE_MARKER)
+    end = pdf_bytes.find(b"\n", start)
+    match = re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", pdf_bytes[-64:])
+    if start < 0 or end < 0 or not match:
+        raise ValueError("Not a previous consultations PDF rendered by this service")
+    state = json.loads(pdf_bytes[start + len(APPEND_STATE_MARKER):end])
+    if state.get("version") != APPEND_STATE_VERSION:
+        raise ValueError(f"Unsupported append state version {state.get('version')}")
+    state["prev"] = int(match.group(1))  # the last xref section, which the update points back to
+    state["length"] = len(pdf_bytes)
+    file_id = re.search(rb"/ID \[([^\]]*)\]", pdf_bytes[state["prev"]:start])
+    state["file_id"] = file_id.group(1).decode("latin-1") if file_id else None
+    return state
+
+
+class FormXObjectOutputProducer(OutputProducer):
+    """
+    OutputProducer that also writes the form XObjects recorded by
+    PatientReport.draw_form and adds them to the /Resources of the pages using them,
+    and applies the document's Compaction settings.
+    """
+
+    # Objects may be packed into object streams (needs every object still in the buffer)
+    can_pack_objects = True
+
+    def __init__(self, fpdf):
+        super().__init__(fpdf)
+        self.compaction = getattr(fpdf, "compaction", None) or COMPACTION_PRESETS["none"]
+        self.resources_by_content = {}
+
+    def _add_pdf_obj(self, pdf_obj, trace_label=None):
+        compaction = self.compaction
+        if isinstance(pdf_obj, PDFResources):
+            if compaction.strip:
+                pdf_obj.proc_set = None  # obsolete since PDF 1.4
+            if compaction.dedupe:
+                return None  # registered by _shared_resources once the dictionary is final
+        elif compaction.deflate_level != DEFAULT_DEFLATE_LEVEL and getattr(pdf_obj, "filter", None) == "FlateDecode":
+            with self.fpdf.stage("compact"):
+                redeflate_stream(pdf_obj, compaction.deflate_level)
+        return super()._add_pdf_obj(pdf_obj, trace_label)
+
+    def _shared_resources(self, resources):
+        """Register a /Resources dictionary, or return an identical one registered before"""
+        key = (resources.proc_set, resources.font, resources.x_object, resources.ext_g_state)
+        shared = self.resources_by_content.setdefault(key, resources)
+        if shared._id is None:
+            super()._add_pdf_obj(shared)
+        return shared
+
+    def _add_fonts(self):
+        fpdf = self.fpdf
+        fonts = fpdf.fonts
+        used = set().union(*fpdf.fonts_used_per_page_number.values(),
+                           *(form["fonts"] for form in fpdf.form_xobjects.values()))
+        # Fonts from the shared cache are written below; unused ones are always left out
+        shared = [font for font in fonts.values() if isinstance(font, SharedTTFFont) and font.i in used]
+        own = {key: font for key, font in fonts.items() if not isinstance(font, SharedTTFFont)}
+        if self.compaction.strip:
+            # Fonts selected but never used on a page, e.g. set before the first add_page()
+            own = {key: font for key, font in own.items() if font.i in used}
+        fpdf.fonts = own
+        try:
+            self.font_objs_per_index = super()._add_fonts()
+        finally:
+            fpdf.fonts = fonts
+        for font in sorted(shared, key=lambda font: font.i):
+            self.font_objs_per_index[font.i] = self._add_shared_ttf_font(font)
+        return self.font_objs_per_index
+
+    def _add_shared_ttf_font(self, font):
+        """The objects fpdf writes for a TrueType font, with the font program from font_cache"""
+        fontname = f"MPDFAA+{font.name}"
+        glyph_names = font.subset.get_all_glyph_names()
+        if font.missing_glyphs:
+            LOGGER.warning("Font %s is missing %d glyphs, e.g. %r", fontname, len(font.missing_glyphs),
+                           "".join(chr(x) for x in font.missing_glyphs[:10]))
+        program, program_length, glyph_ids = font_cache.subset(font.ttffile, glyph_names)
+
+        composite_font_obj = PDFFont(subtype="Type0", base_font=fontname, encoding="Identity-H")
+        self._add_pdf_obj(composite_font_obj, "fonts")
+        cid_font_obj = PDFFont(subtype="CIDFontType2", base_font=fontname,
+                               d_w=font.desc.missing_width, w=_tt_font_widths(font))
+        self._add_pdf_obj(cid_font_obj, "fonts")
+        composite_font_obj.descendant_fonts = PDFArray([cid_font_obj])
+
+        # Unicode of each code, for text search and copy
+        bf_chars = []
+        for glyph, code in font.subset.items():
+            if glyph.unicode:
+                # UTF-16BE, i.e. surrogate pairs beyond the BMP
+                unicode = "".join(chr(u) for u in glyph.unicode).encode("utf-16-be").hex().upper()
+                bf_chars.append(f"<{code:04X}> <{unicode}>\n")
+        to_unicode_obj = PDFContentStream(
+            "/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+            "/CIDSystemInfo\n<</Registry (Adobe)\n/Ordering (UCS)\n/Supplement 0\n>> def\n"
+            "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n"
+            "1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+            f"{len(bf_chars)} beginbfchar\n{''.join(bf_chars)}endbfchar\n"
+            "endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend"
+        )
+        self._add_pdf_obj(to_unicode_obj, "fonts")
+        composite_font_obj.to_unicode = to_unicode_obj
+
+        cid_system_info_obj = CIDSystemInfo()
+        self._add_pdf_obj(cid_system_info_obj, "fonts")
+        cid_font_obj.c_i_d_system_info = cid_system_info_obj
+
+        font_descriptor_obj = font.desc
+        font_descriptor_obj.font_name = Name(fontname)
+        self._add_pdf_obj(font_descriptor_obj, "fonts")
+        cid_font_obj.font_descriptor = font_descriptor_obj
+
+        cid_to_gid_map = bytearray(256 * 256 * 2)
+        for glyph, code in font.subset.items():
+            gid = glyph_ids[glyph.glyph_name]
+            cid_to_gid_map[code * 2] = gid >> 8
+            cid_to_gid_map[code * 2 + 1] = gid & 0xFF
+        cid_to_gid_map_obj = PDFContentStream(contents=bytes(cid_to_gid_map), compress=True)
+        self._add_pdf_obj(cid_to_gid_map_obj, "fonts")
+        cid_font_obj.c_i_d_to_g_i_d_map = cid_to_gid_map_obj
+
+        font_file_obj = PDFDeflatedFontStream(program, program_length)
+        self._add_pdf_obj(font_file_obj, "fonts")
+        font_descriptor_obj.font_file2 = font_file_obj
+
+        font.subset.pick.cache_clear()
+        font.subset.get_glyph.cache_clear()
+        return composite_font_obj
+
+    def _add_images(self):
+        self.img_objs_per_index = super()._add_images()
+        return self.img_objs_per_index
+
+    def image_ids(self):
+        """Object id of each image written, by image cache name"""
+        return {name: self.img_objs_per_index[info["i"]].id
+                for name, info in self.fpdf.image_cache.images.items() if info["i"] in self.img_objs_per_index}
+
+    def _add_gfxstates(self):
+        self.gfxstate_objs_per_name = super()._add_gfxstates()
+        return self.gfxstate_objs_per_name
+
+    def _insert_resources(self, page_objs):
+        self.page_objs = page_objs
+        super()._insert_resources(page_objs)
+        self._insert_form_resources(page_objs)
+        if self.compaction.dedupe:
+            for page_obj in page_objs:
+                page_obj.resources = self._shared_resources(page_obj.resources)
+
+    def _insert_form_resources(self, page_objs):
+        fpdf = self.fpdf
+        forms = getattr(fpdf, "form_xobjects", None)
+        if not forms:
+            return
+
+        form_refs = {}
+        forms_by_content = {}
+        for form in forms.values():
+            if self.compaction.dedupe:
+                key = (form["contents"], frozenset(form["fonts"]), frozenset(form["images"]), frozenset(form["gstates"]))
+                if key in forms_by_content:
+                    form_refs[form["name"]] = forms_by_content[key]
+                    continue
+            resources = self._add_resources_dict(
+                {i: self.font_objs_per_index[i] for i in form["fonts"]},
+                {i: self.img_objs_per_index[i] for i in form["images"] if i in self.img_objs_per_index},
+                {name: gs for name, gs in self.gfxstate_objs_per_name.items() if name in form["gstates"]},
+            )
+            if self.compaction.dedupe:
+                resources = self._shared_resources(resources)
+            form_obj = PDFFormXObject(form["contents"], fpdf.w_pt, fpdf.h_pt, resources, fpdf.compress)
+            self._add_pdf_obj(form_obj, "form_xobjects")
+            form_refs[form["name"]] = pdf_ref(form_obj.id)
+            if self.compaction.dedupe:
+                forms_by_content[key] = form_refs[form["name"]]
+
+        for page_number, page_obj in enumerate(page_objs, start=1):
+            if fpdf.single_resources_object:
+                used = {name: ref for name, ref in form_refs.items()}
+                images = self.img_objs_per_index
+            else:
+                used = {name: form_refs[name] for name in fpdf.form_xobjects_used_per_page_number[page_number]}
+                images = {i: self.img_objs_per_index[i] for i in fpdf.images_used_per_page_number[page_number]}
+            if not used:
+                continue
+            x_objects = {f"/I{index}": pdf_ref(img_obj.id) for index, img_obj in sorted(images.items())}
+            x_objects.update({f"/{name}": ref for name, ref in used.items()})
+            page_obj.resources.x_object = pdf_dict(x_objects)
+            if fpdf.single_resources_object:
+                break
+
+    def bufferize(self):
+        fpdf = self.fpdf
+        pack = (self.compaction.object_streams and self.can_pack_objects
+                and not fpdf._security_handler and not fpdf._sign_key)
+        if pack:
+            fpdf.pdf_version = max(fpdf.pdf_version, "1.5")
+        buffer = super().bufferize()
+        self.size = self.obj_id + 1
+        if pack:
+            with fpdf.stage("compact"):
+                buffer = self.pack_objects(buffer)
+        if getattr(fpdf, "append_y", None) is not None:
+            trailer = self.pdf_objs[-1]
+            page_obj = self.page_objs[-1]
+            state = self.append_state(page_obj, [page_obj.contents.id], [page.id for page in self.page_objs],
+                                      trailer.catalog_obj.id, trailer.info_obj.id, pack)
+            at = buffer.rindex(b"startxref")
+            buffer[at:at] = APPEND_STATE_MARKER + json.dumps(state, separators=(",", ":")).encode() + b"\n"
+        return buffer
+
+    def append_state(self, page_obj, contents, kids, root, info, packed):
+        """What PreviousPatientReport.append_to needs to continue this document, see read_append_state"""
+        resources = page_obj.resources
+        return {
+            "version": APPEND_STATE_VERSION,
+            "size": self.size,
+            "root": root,
+            "info": info,
+            "packed": packed,
+            "pages": page_obj.parent.id,
+            "media_box": page_obj.parent.media_box,
+            "kids": kids,
+            "page": {
+                "id": page_obj.id,
+                "contents": contents,
+                "resources": {key: getattr(resources, key) for key in ("proc_set", "font", "x_object", "ext_g_state")},
+            },
+            "images": self.image_ids(),
+            "page_number": self.fpdf.section_page_no(),
+            "y": self.fpdf.append_y,
+        }
+
+    def pack_objects(self, buffer):
+        """
+        Rewrite a serialized document with every object except streams moved into
+        compressed object streams, and the xref table replaced by an xref stream.
+        """
+        level = self.compaction.deflate_level
+        trailer = self.pdf_objs[-1]
+        view = memoryview(buffer)
+        # The classic xref table follows the last object; "startxref" is not preceded by a newline
+        end = buffer.rindex(b"\nxref\n") + 1
+        ids = sorted(self.offsets)
+        out = bytearray(view[:self.offsets[ids[0]]])  # file header
+        entries = {0: (0, 0, 65535)}
+        packed = []
+        for n, obj_id in enumerate(ids):
+            chunk = view[self.offsets[obj_id]:self.offsets[ids[n + 1]] if n + 1 < len(ids) else end]
+            prefix = f"{obj_id} 0 obj\n".encode()
+            # Streams, and anything not shaped like "<id> 0 obj ... endobj", stay top-level objects
+            if (chunk[:len(prefix)] != prefix or chunk[-len(STREAM_END):] == STREAM_END
+                    or chunk[-len(OBJECT_END):] != OBJECT_END):
+                entries[obj_id] = (1, len(out), 0)
+                out += chunk
+            else:
+                packed.append((obj_id, chunk[len(prefix):-len(OBJECT_END)]))
+
+        next_id = ids[-1] + 1
+        for start in range(0, len(packed), OBJECT_STREAM_SIZE):
+            group = packed[start:start + OBJECT_STREAM_SIZE]
+            offsets, bodies, offset = [], [], 0
+            for index, (obj_id, body) in enumerate(group):
+                entries[obj_id] = (2, next_id, index)
+                offsets.append(f"{obj_id} {offset}")
+                bodies.append(body)
+                offset += len(body) + 1
+            header = " ".join(offsets).encode() + b"\n"
+            data = zlib.compress(header + b"\n".join(bodies), level)
+            entries[next_id] = (1, len(out), 0)
+            out += (f"{next_id} 0 obj\n<<\n/Type /ObjStm\n/N {len(group)}\n/First {len(header)}\n"
+                    f"/Filter /FlateDecode\n/Length {len(data)}\n>>\nstream\n").encode()
+            out += data + b"\nendstream\nendobj\n"
+            next_id += 1
+
+        xref_id = next_id
+        xref_offset = len(out)
+        entries[xref_id] = (1, xref_offset, 0)
+        fpdf = self.fpdf
+        file_id = fpdf.file_id()
+        if file_id == -1:
+            file_id = fpdf._default_file_id(out)
+        fields = [f"/Root {pdf_ref(trailer.catalog_obj.id)}", f"/Info {pdf_ref(trailer.info_obj.id)}"]
+        if file_id:
+            fields.append(f"/ID [{file_id}]")
+        out += xref_stream(xref_id, entries, fields, level)
+        out += f"startxref\n{xref_offset}\n%%EOF\n".encode()
+        self.size = xref_id + 1
+        return out
+
+
+class OffsetBuffer(bytearray):
+    """Output buffer whose length includes bytes already streamed to the client."""
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def __len__(self):
+        return self.base + super().__len__()
+
+    def __bool__(self):
+        return super().__len__() > 0
+
+
+class StreamedOutputProducer(FormXObjectOutputProducer):
+    """
+    Writes the tail of a document whose page content streams were already
+    flushed by PatientReport.stream_pages: pages, resources, fonts, images
+    and an xref table covering both the streamed and the new objects.
+    """
+
+    # The streamed pages already went out under a PDF-1.4 header
+    can_pack_objects = False
+
+    def __init__(self, fpdf):
+        super().__init__(fpdf)
+        self.obj_id = len(fpdf.streamed_offsets)
+        self.buffer = OffsetBuffer(fpdf.streamed_bytes)
+        self._pending_offsets = fpdf.streamed_offsets
+        self._header_skipped = not fpdf.streamed_bytes
+
+    def _out(self, data):
+        if not self._header_skipped:
+            # The PDF header went out with the first streamed page
+            self._header_skipped = True
+            self.offsets.update(self._pending_offsets)
+            return
+        super()._out(data)
+
+    def _add_pages(self, _slice=slice(0, None)):
+        fpdf = self.fpdf
+        page_objs = []
+        for page_number, page_obj in list(fpdf.pages.items())[_slice]:
+            if fpdf.pdf_version > "1.3":
+                page_obj.group = pdf_dict(
+                    {"/Type": "/Group", "/S": "/Transparency", "/CS": "/DeviceRGB"},
+                    field_join=" ",
+                )
+            self._add_pdf_obj(page_obj, "pages")
+            page_objs.append(page_obj)
+
+            streamed_id = fpdf.streamed_pages.get(page_number)
+            if streamed_id:
+                cs_obj = PDFContentStream(contents=b"")
+                cs_obj.id = streamed_id
+            else:
+                cs_obj = PDFContentStream(contents=page_obj.contents, compress=fpdf.compress)
+                self._add_pdf_obj(cs_obj, "pages")
+            page_obj.contents = cs_obj
+        return page_objs
+
+
+class MergedOutputProducer(FormXObjectOutputProducer):
+    """
+    Writes a document assembled by PreviousPatientReport.merge_chunks, whose
+    pages come with their content streams already deflated by the chunk renders.
+    """
+
+    def _add_pages(self, _slice=slice(0, None)):
+        fpdf = self.fpdf
+        page_objs = []
+        for page_number, page_obj in list(fpdf.pages.items())[_slice]:
+            if fpdf.pdf_version > "1.3":
+                page_obj.group = pdf_dict(
+                    {"/Type": "/Group", "/S": "/Transparency", "/CS": "/DeviceRGB"},
+                    field_join=" ",
+                )
+            self._add_pdf_obj(page_obj, "pages")
+            page_objs.append(page_obj)
+            cs_obj = fpdf.merged_contents[page_number]
+            OutputProducer._add_pdf_obj(self, cs_obj, "pages")  # deflated at the compaction level already
+            page_obj.contents = cs_obj
+        return page_objs
+
+
+class ChunkOutputProducer(OutputProducer):
+    """
+    Collects a chunk of a longer report for PreviousPatientReport.merge_chunks
+    instead of writing a PDF: each page's deflated content stream with the
+    fonts, images and forms it uses, and the document's font, image and form
+    registries. The result is left in fpdf.chunk.
+    """
+
+    def bufferize(self):
+        fpdf = self.fpdf
+        pages = [{
+            "contents": fpdf.page_content_stream(page),
+            "fonts": fpdf.fonts_used_per_page_number[number],
+            "images": fpdf.images_used_per_page_number[number],
+            "forms": fpdf.form_xobjects_used_per_page_number[number],
+            "gstates": fpdf.graphics_style_names_per_page_number[number],
+        } for number, page in fpdf.pages.items()]
+        fpdf.chunk = {
+            "pages": pages,
+            "fonts": [font.fontkey for font in sorted(fpdf.fonts.values(), key=lambda font: font.i)],
+            "images": fpdf.image_cache.images,
+            "icc_profiles": fpdf.image_cache.icc_profiles,
+            "forms": fpdf.form_xobjects,
+            "y": fpdf.append_y,
+        }
+        return bytearray()
+
+
+class AppendOutputProducer(FormXObjectOutputProducer):
+    """
+    Writes this document as an incremental update to an existing previous
+    consultations PDF (see read_append_state), leaving its bytes untouched:
+    the first page is painted onto the existing last page as a form XObject,
+    later pages join the existing page tree, and a new xref section points back
+    to the previous one. Only the last page and the page tree root get new versions.
+    """
+
+    can_pack_objects = False
+
+    def __init__(self, fpdf):
+        super().__init__(fpdf)
+        self.state = fpdf.append_state
+        self.obj_id = self.state["size"] - 1
+        self.buffer = OffsetBuffer(self.state["length"])  # offsets continue after the existing file
+
+    def _add_images(self):
+        # Images the existing document already has (the logo) are referenced, not written again
+        existing = self.state["images"]
+        self.img_objs_per_index = {}
+        for name, info in sorted(self.fpdf.image_cache.images.items(), key=lambda item: item[1]["i"]):
+            if info["usages"] > 0:
+                if name in existing:
+                    img_obj = PDFObject()
+                    img_obj.id = existing[name]
+                else:
+                    img_obj = self._add_image(info)
+                self.img_objs_per_index[info["i"]] = img_obj
+        return self.img_objs_per_index
+
+    def image_ids(self):
+        return dict(self.state["images"], **super().image_ids())
+
+    def bufferize(self):
+        fpdf = self.fpdf
+        state = self.state
+        page_objs = self._add_pages()
+        self._insert_resources(page_objs)
+
+        # The continuation page's content becomes a form painted after the existing content
+        first, old_page = page_objs[0], state["page"]
+        form = first.contents
+        form.type = Name("XObject")
+        form.subtype = Name("Form")
+        form.b_box = f"[0 0 {fpdf.w_pt:.2f} {fpdf.h_pt:.2f}]"
+        form.resources = first.resources
+        name = f"/AP{form.id}"
+        resources = dict(old_page["resources"])
+        x_object = resources["x_object"]
+        entry = f"{name} {pdf_ref(form.id)}"
+        resources["x_object"] = f"{x_object[:-2]}\n{entry}>>" if x_object else f"<<{entry}>>"
+        first.resources = PDFResources(**resources)
+        # The existing content may leave the graphics state changed; the form must start from the default
+        save = PDFContentStream(contents=b"q")
+        restore = PDFContentStream(contents=f"Q {name} Do".encode())
+        for pdf_obj in (first.resources, save, restore):
+            OutputProducer._add_pdf_obj(self, pdf_obj)
+        contents = [save.id, *old_page["contents"], restore.id]
+        first.contents = PDFArray([pdf_ref(obj_id) for obj_id in contents])
+        first.id = old_page["id"]
+
+        kids = state["kids"] + [page_obj.id for page_obj in page_objs[1:]]
+        pages_root = PDFPagesRoot(count=len(kids), media_box=state["media_box"])
+        pages_root.kids = PDFArray([pdf_ref(obj_id) for obj_id in kids])
+        pages_root.id = state["pages"]
+        self.pdf_objs.append(pages_root)
+        for page_obj in page_objs:
+            page_obj.parent = pages_root
+            if not page_obj.annots:
+                page_obj.annots = None
+
+        for pdf_obj in self.pdf_objs:
+            self.offsets[pdf_obj.id] = len(self.buffer)
+            self._out(pdf_obj.serialize())
+
+        self.size = max(self.obj_id, state["size"] - 1) + 1
+        xref_offset = len(self.buffer)
+        trailer = [f"/Root {pdf_ref(state['root'])}", f"/Info {pdf_ref(state['info'])}"]
+        if state["file_id"]:
+            trailer.append(f"/ID [{state['file_id']}]")
+        trailer.append(f"/Prev {state['prev']}")
+        if state["packed"]:
+            # A document using xref streams is updated with one too
+            xref_id = self.size
+            self.size += 1
+            entries = {obj_id: (1, offset, 0) for obj_id, offset in self.offsets.items()}
+            entries[xref_id] = (1, xref_offset, 0)
+            self.buffer += xref_stream(xref_id, entries, trailer, self.compaction.deflate_level)
+        else:
+            xref = ["xref", "0 1", "0000000000 65535 f "]
+            for start, count in id_ranges(sorted(self.offsets)):
+                xref.append(f"{start} {count}")
+                xref += [f"{self.offsets[obj_id]:010} 00000 n " for obj_id in range(start, start + count)]
+            xref += ["trailer", "<<", f"/Size {self.size}", *trailer, ">>"]
+            self._out("\n".join(xref))
+
+        last = page_objs[-1]
+        if last is not first:
+            contents = [last.contents.id]
+        state = self.append_state(last, contents, kids, state["root"], state["info"], state["packed"])
+        self.buffer += APPEND_STATE_MARKER + json.dumps(state, separators=(",", ":")).encode() + b"\n"
+        self._out(f"startxref\n{xref_offset}\n%%EOF")
+        return self.buffer
+
+
+def timed_stage(name):
+    """Method decorator: count the call's time towards a render stage, see PatientReport.stage()"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class PatientReport(FPDF):
     def __init__(self, json_data):
         """
         Initialize report with JSON data containing all information
-        json_data: JSON string or dict containing all report data
+        json_data: ReportRequest, or a JSON string/bytes or dict to validate into one
         """
         super().__init__()
         self.set_auto_page_break(auto=True, margin=30)
         
-        # Parse JSON if string is provided
-        if isinstance(json_data, str):
-            self.data = json.loads(json_data)
-        else:
-            self.data = json_data
+        self.request = parse_report_request(json_data)
             
         # Store all sections of data
-        self.patient_data = self.data.get('patient_data', {})
-        self.hospital_data = self.data.get('hospital_data', {})
-        self.doctor_data = self.data.get('doctor_data', {})
-        self.advice_data = self.data.get('advice_data', [])
-        self.previous_reports = self.data.get('previous_reports', [])
+        self.patient_data = self.request.patient_data
+        self.hospital_data = self.request.hospital_data
+        self.doctor_data = self.request.doctor_data
+        self.advice_data = self.request.advice_data
+        self.previous_reports = self.request.previous_reports
         
         # Store logo data
-        self.logo_data = self.data.get('logo_data', "logo.jpg")
-        self.watermark_logo = self.data.get('watermark_logo', "logo.jpg")
+        self.logo_data = self.request.logo_data
+        self.watermark_logo = self.request.watermark_logo
+        self.watermark_mode = self.request.watermark_mode or WATERMARK_MODE
+
+        compaction = self.request.compaction or PDF_COMPACTION
+        self.compaction = COMPACTION_PRESETS[compaction] if isinstance(compaction, str) else compaction
+
+        # Report text font, see REPORT_FONT; the fallback fonts draw what it lacks
+        self.report_font_family = "helvetica"
+        if REPORT_FONT:
+            self.report_font_family = "report"
+            for style, path in (("", REPORT_FONT), ("B", REPORT_FONT_BOLD), ("I", REPORT_FONT_ITALIC)):
+                font_cache.add_to(self, self.report_font_family, style, path or REPORT_FONT)
+            fallbacks = [f"fallback{n}" for n in range(len(REPORT_FALLBACK_FONTS))]
+            for family, path in zip(fallbacks, REPORT_FALLBACK_FONTS):
+                font_cache.add_to(self, family, "", path)
+            if fallbacks:
+                self.set_fallback_fonts(fallbacks, exact_match=False)
+            if REPORT_TEXT_SHAPING:
+                self.set_text_shaping(True)
         
         # Define colors for the report (teal/green theme)
         self.primary_color = (0, 128, 128)  # Teal
@@ -55,9 +1393,188 @@ class PatientReport(FPDF):
         self.accent_color = (0, 77, 64)  # Dark teal
         self.light_accent = (224, 242, 241)  # Very light teal
         self.light_grey = (192, 192, 192)  # Light Grey
-        self.generated_watermark = self.create_watermark_image()
 
-        
+        # Without a fixed creation date every render would differ; callers may supply one
+        creation_date = self.request.creation_date
+        if creation_date and creation_date.tzinfo is None:
+            creation_date = creation_date.replace(tzinfo=timezone.utc)
+        self.creation_date = creation_date
+
+        # Page numbers restart per section when several sections share one document
+        self.section_page_offset = 0
+
+        # Static page furniture drawn once per document, see draw_form()
+        self.form_xobjects = {}
+        self.form_xobjects_used_per_page_number = defaultdict(set)
+
+        # Seconds spent per render stage, reported with the PDF (Server-Timing, /metrics)
+        self.stage_seconds = defaultdict(float)
+        self._stage_stack = []
+
+    use_form_xobjects = True
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a render stage. Stages are exclusive: while a nested stage runs (say a
+        page break, i.e. "header", in the middle of "table") the outer one is paused,
+        so the stage times add up to the render time.
+        """
+        now = time.perf_counter()
+        if self._stage_stack:
+            outer = self._stage_stack[-1]
+            self.stage_seconds[outer[0]] += now - outer[1]
+        current = [name, now]
+        self._stage_stack.append(current)
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._stage_stack.pop()
+            self.stage_seconds[name] += now - current[1]
+            if self._stage_stack:
+                self._stage_stack[-1][1] = now
+
+    def render_stats(self):
+        """Stage timings and page count of the finished render"""
+        return {"stages": dict(self.stage_seconds), "pages": self.page}
+
+    def draw_form(self, key, draw):
+        """
+        Draw static page content (letterhead, footer bar) as a form XObject.
+        The first call records what draw() paints; later pages only reference
+        it with a single Do operator instead of repeating the drawing.
+        """
+        if not self.use_form_xobjects:
+            draw()
+            return
+
+        form = self.form_xobjects.get(key)
+        if form is None:
+            form = self._record_form(key, draw)
+        self._out(f"/{form['name']} Do")
+        self.form_xobjects_used_per_page_number[self.page].add(form['name'])
+        self.set_xy(*form['end_xy'])
+
+    def _record_form(self, key, draw):
+        page = self.pages[self.page]
+        start = len(page.contents)
+        usage_sets = (self.fonts_used_per_page_number, self.images_used_per_page_number,
+                      self.graphics_style_names_per_page_number)
+        page_usage = [usage.pop(self.page, set()) for usage in usage_sets]
+
+        # The form can be painted on any page, so it must not rely on the
+        # graphics state of the page it was recorded on
+        self._push_local_stack()
+        self._out(self.draw_color.serialize().upper())
+        self._out(self.fill_color.serialize().lower())
+        self._out(f"{self.line_width * self.k:.2f} w")
+        if self.current_font:
+            self._out(f"BT /F{self.current_font.i} {self.font_size_pt:.2f} Tf ET")
+            self.fonts_used_per_page_number[self.page].add(self.current_font.i)
+        draw()
+        end_xy = (self.x, self.y)
+        self._pop_local_stack()
+
+        form_usage = [usage.pop(self.page, set()) for usage in usage_sets]
+        for usage, before in zip(usage_sets, page_usage):
+            usage[self.page] = before
+        form = {
+            "name": f"FX{len(self.form_xobjects) + 1}",
+            "contents": bytes(page.contents[start:]),
+            "fonts": form_usage[0],
+            "images": form_usage[1],
+            "gstates": form_usage[2],
+            "end_xy": end_xy,
+        }
+        del page.contents[start:]
+        self.form_xobjects[key] = form
+        return form
+
+    @timed_stage("output")
+    def output(self, *args, **kwargs):
+        producer = StreamedOutputProducer if self.page_sink else FormXObjectOutputProducer
+        kwargs.setdefault("output_producer_class", producer)
+        return super().output(*args, **kwargs)
+
+    page_sink = None
+
+    def stream_pages(self, write):
+        """
+        Send each completed page to write(bytes) as soon as the next one starts,
+        instead of keeping every page in memory until output(). output() then
+        only returns the remainder of the document.
+        """
+        self.page_sink = write
+        self.streamed_bytes = 0
+        self.streamed_offsets = {}  # object id -> file offset
+        self.streamed_pages = {}  # page number -> content stream object id
+
+    def add_page(self, *args, **kwargs):
+        finished_page = self.page
+        super().add_page(*args, **kwargs)
+        if self.page_sink and finished_page:
+            self._flush_page(finished_page)
+
+    @timed_stage("output")
+    def _flush_page(self, page_number):
+        page = self.pages[page_number]
+        if not self.streamed_bytes:
+            header = f"%PDF-{max(self.pdf_version, '1.4')}\n".encode("latin-1")
+            self.page_sink(header)
+            self.streamed_bytes = len(header)
+        content_obj = self.page_content_stream(page)
+        content_obj.id = len(self.streamed_offsets) + 1
+        data = content_obj.serialize().encode("latin-1") + b"\n"
+        self.streamed_offsets[content_obj.id] = self.streamed_bytes
+        self.streamed_pages[page_number] = content_obj.id
+        self.page_sink(data)
+        self.streamed_bytes += len(data)
+        page.contents = bytearray()
+
+    def page_content_stream(self, page):
+        """A page's content stream object, deflated at the document's compaction level"""
+        content_obj = PDFContentStream(contents=bytes(page.contents), compress=self.compress)
+        if self.compress and self.compaction.deflate_level != DEFAULT_DEFLATE_LEVEL:
+            with self.stage("compact"):
+                redeflate_stream(content_obj, self.compaction.deflate_level)
+        return content_obj
+
+    def section_page_no(self):
+        """Page number within the current section"""
+        return self.page_no() - self.section_page_offset
+
+    def cached_image(self, source, variant="logo"):
+        """
+        Register an image from the shared asset cache with this document
+        and return the name to pass to self.image()
+        """
+        name, info = asset_cache.get(source, variant)
+        if name not in self.image_cache.images:
+            info = type(info)(info)  # per-document copy, fpdf annotates it on output
+            info["i"] = len(self.image_cache.images) + 1
+            info["usages"] = 0
+            info["iccp_i"] = None
+            iccp = info.get("iccp")
+            if iccp:
+                icc_profiles = self.image_cache.icc_profiles
+                if iccp not in icc_profiles:
+                    icc_profiles[iccp] = len(icc_profiles)
+                info["iccp_i"] = icc_profiles[iccp]
+                info["iccp"] = None
+            self.image_cache.images[name] = info
+        return name
+
+    def load_watermark(self):
+        """Returns the cached watermark image name for watermark_logo, or None."""
+        if not self.watermark_logo:
+            return None
+
+        try:
+            return self.cached_image(self.watermark_logo, "watermark")
+        except Exception as e:
+            print(f"Error creating watermark: {e}")
+            return None
 
     def create_watermark_image(self):
         """Generates a watermark image from the watermark_logo."""
@@ -65,14 +1582,7 @@ class PatientReport(FPDF):
             return None
 
         try:
-            img = Image.open(self.watermark_logo).convert("L").convert("RGBA")
-            watermark = Image.new("RGBA", img.size, (255, 255, 255, 0))
-            watermark.paste(img, (0, 0), img)
-            pixels = watermark.load()
-            for y in range(watermark.size[1]):
-                for x in range(watermark.size[0]):
-                    r, g, b, a = pixels[x, y]
-                    pixels[x, y] = (r, g, b, 60)  # Adjust opacity here
+            watermark = bake_watermark(Image.open(BytesIO(read_image_source(self.watermark_logo))))
             
             # Save to BytesIO object
             watermark_bytes = BytesIO()
@@ -84,65 +1594,123 @@ class PatientReport(FPDF):
             print(f"Error creating watermark: {e}")
             return None
 
-    def create_table(self, table_data, title='', data_size=10, title_size=12, 
-                     align_data='C', align_header='L', cell_width='even', 
-                     x_start='x_default', emphasize_data=[], emphasize_style=None, 
-                     emphasize_color=(0, 0, 0)):
-        default_style = self.font_style
-        if emphasize_style is None:
-            emphasize_style = default_style
+    def wrap_lines(self, text, w):
+        """Lines multi_cell(w, ...) will print text on in the current font, without drawing"""
+        text = self.normalize_text(str(text)).replace("\r", "")
+        if SOFT_HYPHEN in text or self.needs_fpdf_layout(text):
+            # Hyphenation hints are rare here; let fpdf do the break instead of mirroring it
+            return self.multi_cell(w, text=text, dry_run=True, output="LINES")
+        return text_measure_cache.lines(text, self.current_font, self.font_size_pt, self.k,
+                                        w - self.c_margin - self.c_margin)
 
-        
+    def needs_fpdf_layout(self, text):
+        """Shaped text, and text partly drawn in a fallback font, is not measured by the current font's glyph widths"""
+        if self.text_shaping:
+            return True
+        if not self._fallback_font_ids:
+            return False
+        cmap = self.current_font.cmap
+        return any(ord(char) not in cmap and char not in "\n\f" for char in text)
 
-        def get_col_widths():
-            col_width = cell_width
-            num_cols = 0  # Initialize num_cols
-            if isinstance(table_data, list) and table_data:  # Check if list is not empty
-                num_cols = len(table_data[0])
-            elif isinstance(table_data, dict) and table_data:  # Check if dictionary is not empty
-                num_cols = len(list(table_data.values())[0])
-
-            if num_cols == 0:  # Handle empty table_data
-                return 0  # Or return an appropriate default
-
-            if col_width == 'even':
-                col_width = self.epw / num_cols - 1 if num_cols > 0 else 0
-            elif col_width == 'uneven':
-                col_widths = []
-                for col in range(num_cols):
-                    longest = 0
-                    if isinstance(table_data, list):
-                        for row in table_data:
-                            if col < len(row):  # Ensure col index is valid
-                                cell_value = str(row[col])
-                                value_length = self.get_string_width(cell_value)
-                                char_limit = 30
-                                num_lines = (len(cell_value) // char_limit) + 1
-                                wrapped_length = value_length / num_lines
-                                if wrapped_length > longest:
-                                    longest = wrapped_length
-                    else:  # Dictionary case
-                        dict_values = list(table_data.values())
-                        if dict_values and col < len(dict_values):
-                            col_data = dict_values[col]
-                            for row_index in range(len(col_data)):
-                                cell_value = str(col_data[row_index])
-                                value_length = self.get_string_width(cell_value)
-                                char_limit = 30
-                                num_lines = (len(cell_value) // char_limit) + 1
-                                wrapped_length = value_length / num_lines
-                                if wrapped_length > longest:
-                                    longest = wrapped_length
-                    col_widths.append(longest + 4)
-                col_width = col_widths
-            elif isinstance(col_width, list):
-                col_width = col_width
-            else:
-                try:
-                    col_width = int(col_width)
-                except ValueError:
-                    col_width = self.epw / num_cols - 1 if num_cols > 0 else 0
-            return col_width
+    def plan_table(self, header, rows, cell_width, min_height, header_line_height, data_line_height):
+        """
+        Lay out a table in the current font before drawing it: each cell is wrapped once.
+        Returns (col_widths, header_plan, row_plans), a plan being (row_height, lines per cell).
+        """
+        num_cols = len(header)
+        even_width = self.epw / num_cols - 1 if num_cols else 0
+        if cell_width == 'even':
+            col_widths = [even_width] * num_cols
+        elif cell_width == 'uneven':
+            col_widths = self.uneven_col_widths([header] + rows, num_cols)
+        elif isinstance(cell_width, list):
+            col_widths = cell_width
+        else:
+            try:
+                col_widths = [int(cell_width)] * num_cols
+            except ValueError:
+                col_widths = [even_width] * num_cols
+
+        # Advice tables repeat the same dosages and instructions, so wrap each (text, width) once
+        wrapped = {}
+
+        def plan_row(row, line_height):
+            cells = []
+            for w, datum in zip(col_widths, row):
+                key = (str(datum), w)
+                lines = wrapped.get(key)
+                if lines is None:
+                    lines = wrapped[key] = self.wrap_lines(key[0], w)
+                cells.append(lines)
+            most_lines = max((len(lines) for lines in cells), default=1)
+            return max(min_height, most_lines * line_height), cells
+
+        return (col_widths, plan_row(header, header_line_height),
+                [plan_row(row, data_line_height) for row in rows])
+
+    def table_cell(self, w, h, lines, line_height, align):
+        """Draw one planned, filled and bordered table cell, then move right like multi_cell(new_x=RIGHT, new_y=TOP)"""
+        if len(lines) == 1:
+            self.cell(w, h, lines[0], border=1, align=align, fill=True)
+            return
+        x, y = self.x, self.y
+        self.cell(w, h, "", border=1, fill=True)
+        for i, line in enumerate(lines):
+            self.set_xy(x, y + i * line_height)
+            self.cell(w, line_height, line, align=align)
+        self.set_xy(x + w, y)
+
+    def uneven_col_widths(self, rows, num_cols):
+        """Widths sized to each column's widest cell, shrunk to fit the page when the total is too wide"""
+        widths = glyph_widths(self.current_font, self.font_size_pt, self.k)
+        slack = 4  # cell margins plus breathing room
+        natural = [0] * num_cols
+        longest_word = [0] * num_cols
+        measured = {}
+        for row in rows:
+            for col, datum in enumerate(row[:num_cols]):
+                text = self.normalize_text(str(datum))
+                size = measured.get(text)
+                if size is None:
+                    size = measured[text] = (
+                        max(widths.text_width(line) for line in text.split("\n")),
+                        max((widths.text_width(word) for word in text.split()), default=0),
+                    )
+                natural[col] = max(natural[col], size[0])
+                longest_word[col] = max(longest_word[col], size[1])
+
+        natural = [w + slack for w in natural]
+        if sum(natural) <= self.epw:
+            return natural
+
+        # Scale columns down proportionally, never squeezing one below its longest word
+        # (capped so the minimums alone always fit); columns pinned at their minimum
+        # hand the remaining room to the others
+        minimum = [min(w + slack, self.epw / num_cols) for w in longest_word]
+        col_widths = list(natural)
+        pinned = set()
+        while True:
+            flexible = [col for col in range(num_cols) if col not in pinned]
+            room = self.epw - sum(minimum[col] for col in pinned)
+            flexible_total = sum(natural[col] for col in flexible)
+            newly_pinned = False
+            for col in flexible:
+                col_widths[col] = natural[col] * room / flexible_total
+                if col_widths[col] < minimum[col]:
+                    col_widths[col] = minimum[col]
+                    pinned.add(col)
+                    newly_pinned = True
+            if not newly_pinned or len(pinned) == num_cols:
+                return col_widths
+
+    @timed_stage("table")
+    def create_table(self, table_data, title='', data_size=10, title_size=12, 
+                     align_data='C', align_header='L', cell_width='even', 
+                     x_start='x_default', emphasize_data=[], emphasize_style=None, 
+                     emphasize_color=(0, 0, 0)):
+        default_style = self.font_style
+        if emphasize_style is None:
+            emphasize_style = default_style
 
         if isinstance(table_data, dict):
             header = [key for key in table_data]
@@ -157,27 +1725,24 @@ class PatientReport(FPDF):
 
         line_height = self.font_size * 3
 
-        col_width = get_col_widths()
-        self.set_font(size=title_size)
-            
+        # Plan every column width, row height and line break up front, in the font the cells are drawn in
+        self.set_font(size=data_size)
+        header_line_height, data_line_height = self.font_size, 2 * self.font_size
+        col_widths, (header_height, header_cells), rows = self.plan_table(
+            header, data, cell_width, line_height, header_line_height, data_line_height)
+        table_width = sum(col_widths)
+
         if x_start == 'C':
-            table_width = 0
-            if isinstance(col_width, list):
-                for width in col_width:
-                    table_width += width
-            else:
-                table_width = col_width * len(table_data[0])
-            margin_width = self.w - table_width
-            center_table = margin_width / 2
-            x_start = center_table
-            self.set_x(x_start)
+            x_left = (self.w - table_width) / 2
         elif isinstance(x_start, int):
-            self.set_x(x_start)
-        elif x_start == 'x_default':
-            x_start = self.set_x(self.l_margin)
+            x_left = x_start
+        else:
+            x_left = self.l_margin
 
         # TABLE CREATION #
         # Add title with primary color
+        self.set_font(size=title_size)
+        self.set_x(x_left)
         if title != '':
             self.set_text_color(*self.primary_color)
             self.multi_cell(0, line_height, title, border=0, align='j', ln=3, max_line_height=self.font_size)
@@ -185,57 +1750,28 @@ class PatientReport(FPDF):
             self.set_text_color(0, 0, 0)  # Reset to black
 
         self.set_font(size=data_size)
-        # Add header with teal background
-        y1 = self.get_y()
-        x_left = x_start if x_start != 'x_default' else self.l_margin
-        if x_left is None:
-            x_left = self.l_margin if self.l_margin is not None else 10
-        x_right = self.epw + x_left if x_left is not None else self.epw + 10
 
         # Header with teal background
         self.set_fill_color(*self.primary_color)
-        self.set_text_color(0, 0, 0)  # White text
-        
-        if isinstance(col_width, list):
-            for i, datum in enumerate(header):  # Use header here
-                adjusted_col_width = col_width[i]
-                cell_value = str(datum)
-                char_limit = 30  # Adjust as needed
-                num_lines = (len(cell_value) // char_limit) + 1
-
-                # Calculate cell height based on number of lines
-                adjusted_line_height = line_height * num_lines
+        self.set_text_color(0, 0, 0)
+        self.set_x(x_left)
+        for w, lines in zip(col_widths, header_cells):
+            self.table_cell(w, header_height, lines, header_line_height, align_header)
+        self.ln(header_height)
 
-                self.multi_cell(adjusted_col_width, adjusted_line_height, datum, border=1, align=align_header,  # Border added
-                                max_line_height=self.font_size, new_x=XPos.RIGHT, new_y=YPos.TOP, fill=True)
-        else:
-            for datum in header:  # Use header here
-                cell_value = str(datum)
-                char_limit = 30  # Adjust as needed
-                num_lines = (len(cell_value) // char_limit) + 1
-
-                # Calculate cell height based on number of lines
-                adjusted_line_height = line_height * num_lines
-
-                self.multi_cell(col_width, adjusted_line_height, datum, border=1, align=align_header,  # Border added
-                                max_line_height=self.font_size, new_x=XPos.RIGHT, new_y=YPos.TOP, fill=True)
-        self.ln(adjusted_line_height)
-
-        # Alternating row colors
-        row_counter = 0
-        for row in data:
-            x_left = x_start if x_start != 'x_default' else self.l_margin
-            if x_left is None:
-                x_left = self.l_margin if self.l_margin is not None else 10
-            self.set_x(x_left)
-
-            # Check for page break and set Y position
-            if self.get_y() + line_height > self.h - self.b_margin:
-                self.add_page()
-                gap_height = 10  # Adjust this value for the desired gap size
-                new_y = 50 + gap_height  # Add the gap to the initial Y-position
-                self.set_y(new_y)
-                self.set_x(x_left)
+        # A row that does not fit starts a new page; one taller than a fresh page is
+        # drawn as several page-sized pieces. Nothing is left to fpdf's automatic page
+        # break, which would otherwise fire early inside multi-line cells.
+        lines_per_page = max(1, int((self.h - self.b_margin - 60) // data_line_height))
+        for row_counter, (row_height, cells) in enumerate(rows):
+            pieces = [(row_height, cells)]
+            most_lines = max((len(lines) for lines in cells), default=1)
+            if most_lines > lines_per_page:
+                pieces = []
+                for start in range(0, most_lines, lines_per_page):
+                    piece = [lines[start:start + lines_per_page] or [""] for lines in cells]
+                    piece_lines = max(len(lines) for lines in piece)
+                    pieces.append((max(line_height, piece_lines * data_line_height), piece))
 
             # Alternating background for rows
             if row_counter % 2 == 0:
@@ -243,40 +1779,21 @@ class PatientReport(FPDF):
             else:
                 self.set_fill_color(*self.light_accent)  # Very light teal
 
-            row_counter += 1
-
-            # Calculate max line height for the row
-            max_row_height = 0
-            if isinstance(col_width, list):
-                for datum in row:
-                    cell_value = str(datum)
-                    char_limit = 30  # Adjust as needed
-                    num_lines = (len(cell_value) // char_limit) + 1
-                    adjusted_line_height = line_height * num_lines
-                    max_row_height = max(max_row_height, adjusted_line_height)
-            else:
-                for datum in row:
-                    cell_value = str(datum)
-                    char_limit = 30  # Adjust as needed
-                    num_lines = (len(cell_value) // char_limit) + 1
-                    adjusted_line_height = line_height * num_lines
-                    max_row_height = max(max_row_height, adjusted_line_height)
-
-            if isinstance(col_width, list):
-                for i, datum in enumerate(row):
-                    adjusted_col_width = col_width[i]
-                    self.multi_cell(adjusted_col_width, max_row_height, datum, border=1, align=align_data,  # Border added
-                                    max_line_height=2 * self.font_size, new_x=XPos.RIGHT, new_y=YPos.TOP, fill=True)
-            else:
-                for datum in row:
-                    self.multi_cell(col_width, max_row_height, datum, border=1, align=align_data,  # Border added
-                                    max_line_height=2 * self.font_size, new_x=XPos.RIGHT, new_y=YPos.TOP, fill=True)
-            self.ln(max_row_height) # Use max row height for consistent spacing.
-            
+            for piece_height, piece in pieces:
+                if self.get_y() + piece_height > self.h - self.b_margin:
+                    self.add_page()
+                    gap_height = 10  # Adjust this value for the desired gap size
+                    self.set_y(50 + gap_height)
+                self.set_x(x_left)
+                for w, lines in zip(col_widths, piece):
+                    self.table_cell(w, piece_height, lines, data_line_height, align_data)
+                self.ln(piece_height)
+
         y3 = self.get_y()
         self.set_draw_color(*self.primary_color)  # Teal lines
-        self.line(x_left, y3, x_right, y3)
+        self.line(x_left, y3, x_left + table_width, y3)
 
+    @timed_stage("watermark")
     def add_watermark(self):
     # Save current position
         current_x, current_y = self.get_x(), self.get_y()
@@ -287,14 +1804,31 @@ class PatientReport(FPDF):
         x_start = x_position - (logo_size / 2)
         y_start = y_position - (logo_size / 2)-30
 
-        if self.generated_watermark:
-            self.image(self.generated_watermark, x_start, y_start, logo_size)
-        elif self.logo_data:
-            self.image(self.logo_data, x_start, y_start, logo_size)
+        if self.watermark_mode == "opacity":
+            source = self.watermark_logo or self.logo_data
+            try:
+                watermark = self.cached_image(source) if source else None
+            except Exception as e:
+                print(f"Error creating watermark: {e}")
+                watermark = None
+            if watermark:
+                # Let the PDF viewer apply the transparency, no pixel processing needed
+                with self.local_context(fill_opacity=WATERMARK_ALPHA / 255):
+                    self.image(watermark, x_start, y_start, logo_size)
+        else:
+            watermark = self.load_watermark()
+            if watermark:
+                self.image(watermark, x_start, y_start, logo_size)
+            elif self.logo_data:
+                self.image(self.cached_image(self.logo_data), x_start, y_start, logo_size)
 
         self.set_xy(current_x, current_y)
 
+    @timed_stage("header")
     def header(self):
+        self.draw_form("main_header", self.letterhead)
+
+    def letterhead(self):
         margin = 10
         available_width = self.w - 2 * margin
         hospital_width = available_width * 0.5
@@ -305,39 +1839,39 @@ class PatientReport(FPDF):
         
         # Doctor Details with teal color
         self.set_y(10)
-        self.set_font("helvetica", "B", 16)
+        self.set_font(self.report_font_family, "B", 16)
         self.set_text_color(*self.primary_color)
-        self.cell(0, 8, self.doctor_data.get('name', ''), 0, 1, "L")
+        self.cell(0, 8, self.doctor_data.name, 0, 1, "L")
         
-        self.set_font("helvetica", "", 10)
+        self.set_font(self.report_font_family, "", 10)
         self.set_text_color(*self.secondary_color)
-        self.cell(0, 5, self.doctor_data.get('degree', ''), 0, 1, "L")
-        self.cell(0, 5, self.doctor_data.get('speciality', ''), 0, 1, "L")
+        self.cell(0, 5, self.doctor_data.degree, 0, 1, "L")
+        self.cell(0, 5, self.doctor_data.speciality, 0, 1, "L")
         
-        self.set_font("helvetica", "", 8)
+        self.set_font(self.report_font_family, "", 8)
         self.set_text_color(100, 100, 100)  # Gray text
-        self.cell(0, 4, f"Mobile: {self.doctor_data.get('mobile', '')}", 0, 1, "L")
-        self.cell(0, 4, f"PMC No. {self.doctor_data.get('pmc', '')}", 0, 1, "L")
+        self.cell(0, 4, f"Mobile: {self.doctor_data.mobile}", 0, 1, "L")
+        self.cell(0, 4, f"PMC No. {self.doctor_data.pmc}", 0, 1, "L")
         
         # Hospital Details
         self.set_y(10)
         self.set_x(self.w / 2)
-        self.set_font("helvetica", "B", 16)
+        self.set_font(self.report_font_family, "B", 16)
         self.set_text_color(*self.primary_color)
-        self.cell(hospital_width, 8, self.hospital_data.get('name', ''), 0, 1, "R")
+        self.cell(hospital_width, 8, self.hospital_data.name, 0, 1, "R")
         
-        self.set_font("helvetica", "I", 9)
+        self.set_font(self.report_font_family, "I", 9)
         self.set_text_color(100, 100, 100)  # Gray slogan
         self.set_x(self.w / 2)
         # self.cell(hospital_width, 5, "SLOGAN HERE", 0, 1, "R")
         
-        self.set_font("helvetica", "", 8)
+        self.set_font(self.report_font_family, "", 8)
         self.set_x(self.w / 2)
-        self.cell(hospital_width, 4, self.hospital_data.get('address', ''), 0, 1, "R")
+        self.cell(hospital_width, 4, self.hospital_data.address, 0, 1, "R")
         self.set_x(self.w / 2)
-        self.cell(hospital_width, 4, f"Tel: {self.hospital_data.get('phone', '')}", 0, 1, "R")
+        self.cell(hospital_width, 4, f"Tel: {self.hospital_data.phone}", 0, 1, "R")
         self.set_x(self.w / 2)
-        self.cell(hospital_width, 4, f"Emergency: {self.hospital_data.get('emergency', '')}", 0, 1, "R")
+        self.cell(hospital_width, 4, f"Emergency: {self.hospital_data.emergency}", 0, 1, "R")
         
         # Divider line with primary color
         self.ln(5)
@@ -351,7 +1885,17 @@ class PatientReport(FPDF):
         self.set_text_color(0, 0, 0)
 
 
+    @timed_stage("footer")
     def footer(self):
+        self.draw_form("main_footer", self.footer_bar)
+
+        # Page number on right side
+        self.set_font(self.report_font_family, "", 8)
+        self.set_text_color(255, 255, 255)
+        self.set_xy(self.w - 40, self.h - 15)
+        self.cell(30, 5, "Page " + str(self.section_page_no()), 0, 0, "R")
+
+    def footer_bar(self):
         # Green footer bar
         self.set_fill_color(*self.primary_color)
         self.rect(0, self.h - 25, self.w, 25, 'F')
@@ -362,25 +1906,21 @@ class PatientReport(FPDF):
         
         # QR label
         self.set_xy(10, self.h - 20)
-        self.set_font("helvetica", "B", 14)
+        self.set_font(self.report_font_family, "B", 14)
         self.set_text_color(*self.primary_color)
         self.cell(40, 10, "QR", 0, 0, "C")
         
         # Footer text
         self.set_xy(60, self.h - 20)
-        self.set_font("helvetica", "", 8)
+        self.set_font(self.report_font_family, "", 8)
         self.set_text_color(255, 255, 255)
         
-        footer_data = self.hospital_data.get('footer', {})
-        self.cell(0, 5, f"Address: {footer_data.get('address', '')}", 0, 1, "L")
+        footer_data = self.hospital_data.footer
+        self.cell(0, 5, f"Address: {footer_data.address}", 0, 1, "L")
         
         self.set_xy(60, self.h - 15)
-        contact_line = f"Tel: {footer_data.get('phone', '')}   |   Email: {footer_data.get('email', '')}"
+        contact_line = f"Tel: {footer_data.phone}   |   Email: {footer_data.email}"
         self.cell(0, 5, contact_line, 0, 1, "L")
-        
-        # Page number on right side
-        self.set_xy(self.w - 40, self.h - 15)
-        self.cell(30, 5, "Page " + str(self.page_no()), 0, 0, "R")
     
     def previous_reports_header(self):
         margin = 10
@@ -390,7 +1930,7 @@ class PatientReport(FPDF):
         
         # Add white text
         self.set_y(15)
-        self.set_font("helvetica", "B", 18)
+        self.set_font(self.report_font_family, "B", 18)
         self.set_text_color(255, 255, 255)
         self.cell(0, 10, "Previous Consultations", 0, 1, 'C')
         
@@ -398,7 +1938,7 @@ class PatientReport(FPDF):
         if self.logo_data:
             self.set_fill_color(255, 255, 255)
             self.rect(margin, margin, 35, 35, 'F')
-            self.image(self.logo_data, margin+2.5, margin+2.5, 30)
+            self.image(self.cached_image(self.logo_data), margin+2.5, margin+2.5, 30)
             
         # Return to make sure we know where the header ends
         return 50  # Return a fixed position after header
@@ -409,21 +1949,31 @@ class PatientReport(FPDF):
         self.rect(0, self.h - 15, self.w, 15, 'F')
         
         self.set_y(self.h - 12)
-        self.set_font("helvetica", "I", 8)
+        self.set_font(self.report_font_family, "I", 8)
         self.set_text_color(255, 255, 255)
         self.cell(0, 10, "Page " + str(self.page_no()), 0, 0, "C")
 
 
 class MainPatientReport(PatientReport):
     def generate_main_report(self, output_path=None):
+        """Generate report and return the PDF buffer (a bytearray, not copied)"""
+        self.add_page()
+        self.render_main_section()
+
+        if output_path:
+            return self.output(output_path)
+        else:
+            return self.output()
+
+    @timed_stage("body")
+    def render_main_section(self):
 
         # print("Type of self.patient_data:", type(self.patient_data))
         # print("Contents of self.patient_data:", self.patient_data)
         # print("Age value:", self.patient_data.get('age'))
         # print("Date value:", self.patient_data.get('date'))
 
-        """Generate report and return PDF as bytes"""
-        self.add_page()
+        """Draw the main report onto the current (first) page"""
         self.add_watermark()  # Add the watermark
 
         # Patient information section with horizontal line at top
@@ -437,7 +1987,7 @@ class MainPatientReport(PatientReport):
 
         # First line - Patient Name
         self.set_y(45)
-        self.set_font("helvetica", "B", 10)
+        self.set_font(self.report_font_family, "B", 10)
         self.set_text_color(*self.primary_color)
         self.set_x(10)
 
@@ -445,361 +1995,2398 @@ class MainPatientReport(PatientReport):
         patient_name_label = "Patient Name:"
         patient_name_label_width = self.get_string_width(patient_name_label) + 5  # Add some padding
 
-        self.cell(patient_name_label_width, 10, patient_name_label, 0, 0, 'L')  # No new line
+        self.cell(patient_name_label_width, 10, patient_name_label, 0, 0, 'L')  # No new line
+
+        # Add patient name value immediately after the header
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+
+        # Specify a width for the patient name cell
+        patient_name_width = 80
+        self.cell(patient_name_width, 10, self.patient_data.name, 0, 1, 'L')  # Create new line
+
+        age = self.patient_data.age or 'N/A'
+        date = self.patient_data.date or 'N/A'
+        
+        # Second line headers - Age
+        self.set_x(10)
+        self.set_font(self.report_font_family, "B", 10)
+        self.set_text_color(*self.primary_color)
+
+        # Age label
+        age_label = "Age:"
+        age_label_width = self.get_string_width(age_label) + 5
+        self.cell(age_label_width, 10, age_label, 0, 0, 'L')
+
+        # Age value
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+        age_width = 40
+        self.cell(age_width, 10, age, 0, 0, 'L')  # No new line
+
+        # Add some space between Age and Date
+        self.set_x(60)  # Adjust X position to avoid overlap
+
+        # Date label
+        self.set_font(self.report_font_family, "B", 10)
+        self.set_text_color(*self.primary_color)
+        date_label = "Date:"
+        date_label_width = self.get_string_width(date_label) + 5
+        self.cell(date_label_width, 10, date_label, 0, 0, 'L')
+
+        # Date value
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+        self.cell(40, 10, date, 0, 1, 'L')  # End line
+
+        # Patient info line
+        self.line(10, 65, self.w - 10, 65)
+        self.ln(5)
+
+        # Patient Details section - separated into two columns
+        self.set_y(70)  # Adjusted from original 60
+        self.set_font(self.report_font_family, "B", 10)
+        self.set_text_color(*self.primary_color)
+
+        # Left column - abbreviations
+        left_col_width = 35  # Reduced width for left column
+        self.set_x(10)
+        self.cell(left_col_width, 10, "C/C", 0, 1, 'L')
+        self.set_x(10)
+        self.ln(10)
+        self.set_x(10)
+        self.cell(left_col_width, 10, "D/E", 0, 1, 'L')
+        self.set_x(10)
+        self.cell(left_col_width, 10, "BP=", 0, 1, 'L')
+
+        # Vertical divider between columns - adjusted position
+        self.set_draw_color(*self.primary_color)
+        self.line(45, 70, 45, 160)  # Adjusted position and height
+
+        # Main content area - Right column 
+        # Patient Details using multi-cells for longer text
+        patient_fields = [
+            ('Chief Complaints:', 'chief_complaints'),
+            ('Aggravating factor:', 'aggravating_factor'),
+            ('Present Illness:', 'present_illness'),
+            ('Family History:', 'family_history'),
+            ('Surgical History:', 'surgical_history'),
+            ('Examination:', 'examination'),
+            ('Clinical Impression:', 'clinical_impression')
+        ]
+
+        self.set_y(70)  # Start right at 70 instead of 60
+        self.set_x(50)  # Move content start to the right of the vertical line
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+
+        y_position = self.get_y()
+        for label, field in patient_fields:
+            self.set_font(self.report_font_family, "B", 10)
+            self.set_y(y_position)
+            self.set_x(50)  # Adjusted from 75
+            self.set_text_color(*self.secondary_color)
+            self.cell(40, 8, label, 0, 0)
+            self.set_font(self.report_font_family, "", 10)
+            self.set_text_color(0, 0, 0)
+            self.set_x(90)  # Adjusted from 115
+            self.multi_cell(100, 8, getattr(self.patient_data, field))  # Increased width from 80 to 100
+            y_position += 15
+
+        # Advice (Medications Table)
+        self.ln(5)
+        self.set_font(self.report_font_family, "B", 14)
+        self.set_text_color(*self.primary_color)
+        self.cell(0, 10, "Advice", 0, 1)
+
+        # Prepare table data
+        table_data = [
+            ["S.No.", "Medicine Name", "Dosage", "Details"]
+        ]
+        for i, med in enumerate(self.advice_data):
+            table_data.append([
+                str(i + 1),
+                med.name,
+                med.dosage,
+                med.details
+            ])
+
+        self.create_table(table_data, align_data='C', align_header='C', cell_width='even')
+
+
+class PreviousPatientReport(PatientReport):
+    
+    @timed_stage("header")
+    def header(self):
+        if self.append_state and self.page == 1:
+            return  # the existing last page already has its letterhead
+        # Override the default header method to use our custom previous reports header
+        self.draw_form("previous_header", self.consultations_letterhead)
+
+    def consultations_letterhead(self):
+        # self.ln(10)
+        margin = 10
+        # Set green background for header
+        self.set_fill_color(*self.primary_color)
+        self.rect(0, 0, self.w, 40, 'F')
+        
+        # Add white text
+        self.set_y(15)
+        self.set_font(self.report_font_family, "B", 18)
+        self.set_text_color(255, 255, 255)
+        self.cell(0, 10, "Previous Consultations", 0, 1, 'C')
+        
+        # Logo with white background
+        if self.logo_data:
+            self.set_fill_color(255, 255, 255)
+            self.rect(margin, margin, 35, 35, 'F')
+            self.image(self.cached_image(self.logo_data), margin+2.5, margin+2.5, 30)
+
+    
+
+    @timed_stage("footer")
+    def footer(self):
+        if self.merging or (self.append_state and self.page == 1):
+            return  # merged pages come with their footers
+        # Override the default footer method to use our custom previous reports footer
+        self.draw_form("previous_footer", self.consultations_footer_bar)
+        
+        self.set_y(self.h - 12)
+        self.set_font(self.report_font_family, "I", 8)
+        self.set_text_color(0,0,0)
+        self.cell(0, 10, "Page " + str(self.section_page_no()), 0, 0, "C")
+        # self.ln(30)
+
+    def consultations_footer_bar(self):
+        self.set_fill_color(*self.light_grey)
+        self.rect(0, self.h - 15, self.w, 15, 'F')
+
+    def generate_report(self):
+        """Generate previous reports PDF and return the PDF buffer"""
+        self.add_page()
+        self.render_previous_section()
+        self.append_y = self.get_y()  # where append_to() continues
+        return self.output()
+
+    # State of the document being continued by append_to()
+    append_state = None
+
+    def append_to(self, existing_pdf):
+        """
+        Add this request's previous_reports to a PDF made by generate_report() (or by an
+        earlier append_to), continuing on its last page. The result is the existing bytes
+        unchanged plus a PDF incremental update, so only the new blocks are rendered.
+        Raises ValueError if existing_pdf cannot be continued.
+        """
+        self.append_state = read_append_state(existing_pdf)
+        # The continuation page keeps the existing last page's number
+        self.section_page_offset = 1 - self.append_state["page_number"]
+        self.add_page()
+        self.set_y(self.append_state["y"])
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+        with self.stage("consultations"):
+            for report in self.previous_reports:
+                self.consultation_block(report)
+        self.append_y = self.get_y()
+        document = bytearray(existing_pdf)
+        document += self.output(output_producer_class=AppendOutputProducer)
+        return document
+
+    # Parallel rendering (render_chunked): pages are rendered in chunks, then merged by merge_chunks()
+    merging = False
+
+    def prime_fonts(self):
+        """
+        Register the report font styles in a fixed order, before the first page, so
+        that documents rendering parts of one report all number their fonts alike
+        """
+        for style in ("B", "", "I"):
+            self.set_font(self.report_font_family, style)
+
+    def paginate(self, blocks):
+        """
+        Follow consultation_block's page breaks from the current position over blocks,
+        (height, description lines) pairs as block_layout gives them, without drawing.
+        Returns the total page count and (block index, page number) for each block
+        that starts a new page and fits on it, i.e. where a chunk may begin.
+        """
+        limit = self.h - self.b_margin
+        # Where text continues after an automatic page break: below the letterhead
+        continued_y = self.form_xobjects["previous_header"]["end_xy"][1]
+        page, y = self.section_page_no(), self.get_y()
+        starts = []
+        for index, (height, line_count) in enumerate(blocks):
+            if y + max(height, 30) > limit:
+                page += 1
+                y = 50
+                if y + height <= limit:
+                    starts.append((index, page))
+            # Blocks taller than a page break inside their description
+            line_y = y + 10
+            for _ in range(line_count):
+                if line_y + self.block_line_height > limit:
+                    page += 1
+                    line_y = continued_y
+                line_y += self.block_line_height
+            y += height + 5
+        return page, starts
+
+    def plan_chunks(self, blocks, count):
+        """
+        Split the consultations into up to count page-aligned chunks of about the same
+        number of pages, starting from the current position (see paginate). Returns the
+        total page count and the (first block, first page) of each chunk.
+        """
+        pages, starts = self.paginate(blocks)
+        chunks = [(0, self.section_page_no())]
+        for index, page in starts:
+            if len(chunks) < count and page - 1 >= pages * len(chunks) / count:
+                chunks.append((index, page))
+        return pages, chunks
+
+    def render_chunk(self, first_page):
+        """
+        Render this request's previous_reports as a chunk of a longer report starting on
+        page first_page, for merge_chunks(); the first chunk begins with the patient section.
+        Returns a dict of the chunk's page content streams and what they use.
+        """
+        self.prime_fonts()
+        if first_page == 1:
+            self.add_page()
+            self.render_previous_section()
+        else:
+            self.section_page_offset = 1 - first_page
+            # Drawing state as consultation_block leaves it, which a page break carries over
+            self.set_font(self.report_font_family, "", 10)
+            self.set_fill_color(*self.light_accent)
+            self.set_draw_color(*self.primary_color)
+            self.add_page()
+            self.set_y(50)
+            with self.stage("consultations"):
+                for report in self.previous_reports:
+                    self.consultation_block(report)
+        self.append_y = self.get_y()
+        self.output(output_producer_class=ChunkOutputProducer)
+        return dict(self.chunk, stats=self.render_stats())
+
+    def merge_chunks(self, chunks):
+        """
+        The PDF of the chunks render_chunk() returned, in page order. Every chunk
+        registers the same fonts, images and forms, so each is written once here.
+        """
+        self.merging = True
+        self.prime_fonts()
+        fonts = [font.fontkey for font in sorted(self.fonts.values(), key=lambda font: font.i)]
+        first = chunks[0]
+        for chunk in chunks:
+            if (chunk["fonts"] != fonts
+                    or {name: info["i"] for name, info in chunk["images"].items()}
+                    != {name: info["i"] for name, info in first["images"].items()}
+                    or {key: form["name"] for key, form in chunk["forms"].items()}
+                    != {key: form["name"] for key, form in first["forms"].items()}):
+                raise ValueError("Chunks registered different fonts, images or forms")
+        self.form_xobjects = first["forms"]
+        for name, info in first["images"].items():
+            self.image_cache.images[name] = type(info)(info, usages=sum(chunk["images"][name]["usages"]
+                                                                        for chunk in chunks))
+        self.image_cache.icc_profiles.update(first["icc_profiles"])
+
+        self.merged_contents = {}
+        with self.stage("merge"):
+            for chunk in chunks:
+                for page in chunk["pages"]:
+                    if page["gstates"]:
+                        raise ValueError("Graphics states cannot be merged")
+                    self._beginpage(None, None, False, None, None)
+                    self.fonts_used_per_page_number[self.page] = page["fonts"]
+                    self.images_used_per_page_number[self.page] = page["images"]
+                    self.form_xobjects_used_per_page_number[self.page] = page["forms"]
+                    self.merged_contents[self.page] = page["contents"]
+        self.append_y = chunks[-1]["y"]
+        return self.output(output_producer_class=MergedOutputProducer)
+
+    @timed_stage("consultations")
+    def render_previous_section(self):
+        """Draw patient details and consultation blocks starting on the current page"""
+        start_y = self.get_y() + 30
+        self.set_y(start_y)
+        
+        self.set_fill_color(*self.light_accent)
+        self.rect(10, start_y, self.w - 20, 10, 'F')
+
+        # Patient info header
+        self.set_font(self.report_font_family, "B", 10)
+        self.set_text_color(*self.primary_color)
+        self.cell(80, 10, "Patient Name:", 0, 0, 'L')
+        self.cell(60, 10, "UHID:", 0, 0, 'L')
+        self.cell(40, 10, "Age/Sex:", 0, 1, 'L')
+
+        # Info line
+        self.set_draw_color(*self.primary_color)
+        self.line(10, start_y + 10, self.w - 10, start_y + 10)
+
+        # Fill in patient details
+        self.set_y(start_y + 15)
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+        self.cell(80, 10, self.patient_data.name, 0, 0, 'L')
+        self.cell(60, 10, self.patient_data.uhid, 0, 0, 'L')
+        self.cell(40, 10, f"{self.patient_data.age}/{self.patient_data.sex}", 0, 1, 'L')
+
+        self.ln(10)
+
+        # Previous Consultations - formatted as blocks
+        self.set_font(self.report_font_family, "B", 14)
+        self.set_text_color(*self.primary_color)
+        self.cell(0, 10, "Previous Consultations", 0, 1)
+
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+
+        for report in self.previous_reports:
+            self.consultation_block(report)
+
+    block_line_height = 8  # Height of each description line
+
+    def block_layout(self, report):
+        """Description lines of a consultation block and the block's height; the current font must be the body font"""
+        available_width = self.w - 30  # Width of the rectangle minus some padding
+        # The description exactly as multi_cell would wrap it
+        lines = self.wrap_lines(report.consultation, available_width) if report.consultation else []
+        text_height = len(lines) * self.block_line_height
+
+        # Add header height (for date/hospital) + padding
+        rect_height = 10 + text_height + 5
+
+        # Ensure minimum rectangle height - reduce for small content
+        min_height = 20 if text_height < 10 else 30
+        return lines, max(rect_height, min_height)
+
+    def consultation_block(self, report):
+        """Draw one consultation as a rounded block, on a new page if it does not fit on this one"""
+        date_hospital = f"{report.date} - {report.hospital}"
+        available_width = self.w - 30
+        lines, rect_height = self.block_layout(report)
+
+        # Check for page break: keep each block on one page
+        if self.get_y() + max(rect_height, 30) > self.h - self.b_margin:
+            self.add_page()
+            self.set_y(50)
+
+        current_y = self.get_y()
+        
+        # Draw rounded rectangle
+        self.set_fill_color(*self.light_accent)
+        self.rounded_rect(10, current_y, self.w - 20, rect_height, 5, 'F')
+
+        # Date and hospital on one line
+        self.set_font(self.report_font_family, "B", 12)
+        self.set_text_color(*self.secondary_color)
+        self.cell(0, 10, date_hospital, 0, 1, 'L')
+
+        # Consultation description below
+        self.set_font(self.report_font_family, "", 10)
+        self.set_text_color(0, 0, 0)
+        # Printed from the measured lines, so the text is not wrapped a second time
+        for line in lines:
+            self.cell(available_width, self.block_line_height, line, new_x=XPos.LEFT, new_y=YPos.NEXT)
+
+        # Position for next item - calculate properly
+        self.set_y(current_y + rect_height + 5)
+
+    def rounded_rect(self, x, y, w, h, r, style=None):
+        """Draw a rectangle with rounded corners.
+        
+        Args:
+            x, y: top-left corner coordinates
+            w, h: width and height
+            r: radius of the rounded corners
+            style: 'F' for filled, 'S' for stroke (outline), 'DF' or 'FD' for both
+        """
+        # Ensure radius doesn't exceed dimensions
+        r = min(r, min(w, h) / 2)
+        
+        # Start at top-right corner after the rounded part
+        hp = self.h  # Page height
+        k = self.k   # Scale factor
+        
+        # Move to position just after the top-left rounded corner
+        self._out(f'{(x+r)*k:.2f} {(hp-y)*k:.2f} m')
+        
+        # Draw top border line (to top-right corner minus radius)
+        self._out(f'{(x+w-r)*k:.2f} {(hp-y)*k:.2f} l')
+        
+        # Draw quarter circle for top-right rounded corner
+        self._out(f'{(x+w-r)*k:.2f} {(hp-y)*k:.2f} {(x+w)*k:.2f} {(hp-y)*k:.2f} {(x+w)*k:.2f} {(hp-(y+r))*k:.2f} c')
+        
+        # Draw right border line (to bottom-right corner minus radius)
+        self._out(f'{(x+w)*k:.2f} {(hp-(y+h-r))*k:.2f} l')
+        
+        # Draw quarter circle for bottom-right rounded corner
+        self._out(f'{(x+w)*k:.2f} {(hp-(y+h-r))*k:.2f} {(x+w)*k:.2f} {(hp-(y+h))*k:.2f} {(x+w-r)*k:.2f} {(hp-(y+h))*k:.2f} c')
+        
+        # Draw bottom border line (to bottom-left corner minus radius)
+        self._out(f'{(x+r)*k:.2f} {(hp-(y+h))*k:.2f} l')
+        
+        # Draw quarter circle for bottom-left rounded corner
+        self._out(f'{(x+r)*k:.2f} {(hp-(y+h))*k:.2f} {x*k:.2f} {(hp-(y+h))*k:.2f} {x*k:.2f} {(hp-(y+h-r))*k:.2f} c')
+        
+        # Draw left border line (to top-left corner minus radius)
+        self._out(f'{x*k:.2f} {(hp-(y+r))*k:.2f} l')
+        
+        # Draw quarter circle for top-left rounded corner
+        self._out(f'{x*k:.2f} {(hp-(y+r))*k:.2f} {x*k:.2f} {(hp-y)*k:.2f} {(x+r)*k:.2f} {(hp-y)*k:.2f} c')
+        
+        # Close path and apply style
+        if style == 'F':
+            self._out('f')  # Fill
+        elif style == 'S':
+            self._out('S')  # Stroke
+        else:  # 'FD' or 'DF'
+            self._out('B')  # Both fill and stroke
+
+class CombinedPatientReport(MainPatientReport, PreviousPatientReport):
+    """
+    Main report followed by the previous consultations in one document.
+    Both sections share the parsed data and embedded images but keep their
+    own header, footer and page numbering.
+    """
+
+    def __init__(self, json_data):
+        super().__init__(json_data)
+        self.section = "main"
+        self.next_section = None
+
+    def start_section(self, section):
+        # The old section's footer is drawn by add_page before the new header
+        self.next_section = section
+        self.add_page()
+
+    @timed_stage("header")
+    def header(self):
+        if self.next_section:
+            self.section = self.next_section
+            self.section_page_offset = self.page_no() - 1
+            self.next_section = None
+        if self.section == "previous":
+            PreviousPatientReport.header(self)
+        else:
+            PatientReport.header(self)
+
+    @timed_stage("footer")
+    def footer(self):
+        if self.section == "previous":
+            PreviousPatientReport.footer(self)
+        else:
+            PatientReport.footer(self)
+
+    def generate_combined_report(self):
+        """Generate main report and previous consultations, return the PDF buffer"""
+        self.start_section("main")
+        self.render_main_section()
+        self.start_section("previous")
+        self.render_previous_section()
+        return self.output()
+
+
+# Function to generate report from JSON data
+def generate_main_report_from_json(json_data):
+    report = MainPatientReport(json_data)
+    return report.generate_main_report()
+
+def generate_previous_reports_from_json(json_data):
+    # Create a completely separate instance for previous reports
+    report = PreviousPatientReport(json_data)
+    return report.generate_report()
+
+def append_previous_reports_from_json(existing_pdf, json_data):
+    """Existing previous consultations PDF with json_data's previous_reports appended"""
+    report = PreviousPatientReport(json_data)
+    return report.append_to(existing_pdf)
+
+def generate_combined_report_from_json(json_data):
+    report = CombinedPatientReport(json_data)
+    return report.generate_combined_report()
+
+report_classes = {
+    "main": (MainPatientReport, "generate_main_report"),
+    "previous": (PreviousPatientReport, "generate_report"),
+    "combined": (CombinedPatientReport, "generate_combined_report"),
+}
+
+# Estimated render memory: document setup, fonts and output buffers, then layout and PDF
+# output per character of report text; measured with tracemalloc on the bundled fonts
+RENDER_MEMORY_BASE = 512 * 1024
+RENDER_MEMORY_PER_CHAR = 24
+
+
+def estimate_render_memory(kind, report_request):
+    """
+    Estimated peak memory of a render in bytes, from the request alone: a fixed base,
+    the report text, and the largest image decode (images are decoded one at a time).
+    Images the worker has cached already cost less than this assumes.
+    """
+    chars = 0
+    if kind in ("main", "combined"):
+        chars += sum(len(advice.name) + len(advice.dosage) + len(advice.details)
+                     for advice in report_request.advice_data)
+    if kind in ("previous", "combined"):
+        chars += sum(len(report.date) + len(report.hospital) + len(report.consultation)
+                     for report in report_request.previous_reports)
+    images = [image_decode_memory(source) for source in (report_request.logo_data, report_request.watermark_logo)
+              if source]
+    return RENDER_MEMORY_BASE + RENDER_MEMORY_PER_CHAR * chars + max(images, default=0)
+
+
+@contextmanager
+def traced_memory(stats):
+    """
+    Measure the peak memory of the block with tracemalloc for RENDER_MEMORY_TRACE_RATE of
+    the calls, into stats["peak_memory"]. Pixel buffers held by PIL are not included.
+    """
+    if RENDER_MEMORY_TRACE_RATE <= 0 or random.random() >= RENDER_MEMORY_TRACE_RATE or tracemalloc.is_tracing():
+        yield
+        return
+    tracemalloc.start()
+    try:
+        yield
+        stats["peak_memory"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def render_report(kind, report_request):
+    """
+    Render a report of the given kind; runs inside a render pool worker.
+    Returns (pdf_bytes, stats): stats has per-stage seconds, the total render seconds and pages,
+    and the peak memory when traced (see traced_memory).
+    """
+    start = time.perf_counter()
+    traced = {}
+    with traced_memory(traced):
+        report_class, method = report_classes[kind]
+        report = report_class(report_request)
+        setup_seconds = time.perf_counter() - start
+        pdf_bytes = getattr(report, method)()
+    stats = dict(report.render_stats(), **traced)
+    stats["stages"]["setup"] = setup_seconds
+    stats["seconds"] = time.perf_counter() - start
+    return pdf_bytes, stats
+
+
+def measure_consultation_blocks(report_request):
+    """(height, description lines) of each consultation block, and the seconds taken; runs in a render worker"""
+    start = time.perf_counter()
+    report = PreviousPatientReport(report_request)
+    report.set_font(report.report_font_family, "", 10)
+    blocks = [(height, len(lines)) for lines, height in map(report.block_layout, report.previous_reports)]
+    return blocks, time.perf_counter() - start
+
+
+def render_consultation_chunk(report_request, first_page):
+    """A chunk of a previous consultations report, see PreviousPatientReport.render_chunk; runs in a render worker"""
+    report = PreviousPatientReport(report_request)
+    return report.render_chunk(first_page)
+
+
+def without_consultations(report_request):
+    return report_request.model_copy(update={"previous_reports": []})
+
+
+def plan_consultation_chunks(report_request, blocks, count):
+    """Total pages and (first block, first page) of each chunk, see PreviousPatientReport.plan_chunks"""
+    report = PreviousPatientReport(without_consultations(report_request))
+    report.add_page()
+    report.render_previous_section()
+    return report.plan_chunks(blocks, count)
+
+
+def merge_consultation_chunks(report_request, chunks):
+    """(pdf_bytes, stats) of the report rendered as chunks, see PreviousPatientReport.merge_chunks"""
+    report = PreviousPatientReport(without_consultations(report_request))
+    pdf_bytes = report.merge_chunks(chunks)
+    return pdf_bytes, report.render_stats()
+
+
+def preload_assets(report_request):
+    """Decode the request's logos and parse the report fonts into the process-wide caches"""
+    asset_cache.get(report_request.logo_data)
+    if report_request.watermark_logo:
+        opacity = (report_request.watermark_mode or WATERMARK_MODE) == "opacity"
+        asset_cache.get(report_request.watermark_logo, "logo" if opacity else "watermark")
+    font_cache.preload(REPORT_FONT, REPORT_FONT_BOLD, REPORT_FONT_ITALIC, *REPORT_FALLBACK_FONTS)
+
+
+def warm_up_worker(report_request):
+    """Prime a render worker's caches with one render of each kind; returns the worker's pid"""
+    preload_assets(report_request)
+    for kind in report_classes:
+        render_report(kind, report_request)
+    return os.getpid()
+
+
+class RenderPoolFull(Exception):
+    """Raised when the render pool admission queue is full."""
+
+
+class RenderTimeout(Exception):
+    """Raised when a render does not finish within the configured timeout."""
+
+
+class RenderTooLarge(Exception):
+    """Raised when a render is estimated to need more memory than one request may use."""
+
+
+def run_with_deadline(deadline, fn, *args):
+    """
+    Call fn(*args) in a render worker process, raising RenderTimeout there once the
+    time.time() deadline passes. A render its caller gave up on stops and frees the
+    worker, and one that waited past its deadline in the executor queue never starts.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise RenderTimeout("Render timed out before it started")
+    if not hasattr(signal, "setitimer"):  # Windows: the render runs to completion
+        return fn(*args)
+
+    def expire(signum, frame):
+        raise RenderTimeout("Render exceeded its deadline")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, remaining)
+    try:
+        return fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class RenderPool:
+    """
+    Bounded pool of worker processes for report rendering.
+
+    At most `workers + queue_size` renders are admitted at once; further
+    submissions fail fast with RenderPoolFull so the route can answer 503,
+    or wait for a free slot when submitted with wait=True (batch renders).
+
+    Renders also reserve their estimated memory (estimate_render_memory) out of
+    memory_budget. An admitted render that does not fit waits in line for running
+    ones to free theirs, up to the timeout unless submitted with wait=True; one
+    above max_request_memory is refused with RenderTooLarge.
+
+    A render that times out is stopped in its worker as well (run_with_deadline), and
+    keeps its slot and memory until the worker has actually let go of it. With
+    workers=0 renders run in threads of this process, which cannot be interrupted:
+    there the timeout only ends the wait, and the slot stays taken until the render ends.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, queue_size=RENDER_QUEUE_SIZE, timeout=RENDER_TIMEOUT,
+                 memory_budget=RENDER_MEMORY_BUDGET, max_request_memory=RENDER_MEMORY_MAX_REQUEST):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.memory_budget = memory_budget
+        self.max_request_memory = max_request_memory
+        self.pending = 0
+        self.memory_reserved = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.too_large = 0
+        self.timed_out = 0
+        self._executor = None
+        self._waiters = deque()
+        self._memory_waiters = deque()  # (future, bytes), first come first served
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return max(self.workers, 1) + self.queue_size
+
+    def _get_executor(self):
+        if self._executor is None and self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def _admit(self, wait, memory=0):
+        self.check_memory(memory)
+        with self._lock:
+            if self.pending < self.capacity:
+                self.pending += 1
+                waiter = None
+            elif not wait:
+                self.rejected += 1
+                raise RenderPoolFull("Render queue is full, retry later")
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+        if waiter is not None:
+            try:
+                await waiter  # a finishing render hands its slot over
+            except asyncio.CancelledError:
+                with self._lock:
+                    if waiter.done() and not waiter.cancelled():
+                        self._free_slot()
+                raise
+        if memory:
+            try:
+                await self._reserve_memory(memory, wait)
+            except BaseException:
+                with self._lock:
+                    self._free_slot()
+                raise
+
+    def check_memory(self, memory):
+        """Raise RenderTooLarge for a render estimated to need more than max_request_memory."""
+        if self.max_request_memory > 0 and memory > self.max_request_memory:
+            with self._lock:
+                self.too_large += 1
+            raise RenderTooLarge(f"Report needs an estimated {memory / 2**20:.0f} MB to render, "
+                                 f"the limit is {self.max_request_memory / 2**20:.0f} MB")
+
+    def _memory_fits(self, memory):
+        # An idle pool takes any render, so a budget below max_request_memory cannot stall one forever
+        return (self.memory_budget <= 0 or self.memory_reserved == 0
+                or self.memory_reserved + memory <= self.memory_budget)
+
+    async def _reserve_memory(self, memory, wait):
+        with self._lock:
+            if not self._memory_waiters and self._memory_fits(memory):
+                self.memory_reserved += memory
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._memory_waiters.append((waiter, memory))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), None if wait else self.timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            with self._lock:
+                if waiter.done():
+                    self._free_memory(memory)  # granted just as the wait ended
+                else:
+                    waiter.cancel()
+                    self._memory_waiters.remove((waiter, memory))
+                    self._grant_memory()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.rejected += 1
+            if isinstance(e, asyncio.TimeoutError):
+                raise RenderPoolFull("Not enough render memory free, retry later") from None
+            raise
+
+    def _grant_memory(self):
+        # Caller holds self._lock. Strictly in order, so small renders cannot starve a large one
+        while self._memory_waiters:
+            waiter, memory = self._memory_waiters[0]
+            if not self._memory_fits(memory):
+                return
+            self._memory_waiters.popleft()
+            self.memory_reserved += memory
+            waiter.set_result(None)
+
+    def _free_memory(self, memory):
+        # Caller holds self._lock
+        self.memory_reserved -= memory
+        self._grant_memory()
+
+    def _free_slot(self):
+        # Caller holds self._lock
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.pending -= 1
+
+    def _release(self, future, memory=0):
+        # A render that timed out keeps its slot and memory until the worker actually finishes it
+        self.release(failed=future.cancelled() or future.exception() is not None, memory=memory)
+
+    async def reserve(self, wait=False, memory=0):
+        """Take a slot (and memory) for a render that runs outside the pool (e.g. streaming)."""
+        await self._admit(wait, memory)
+
+    def take_idle(self, count):
+        """
+        Take up to count more slots at once for a render that already holds one and can
+        use more workers (render_chunked): only as many as there are idle workers, never
+        queueing. Returns how many were taken; give them back with release_idle.
+        """
+        with self._lock:
+            if self._waiters or self._memory_waiters:
+                return 0
+            taken = max(min(count, self.workers - self.pending), 0)
+            self.pending += taken
+            return taken
+
+    def release_idle(self, count):
+        with self._lock:
+            for _ in range(count):
+                self._free_slot()
+
+    def release(self, failed=False, memory=0):
+        """Give back a reserved slot (and memory); failed=None counts neither outcome, e.g. for a bad request."""
+        with self._lock:
+            self._free_slot()
+            if memory:
+                self._free_memory(memory)
+            if failed:
+                self.failed += 1
+            elif failed is not None:
+                self.completed += 1
+
+    async def run(self, fn, *args, wait=False, timeout=None, memory=0, reserved=False):
+        """
+        Run fn(*args) on the pool and return its result; timeout defaults to the pool's.
+        memory is the render's estimated peak memory in bytes, see estimate_render_memory.
+        reserved runs use a slot the caller already holds (reserve, take_idle) and releases.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if not reserved:
+            await self._admit(wait, memory)
+        loop = asyncio.get_running_loop()
+        try:
+            executor = self._get_executor()
+            if executor is not None:
+                future = loop.run_in_executor(executor, run_with_deadline, time.time() + timeout, fn, *args)
+            else:
+                future = loop.run_in_executor(None, fn, *args)
+        except Exception:
+            if not reserved:
+                with self._lock:
+                    self._free_slot()
+                    if memory:
+                        self._free_memory(memory)
+            raise
+        if not reserved:
+            future.add_done_callback(functools.partial(self._release, memory=memory))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, RenderTimeout):
+            # The worker may hit the deadline first, e.g. for a render queued past it
+            with self._lock:
+                self.timed_out += 1
+            raise RenderTimeout(f"Render exceeded {timeout:g}s") from None
+
+    async def warm_up(self, fn, *args):
+        """
+        Start the worker processes and run fn(*args) about once in each, outside
+        admission control. Returns the results (none when rendering in-process).
+        """
+        executor = self._get_executor()
+        if executor is None:
+            return []
+        loop = asyncio.get_running_loop()
+        # Submitted together, so the executor starts a process for each
+        return await asyncio.gather(*(loop.run_in_executor(executor, fn, *args) for _ in range(self.workers)))
+
+    def stats(self):
+        with self._lock:
+            running = min(self.pending - len(self._memory_waiters), max(self.workers, 1))
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "running": running,
+                "queued": self.pending - running,
+                "waiting": len(self._waiters),
+                "waiting_for_memory": len(self._memory_waiters),
+                "memory_budget": self.memory_budget,
+                "memory_reserved": self.memory_reserved,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "too_large": self.too_large,
+                "timed_out": self.timed_out,
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+render_pool = RenderPool()
+
+# uvicorn configures this logger, so our messages show up next to its own
+log = logging.getLogger("uvicorn.error")
+
+
+class Warmup:
+    """
+    Startup phase paying the first request's costs up front: decoding the logos,
+    parsing fonts, and a throwaway render of each report kind, in this process
+    (streaming and in-process renders) and in the render workers. Runs in the
+    background; requests are served meanwhile, only /ready waits for it.
+    """
+
+    def __init__(self, enabled=WARMUP, request_path=WARMUP_REQUEST):
+        self.enabled = enabled
+        self.request_path = request_path
+        self.ready = not enabled
+        self.error = None
+        self.phase_seconds = {}
+        self.workers_warmed = 0
+        self._task = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = self.phase_seconds[name] = time.perf_counter() - start
+            log.info("Warmup %s: %.0f ms", name, seconds * 1000)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        try:
+            with self.phase("total"):
+                with self.phase("request"):
+                    with open(self.request_path, "rb") as f:
+                        report_request = parse_report_request(f.read())
+                with self.phase("assets"):
+                    await asyncio.to_thread(preload_assets, report_request)
+                for kind in report_classes:
+                    with self.phase(f"render_{kind}"):
+                        await asyncio.to_thread(render_report, kind, report_request)
+                with self.phase("render_workers"):
+                    pids = await render_pool.warm_up(warm_up_worker, report_request)
+                    self.workers_warmed = len(set(pids))
+        except Exception as e:
+            # A cold instance still serves; keeping it out of rotation would be worse
+            self.error = f"{type(e).__name__}: {e}"
+            log.warning("Warmup failed, serving cold: %s", self.error)
+        finally:
+            self.ready = True
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "warmup": self.enabled,
+            "phase_seconds": dict(self.phase_seconds),
+            "workers_warmed": self.workers_warmed,
+            "error": self.error,
+        }
+
+
+warmup = Warmup()
+
+
+def validation_error_body(e):
+    """Error summary and per-field details of a ValidationError, without echoing the input back."""
+    return {"error": f"Invalid report data ({e.error_count()} error(s))",
+            "detail": e.errors(include_url=False, include_context=False, include_input=False)}
+
+
+def render_error_response(e):
+    """Map render pool errors to HTTP responses."""
+    if isinstance(e, RenderPoolFull):
+        return JSONResponse(status_code=503, content={"error": str(e)},
+                            headers={"Retry-After": str(RENDER_RETRY_AFTER)})
+    if isinstance(e, RenderTimeout):
+        return JSONResponse(status_code=504, content={"error": str(e)})
+    if isinstance(e, RenderTooLarge):
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    if isinstance(e, ValidationError):
+        return JSONResponse(status_code=422, content=validation_error_body(e))
+    if isinstance(e, HTTPException):
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+    return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+def write_atomic(path, data):
+    """Write then rename, so readers never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ResultCache:
+    """
+    Memory-budgeted LRU of rendered PDFs keyed by request hash, with an
+    optional on-disk tier that survives restarts and is shared by workers.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, directory=RESULT_CACHE_DIR,
+                 disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk_bytes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".pdf"))
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.directory:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                self._put_memory(key, data)
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        if self.directory and not os.path.exists(self._path(key)):
+            write_atomic(self._path(key), data)
+            with self._lock:
+                self.disk_bytes += len(data)
+                over_budget = self.disk_bytes > self.disk_max_bytes
+            if over_budget:
+                self._trim_disk()
+
+    def _trim_disk(self):
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".pdf")),
+                         key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.disk_evictions += 1
+        with self._lock:
+            self.disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "disk_enabled": bool(self.directory),
+                "disk_bytes": self.disk_bytes,
+                "disk_evictions": self.disk_evictions,
+            }
+
+
+result_cache = ResultCache()
+
+
+def report_cache_key(kind, request):
+    """
+    Hash of the validated request, the content of any logo and font files
+    it uses and the server settings that affect the rendered bytes.
+    """
+    request = parse_report_request(request)
+    h = hashlib.sha256()
+    settings = (RENDER_VERSION, WATERMARK_MODE, PDF_COMPACTION, IMAGE_DPI, IMAGE_JPEG_QUALITY, kind,
+                renders_in_chunks(kind, request))
+    h.update("".join(f"{value}\0" for value in settings).encode())
+    # Models dump their fields in declaration order, so this is canonical
+    h.update(request.model_dump_json().encode())
+    for source in (request.logo_data, request.watermark_logo):
+        if source and os.path.exists(source):
+            h.update(asset_cache.content_digest(source).encode())
+    if REPORT_FONT:
+        h.update(f"{REPORT_TEXT_SHAPING}\0".encode())
+        for source in (REPORT_FONT, REPORT_FONT_BOLD, REPORT_FONT_ITALIC, *REPORT_FALLBACK_FONTS):
+            if source:
+                h.update(asset_cache.content_digest(source).encode())
+    return h.hexdigest()
+
+
+# Histogram buckets: stage and render times (seconds), page counts, PDF sizes (bytes)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25)
+PAGES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = (10e3, 50e3, 100e3, 250e3, 500e3, 1e6, 5e6, 10e6, 50e6)
+
+
+def prometheus_labels(names, values, **extra):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra.items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Cumulative histogram with labels, rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, buckets, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labelvalues, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = prometheus_labels(self.labelnames, labelvalues, le=f"{bound:g}")
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = prometheus_labels(self.labelnames, labelvalues, le="+Inf")
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = prometheus_labels(self.labelnames, labelvalues)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return "\n".join(lines)
+
+
+render_stage_seconds = Histogram(
+    "report_render_stage_seconds", "Time spent in each render stage.", SECONDS_BUCKETS, ("kind", "stage"))
+render_seconds = Histogram(
+    "report_render_seconds", "Render time including queueing for a worker.", SECONDS_BUCKETS, ("kind",))
+render_pages = Histogram("report_pages", "Pages per rendered report.", PAGES_BUCKETS, ("kind",))
+render_output_bytes = Histogram("report_output_bytes", "Size of rendered PDFs.", BYTES_BUCKETS, ("kind",))
+render_peak_memory = Histogram(
+    "report_render_peak_memory_bytes", "Peak memory of renders traced with tracemalloc.", BYTES_BUCKETS, ("kind",))
+
+
+class MemoryCalibration:
+    """
+    Estimated against measured peak memory of the renders traced with tracemalloc
+    (RENDER_MEMORY_TRACE_RATE), for tuning estimate_render_memory. Ratios well below 1
+    are expected for image-heavy requests: tracemalloc does not see PIL pixel buffers.
+    """
+
+    def __init__(self, max_samples=1000):
+        self.samples = deque(maxlen=max_samples)  # (kind, estimated bytes, peak bytes)
+        self._lock = threading.Lock()
+
+    def observe(self, kind, estimate, peak):
+        with self._lock:
+            self.samples.append((kind, estimate, peak))
+
+    def stats(self):
+        with self._lock:
+            samples = list(self.samples)
+        ratios = defaultdict(list)
+        for kind, estimate, peak in samples:
+            ratios[kind].append(peak / estimate)
+        kinds = {}
+        for kind, values in ratios.items():
+            values.sort()
+            kinds[kind] = {"samples": len(values), "median_ratio": round(values[len(values) // 2], 3),
+                           "max_ratio": round(values[-1], 3)}
+        recent = [{"kind": kind, "estimate": estimate, "peak": peak} for kind, estimate, peak in samples[-20:]]
+        return {"trace_rate": RENDER_MEMORY_TRACE_RATE, "kinds": kinds, "recent": recent}
+
+
+memory_calibration = MemoryCalibration()
+
+
+class ServerTiming:
+    """Collects the metrics of one response for its Server-Timing header."""
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, name, seconds=None, desc=None):
+        self.entries.append((name, seconds, desc))
+
+    def header(self):
+        parts = []
+        for name, seconds, desc in self.entries:
+            part = name
+            if desc:
+                part += f'; desc="{desc}"'
+            if seconds is not None:
+                part += f"; dur={seconds * 1000:.1f}"
+            parts.append(part)
+        return ", ".join(parts)
+
+
+def observe_render(kind, stats, wall_seconds, size, timing=None):
+    """Record a finished render in the /metrics histograms and, if given, a ServerTiming."""
+    queue_seconds = max(wall_seconds - stats["seconds"], 0.0)
+    stages = dict(stats["stages"], queue=queue_seconds)
+    for stage, seconds in stages.items():
+        render_stage_seconds.observe(seconds, kind, stage)
+    render_seconds.observe(wall_seconds, kind)
+    render_pages.observe(stats["pages"], kind)
+    render_output_bytes.observe(size, kind)
+    if "peak_memory" in stats:
+        render_peak_memory.observe(stats["peak_memory"], kind)
+        if stats.get("memory_estimate"):
+            memory_calibration.observe(kind, stats["memory_estimate"], stats["peak_memory"])
+    if timing is not None:
+        for stage, seconds in stages.items():
+            timing.add(stage, seconds)
+        timing.add("render", stats["seconds"], desc=f"{stats['pages']} pages")
+
+
+def renders_in_chunks(kind, report_request):
+    """Whether render_cached renders this report with render_chunked"""
+    return (kind == "previous" and CHUNKED_RENDER_MIN_REPORTS > 0 and render_pool.workers > 1 and not REPORT_FONT
+            and len(report_request.previous_reports) >= CHUNKED_RENDER_MIN_REPORTS)
+
+
+async def render_chunked(report_request, wait=False, memory=0):
+    """
+    Render a long previous consultations report on several render workers at once: the
+    consultation blocks are measured in parallel slices, paginated here, rendered as
+    page-aligned chunks in parallel and merged into one PDF. Returns (pdf_bytes, stats)
+    like render_report, with stage times summed over the workers.
+
+    Admission takes one pool slot and the estimated memory of the whole report, so a
+    full pool still answers 503. The other chunks only use workers idle at that moment,
+    taken all at once, and every part runs on a slot already held, so concurrent chunked
+    renders never wait on each other. With no idle worker the report renders serially.
+    """
+    start = time.perf_counter()
+    await render_pool.reserve(wait, memory)
+    extra = render_pool.take_idle(render_pool.workers - 1)
+    failed = True
+    try:
+        if not extra:
+            result = await render_pool.run(render_report, "previous", report_request, reserved=True)
+        else:
+            result = await render_chunks(report_request, extra + 1, start)
+        failed = False
+        return result
+    finally:
+        render_pool.release_idle(extra)
+        render_pool.release(failed, memory)
+
+
+async def run_reserved(calls):
+    """Run (fn, *args) calls on slots already held; waits for all of them, then raises the first error"""
+    results = await asyncio.gather(*(render_pool.run(*call, reserved=True) for call in calls),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def render_chunks(report_request, count, start):
+    """The parallel part of render_chunked, on count held slots"""
+    reports = report_request.previous_reports
+
+    def part(begin, end):
+        return report_request.model_copy(update={"previous_reports": reports[begin:end]})
+
+    step = -(-len(reports) // count)
+    measured = await run_reserved([(measure_consultation_blocks, part(begin, begin + step))
+                                   for begin in range(0, len(reports), step)])
+    blocks = [block for part_blocks, _ in measured for block in part_blocks]
+    pages, plan = await asyncio.to_thread(plan_consultation_chunks, report_request, blocks, count)
+    ends = plan[1:] + [(len(reports), pages + 1)]
+    chunks = await run_reserved([(render_consultation_chunk, part(first, end), first_page)
+                                 for (first, first_page), (end, _) in zip(plan, ends)])
+    if [len(chunk["pages"]) for chunk in chunks] != [end - first for (_, first), (_, end) in zip(plan, ends)]:
+        # A layout pass out of step with consultation_block; the page numbers would be wrong
+        log.warning("Chunked render pages differ from the layout, rendering serially")
+        return await render_pool.run(render_report, "previous", report_request, reserved=True)
+    pdf_bytes, merge_stats = await asyncio.to_thread(merge_consultation_chunks, report_request, chunks)
+    stages = defaultdict(float, layout=sum(seconds for _, seconds in measured))
+    for stats in [chunk["stats"] for chunk in chunks] + [merge_stats]:
+        for stage, seconds in stats["stages"].items():
+            stages[stage] += seconds
+    return pdf_bytes, {"stages": dict(stages), "pages": pages, "seconds": time.perf_counter() - start}
+
+
+async def render_cached(kind, report_request, key=None, wait=False, timing=None):
+    """Return rendered PDF bytes from the result cache, rendering on a miss."""
+    key = key or report_cache_key(kind, report_request)
+    start = time.perf_counter()
+    pdf_bytes = result_cache.get(key)
+    if pdf_bytes is not None:
+        if timing is not None:
+            timing.add("cache", time.perf_counter() - start, desc="hit")
+        return pdf_bytes
+    memory = estimate_render_memory(kind, report_request)
+    if renders_in_chunks(kind, report_request):
+        pdf_bytes, stats = await render_chunked(report_request, wait=wait, memory=memory)
+    else:
+        pdf_bytes, stats = await render_pool.run(render_report, kind, report_request, wait=wait, memory=memory)
+    stats["memory_estimate"] = memory
+    observe_render(kind, stats, time.perf_counter() - start, len(pdf_bytes), timing)
+    result_cache.put(key, pdf_bytes)
+    return pdf_bytes
+
+
+def metrics_text():
+    """All metrics in the Prometheus text exposition format."""
+    pool = render_pool.stats()
+    cache = result_cache.stats()
+    lines = [
+        "# HELP report_renders_in_flight Renders running on a worker.",
+        "# TYPE report_renders_in_flight gauge",
+        f"report_renders_in_flight {pool['running']}",
+        "# HELP report_renders_queued Admitted renders waiting for a worker, plus callers waiting for admission.",
+        "# TYPE report_renders_queued gauge",
+        f"report_renders_queued {pool['queued'] + pool['waiting']}",
+        "# HELP report_render_memory_reserved_bytes Estimated memory of the admitted renders.",
+        "# TYPE report_render_memory_reserved_bytes gauge",
+        f"report_render_memory_reserved_bytes {pool['memory_reserved']}",
+        "# HELP report_renders_total Renders by outcome.",
+        "# TYPE report_renders_total counter",
+    ]
+    for outcome in ("completed", "failed", "rejected", "too_large", "timed_out"):
+        lines.append(f'report_renders_total{{outcome="{outcome}"}} {pool[outcome]}')
+    lines += [
+        "# HELP report_cache_lookups_total Rendered-PDF cache lookups by result.",
+        "# TYPE report_cache_lookups_total counter",
+        f'report_cache_lookups_total{{result="hit"}} {cache["hits"]}',
+        f'report_cache_lookups_total{{result="disk_hit"}} {cache["disk_hits"]}',
+        f'report_cache_lookups_total{{result="miss"}} {cache["misses"]}',
+        "# HELP report_cache_bytes Bytes held by the in-memory rendered-PDF cache.",
+        "# TYPE report_cache_bytes gauge",
+        f"report_cache_bytes {cache['bytes']}",
+    ]
+    for histogram in (render_stage_seconds, render_seconds, render_pages, render_output_bytes, render_peak_memory):
+        lines.append(histogram.expose())
+    return "\n".join(lines) + "\n"
+
+
+async def read_report_request(request):
+    """
+    Decode and validate the request body into a ReportRequest, rejecting an
+    empty one; the parse time is kept for Server-Timing.
+    """
+    body = await request.body()
+    if not body.strip():
+        raise HTTPException(status_code=400, detail="No JSON data provided")
+    start = time.perf_counter()
+    if len(body) > PARSE_IN_THREAD_BYTES:
+        # Big histories take tens of milliseconds to validate, keep the event loop free
+        report_request = await asyncio.to_thread(parse_report_request, body)
+    else:
+        report_request = parse_report_request(body)
+    request.state.parse_seconds = time.perf_counter() - start
+    if not report_request.model_fields_set:
+        raise HTTPException(status_code=400, detail="No JSON data provided")
+    return report_request
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def negotiate_output_format(request):
+    """
+    Response encoding for a render request: ?format= if given, otherwise the
+    preferred of application/pdf and application/json in Accept. Raw PDF by default.
+    """
+    output_format = request.query_params.get("format")
+    if output_format is not None:
+        if output_format not in OUTPUT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(OUTPUT_FORMATS)}")
+        return output_format
+    best, best_q = "pdf", 0.0
+    for item in request.headers.get("accept", "").split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        candidate = {"application/pdf": "pdf", "application/json": "base64"}.get(media_type.lower())
+        if candidate and q > best_q:
+            best, best_q = candidate, q
+    return best
+
+
+def iter_slices(view, size=OUTPUT_CHUNK_BYTES):
+    for start in range(0, len(view), size):
+        yield view[start:start + size]
+
+
+def iter_base64_json(view):
+    """{"pdf_data": "<base64>"} encoded slice by slice, never holding the whole encoding"""
+    yield b'{"pdf_data":"'
+    for chunk in iter_slices(view):
+        yield base64.b64encode(chunk)
+    yield b'"}'
+
+
+def base64_json_length(size):
+    return len(b'{"pdf_data":"') + 4 * ((size + 2) // 3) + len(b'"}')
+
+
+def pdf_response(pdf_bytes, output_format, filename, headers):
+    """
+    Response for a rendered PDF in the negotiated format. The render buffer is
+    sent through a read-only memoryview, never copied, and every format sets
+    Content-Length up front.
+    """
+    view = memoryview(pdf_bytes).toreadonly()
+    if output_format == "base64":
+        headers = dict(headers, **{"Content-Length": str(base64_json_length(len(view)))})
+        return StreamingResponse(iter_base64_json(view), media_type="application/json", headers=headers)
+    headers = dict(headers, **{"Content-Disposition": f"attachment; filename={filename}"})
+    if output_format == "stream":
+        headers["Content-Length"] = str(len(view))
+        return StreamingResponse(iter_slices(view), media_type="application/pdf", headers=headers)
+    return Response(content=view, media_type="application/pdf", headers=headers)
+
+
+async def render_pdf_response(request, kind, report_request, filename):
+    """Render (or fetch from cache) a report and build the response in the negotiated format, with its ETag."""
+    output_format = negotiate_output_format(request)
+    timing = ServerTiming()
+    parse_seconds = getattr(request.state, "parse_seconds", None)
+    if parse_seconds is not None:
+        timing.add("parse", parse_seconds)
+        render_stage_seconds.observe(parse_seconds, kind, "parse")
+
+    key = report_cache_key(kind, report_request)
+    # The base64 body is a different representation of the same render, so it gets its own tag
+    etag = f'"{key}-base64"' if output_format == "base64" else f'"{key}"'
+    headers = {"ETag": etag, "Vary": "Accept"}
+    # Rendering is deterministic, so a matching ETag means the client already has these bytes
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=dict(headers, **{"Server-Timing": timing.header()}))
+
+    pdf_bytes = await render_cached(kind, report_request, key, timing=timing)
+    headers["Server-Timing"] = timing.header()
+    return pdf_response(pdf_bytes, output_format, filename, headers)
+
+
+@app.post("/generate_main_report")
+async def generate_main_report_route(request: Request):
+    try:
+        report_request = await read_report_request(request)
+
+        return await render_pdf_response(request, "main", report_request, "main_report.pdf")
+
+    except Exception as e:
+        return render_error_response(e)
+
+@app.post("/generate_previous_reports")
+async def generate_previous_reports_route(request: Request):
+    try:
+        report_request = await read_report_request(request)
+
+        return await render_pdf_response(request, "previous", report_request, "previous_reports.pdf")
+
+    except Exception as e:
+        return render_error_response(e)
+
+
+class ZipStream:
+    """Write-only file object for zipfile that hands out the bytes written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def batch_item_filename(index, kind, payload):
+    """Build a safe, unique archive name for a batch item."""
+    label = payload.get('id') or payload.get('patient_data', {}).get('uhid', '')
+    label = "".join(c for c in str(label) if c.isalnum() or c in "-_")
+    return f"{index:05d}_{label + '_' if label else ''}{kind}_report.pdf"
+
+
+async def read_batch_items(request):
+    """
+    Yield (index, payload, error) for each report in a batch body.
+
+    Accepts a JSON array of payloads, an object {"defaults": {...}, "reports": [...]},
+    or NDJSON (one payload per line, read incrementally). Keys in "defaults"
+    (e.g. hospital_data, doctor_data, logo_data) are shared by every report;
+    in NDJSON a line of the form {"defaults": {...}} sets them for later lines.
+    """
+    content_type = request.headers.get("content-type", "")
+    defaults = {}
+
+    def item(index, payload):
+        if not isinstance(payload, dict):
+            return index, None, "Each report must be a JSON object"
+        return index, {**defaults, **payload}, None
+
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        index = 0
+        buffer = b""
+
+        def parse(line):
+            nonlocal defaults, index
+            if not line.strip():
+                return None
+            try:
+                payload = json.loads(line)
+            except ValueError as e:
+                parsed = (index, None, f"Invalid JSON: {e}")
+            else:
+                if isinstance(payload, dict) and set(payload) == {"defaults"}:
+                    defaults = payload["defaults"]
+                    return None
+                parsed = item(index, payload)
+            index += 1
+            return parsed
+
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                parsed = parse(line)
+                if parsed:
+                    yield parsed
+        parsed = parse(buffer)
+        if parsed:
+            yield parsed
+        return
+
+    body = json.loads(await request.body())
+    if isinstance(body, dict):
+        defaults = body.get('defaults', {})
+        body = body.get('reports', [])
+    if not isinstance(body, list):
+        raise ValueError("Batch body must be a JSON array or an object with a 'reports' array")
+    for index, payload in enumerate(body):
+        yield item(index, payload)
+
+
+async def stream_batch_zip(items, kind):
+    """
+    Render batch items in parallel and yield a ZIP archive chunk by chunk,
+    adding each PDF as soon as it finishes. Failures become manifest entries.
+    """
+    sink = ZipStream()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+    manifest = []
+    running = {}
+    items = items.__aiter__()
+    exhausted = False
+
+    async def render_item(index, payload, error):
+        if error:
+            raise ValueError(error)
+        item_kind = payload.get('report_type', kind)
+        if item_kind not in report_classes:
+            raise ValueError(f"Unknown report_type: {item_kind}")
+        pdf_bytes = await render_cached(item_kind, parse_report_request(payload), wait=True)
+        return batch_item_filename(index, item_kind, payload), pdf_bytes
+
+    try:
+        while running or not exhausted:
+            while not exhausted and len(running) < BATCH_CONCURRENCY:
+                try:
+                    index, payload, error = await items.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                task = asyncio.ensure_future(render_item(index, payload, error))
+                running[task] = index
+            if not running:
+                break
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = running.pop(task)
+                try:
+                    filename, pdf_bytes = task.result()
+                except ValidationError as e:
+                    manifest.append(dict(validation_error_body(e), index=index, status="error"))
+                    continue
+                except Exception as e:
+                    manifest.append({"index": index, "status": "error", "error": str(e) or type(e).__name__})
+                    continue
+                archive.writestr(filename, pdf_bytes)
+                manifest.append({"index": index, "status": "ok", "file": filename, "bytes": len(pdf_bytes)})
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+
+        manifest.sort(key=lambda entry: entry["index"])
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+        archive.close()
+        yield sink.drain()
+    finally:
+        for task in running:
+            task.cancel()
+
+
+@app.post("/generate_batch")
+async def generate_batch_route(request: Request, report_type: str = "main"):
+    """
+    Renders many reports in one request and streams back a ZIP of PDFs
+    plus manifest.json describing the outcome of every item.
+    """
+    if report_type not in report_classes:
+        return JSONResponse(status_code=400, content={"error": f"Unknown report_type: {report_type}"})
+
+    items = read_batch_items(request)
+    try:
+        # Read the first item up front so an unreadable body is a 400, not a broken ZIP
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        return JSONResponse(status_code=400, content={"error": "No reports provided"})
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    async def all_items():
+        yield first
+        async for batch_item in items:
+            yield batch_item
+
+    return StreamingResponse(stream_batch_zip(all_items(), report_type), media_type="application/zip",
+                             headers={"Content-Disposition": "attachment; filename=reports.zip"})
+
+class ReportBodyReader:
+    """
+    Incremental reader for a report JSON body. All keys up to "previous_reports"
+    are decoded normally; the entries of that array are then decoded one at a
+    time as body chunks arrive, so the history never has to be held in memory.
+    "previous_reports" must therefore be the last key of the object.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            raise ValueError("Unexpected end of JSON body")
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            text = self._utf8.decode(b"", final=True)
+        else:
+            text = self._utf8.decode(chunk)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._fill()
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} in JSON body, got {char!r}")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            if end == len(self._buf) and not self._eof:
+                # A number at the end of the buffer may continue in the next chunk
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def read_header(self):
+        """Return the report dict; its previous_reports is a lazy iterator."""
+        data = {}
+        self._expect("{")
+        if self._peek() == "}":
+            return data
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "previous_reports":
+                self._expect("[")
+                data[key] = self._iter_previous_reports()
+                return data
+            data[key] = self._value()
+            if self._expect(",}") == "}":
+                return data
+
+    def _iter_previous_reports(self):
+        if self._peek() == "]":
+            self._pos += 1
+        else:
+            while True:
+                yield self._value()
+                if self._expect(",]") == "]":
+                    break
+        if self._expect(",}") == ",":
+            raise ValueError("previous_reports must be the last key when streaming")
+
+
+def put_unless_cancelled(q, item, cancelled):
+    """Blocking put that gives up once the other side has gone away."""
+    while not cancelled.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def render_streaming_previous_reports(body_chunks, pdf_chunks, cancelled):
+    """Render thread for the streaming route: body chunks in, PDF chunks out."""
+
+    def send(item):
+        if not put_unless_cancelled(pdf_chunks, item, cancelled):
+            raise RuntimeError("Client disconnected")
+
+    def receive():
+        while not cancelled.is_set():
+            try:
+                chunk = body_chunks.get(timeout=1)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                return
+            yield chunk
+
+    try:
+        start = time.perf_counter()
+        header = ReportBodyReader(receive()).read_header()
+        entries = header.pop("previous_reports", ())
+        report = PreviousPatientReport(parse_report_request(header))
+        # Validated one at a time as the body arrives, like the decoding
+        report.previous_reports = (PreviousReport.model_validate(entry) for entry in entries)
+        report.stream_pages(send)
+        tail = report.generate_report()
+        send(memoryview(tail))
+        send(None)
+        # Includes time spent waiting on the client at either end of the stream
+        stats = dict(report.render_stats(), seconds=time.perf_counter() - start)
+        observe_render("previous_stream", stats, stats["seconds"], report.streamed_bytes + len(tail))
+    except Exception as e:
+        if not cancelled.is_set():
+            send(e)
+
+
+@app.post("/generate_previous_reports/stream")
+async def stream_previous_reports_route(request: Request):
+    """
+    Previous consultations for very long histories: previous_reports is parsed
+    incrementally from the body and each finished page is streamed to the client,
+    keeping memory flat regardless of history length. previous_reports must be
+    the last key in the JSON body.
+    """
+    try:
+        await render_pool.reserve()
+    except RenderPoolFull as e:
+        return render_error_response(e)
+
+    body_chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    pdf_chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    threading.Thread(target=render_streaming_previous_reports, args=(body_chunks, pdf_chunks, cancelled),
+                     daemon=True).start()
+
+    async def feed_body():
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    await asyncio.to_thread(put_unless_cancelled, body_chunks, chunk, cancelled)
+        finally:
+            await asyncio.to_thread(put_unless_cancelled, body_chunks, None, cancelled)
+
+    feeder = asyncio.ensure_future(feed_body())
+
+    def finish(error=None):
+        cancelled.set()
+        feeder.cancel()
+        # A body that does not parse or validate (ValueError, including ValidationError) is the
+        # client's error, not a render outcome; only the render's own errors count as failed
+        render_pool.release(failed=None if isinstance(error, ValueError) else error is not None)
+
+    # Wait for the first page so that a malformed body is still a plain error response
+    first = await asyncio.to_thread(pdf_chunks.get)
+    if isinstance(first, Exception):
+        finish(first)
+        if isinstance(first, ValueError) and not isinstance(first, ValidationError):
+            return JSONResponse(status_code=400, content={"error": str(first)})
+        return render_error_response(first)
+
+    async def stream():
+        error = None
+        try:
+            chunk = first
+            while chunk is not None:
+                if isinstance(chunk, Exception):
+                    error = chunk
+                    raise chunk
+                yield chunk
+                chunk = await asyncio.to_thread(pdf_chunks.get)
+        finally:
+            finish(error)
+
+    return StreamingResponse(stream(), media_type="application/pdf",
+                             headers={"Content-Disposition": "attachment; filename=previous_reports.pdf"})
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    """
+    File-backed job records. Per job id: <id>.json holds the status record,
+    <id>.request.json the report data (so queued jobs can be resumed after a
+    restart), <id>.progress the pages rendered so far and <id>.pdf the result.
+    """
+
+    def __init__(self, directory=JOBS_DIR, ttl=JOB_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, job_id, suffix):
+        return os.path.join(self.directory, f"{job_id}{suffix}")
+
+    def create(self, kind, report_request):
+        job_id = uuid.uuid4().hex
+        write_atomic(self.path(job_id, ".request.json"), report_request.model_dump_json().encode())
+        job = {"id": job_id, "report_type": kind, "status": "queued", "owner": os.getpid(), "created": time.time(),
+               "started": None, "finished": None, "pages": None, "bytes": None, "error": None}
+        write_atomic(self.path(job_id, ".json"), json.dumps(job).encode())
+        return job
+
+    def get(self, job_id):
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        try:
+            with open(self.path(job_id, ".json"), "rb") as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return None
+        job["pages_rendered"] = job["pages"]
+        if job["status"] == "running":
+            try:
+                with open(self.path(job_id, ".progress")) as f:
+                    job["pages_rendered"] = int(f.read() or 0)
+            except (FileNotFoundError, ValueError):
+                job["pages_rendered"] = 0
+        return job
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            with open(self.path(job_id, ".json"), "rb") as f:
+                job = json.load(f)
+            job.update(fields)
+            write_atomic(self.path(job_id, ".json"), json.dumps(job).encode())
+        return job
 
-        # Add patient name value immediately after the header
-        self.set_font("helvetica", "", 10)
-        self.set_text_color(0, 0, 0)
+    def request_data(self, job_id):
+        with open(self.path(job_id, ".request.json"), "rb") as f:
+            return parse_report_request(f.read())
 
-        # Specify a width for the patient name cell
-        patient_name_width = 80
-        self.cell(patient_name_width, 10, self.patient_data.get('name', ''), 0, 1, 'L')  # Create new line
+    def orphaned(self):
+        """
+        Jobs left queued or running by a server process that has since stopped,
+        oldest first. Jobs owned by another live process sharing the directory are its own.
+        """
+        jobs = []
+        for entry in os.scandir(self.directory):
+            job_id, _, suffix = entry.name.partition(".")
+            if suffix == "json" and JOB_ID_PATTERN.fullmatch(job_id):
+                job = self.get(job_id)
+                if job and job["status"] in ("queued", "running"):
+                    # Our own pid can only be a stale one reused after a restart (pid 1 in containers)
+                    if job["owner"] == os.getpid() or not process_alive(job["owner"]):
+                        jobs.append(job)
+        return sorted(jobs, key=lambda job: job["created"])
 
-        age = self.patient_data.get('age','N/A')
-        date = self.patient_data.get('date','N/A')
-        
-        # Second line headers - Age
-        self.set_x(10)
-        self.set_font("helvetica", "B", 10)
-        self.set_text_color(*self.primary_color)
+    def purge_expired(self):
+        """Delete finished jobs older than the TTL together with their files"""
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            job_id, _, suffix = entry.name.partition(".")
+            if suffix != "json" or not JOB_ID_PATTERN.fullmatch(job_id):
+                continue
+            job = self.get(job_id)
+            if job and job["finished"] and job["finished"] < cutoff:
+                for suffix in (".pdf", ".progress", ".request.json", ".json"):
+                    try:
+                        os.remove(self.path(job_id, suffix))
+                    except FileNotFoundError:
+                        pass
 
-        # Age label
-        age_label = "Age:"
-        age_label_width = self.get_string_width(age_label) + 5
-        self.cell(age_label_width, 10, age_label, 0, 0, 'L')
 
-        # Age value
-        self.set_font("helvetica", "", 10)
-        self.set_text_color(0, 0, 0)
-        age_width = 40
-        self.cell(age_width, 10, age, 0, 0, 'L')  # No new line
+def render_job(kind, report_request, result_path, progress_path):
+    """
+    Render a job inside a render pool worker. Pages are streamed straight into
+    the result file instead of being sent back through the pool, and the number
+    of finished pages is written to progress_path as the render goes.
+    """
+    start = time.perf_counter()
+    traced = {}
+    with traced_memory(traced):
+        report_class, method = report_classes[kind]
+        report = report_class(report_request)
+        setup_seconds = time.perf_counter() - start
+        last_progress = 0.0
+        tmp_path = result_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            def write(data):
+                nonlocal last_progress
+                f.write(data)
+                now = time.perf_counter()
+                if now - last_progress >= JOB_PROGRESS_INTERVAL:
+                    last_progress = now
+                    write_atomic(progress_path, str(report.page - 1).encode())
 
-        # Add some space between Age and Date
-        self.set_x(60)  # Adjust X position to avoid overlap
+            report.stream_pages(write)
+            f.write(getattr(report, method)())
+            size = f.tell()
+    os.replace(tmp_path, result_path)
+    stats = dict(report.render_stats(), **traced)
+    stats["stages"]["setup"] = setup_seconds
+    stats["seconds"] = time.perf_counter() - start
+    return stats, size
 
-        # Date label
-        self.set_font("helvetica", "B", 10)
-        self.set_text_color(*self.primary_color)
-        date_label = "Date:"
-        date_label_width = self.get_string_width(date_label) + 5
-        self.cell(date_label_width, 10, date_label, 0, 0, 'L')
 
-        # Date value
-        self.set_font("helvetica", "", 10)
-        self.set_text_color(0, 0, 0)
-        self.cell(40, 10, date, 0, 1, 'L')  # End line
+class JobQueue:
+    """In-process queue of job ids, drained by JOB_WORKERS tasks that render on the shared render pool."""
 
-        # Patient info line
-        self.line(10, 65, self.w - 10, 65)
-        self.ln(5)
+    def __init__(self, store, workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE):
+        self.store = store
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue = None
+        self._tasks = []
+        self._last_purge = 0.0
 
-        # Patient Details section - separated into two columns
-        self.set_y(70)  # Adjusted from original 60
-        self.set_font("helvetica", "B", 10)
-        self.set_text_color(*self.primary_color)
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        # Pick up where a previous process stopped; a running job is started over
+        for job in self.store.orphaned():
+            self.store.update(job["id"], status="queued", owner=os.getpid(), started=None)
+            self._queue.put_nowait(job["id"])
 
-        # Left column - abbreviations
-        left_col_width = 35  # Reduced width for left column
-        self.set_x(10)
-        self.cell(left_col_width, 10, "C/C", 0, 1, 'L')
-        self.set_x(10)
-        self.ln(10)
-        self.set_x(10)
-        self.cell(left_col_width, 10, "D/E", 0, 1, 'L')
-        self.set_x(10)
-        self.cell(left_col_width, 10, "BP=", 0, 1, 'L')
+    async def submit(self, kind, report_request):
+        """Persist a job and queue it. Only the store write runs in a thread; the queue belongs to the loop."""
+        if self._queue.qsize() >= self.max_queued:
+            raise RenderPoolFull("Job queue is full")
+        render_pool.check_memory(await asyncio.to_thread(estimate_render_memory, kind, report_request))
+        job = await asyncio.to_thread(self.store.create, kind, report_request)
+        self._queue.put_nowait(job["id"])
+        return job
 
-        # Vertical divider between columns - adjusted position
-        self.set_draw_color(*self.primary_color)
-        self.line(45, 70, 45, 160)  # Adjusted position and height
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception:
+                log.exception("Error running job %s", job_id)
+            finally:
+                self._queue.task_done()
 
-        # Main content area - Right column 
-        # Patient Details using multi-cells for longer text
-        patient_fields = [
-            ('Chief Complaints:', 'chief_complaints'),
-            ('Aggravating factor:', 'aggravating_factor'),
-            ('Present Illness:', 'present_illness'),
-            ('Family History:', 'family_history'),
-            ('Surgical History:', 'surgical_history'),
-            ('Examination:', 'examination'),
-            ('Clinical Impression:', 'clinical_impression')
-        ]
+    async def _run(self, job_id):
+        job = self.store.update(job_id, status="running", started=time.time())
+        kind = job["report_type"]
+        start = time.perf_counter()
+        try:
+            report_request = await asyncio.to_thread(self.store.request_data, job_id)
+            memory = estimate_render_memory(kind, report_request)
+            stats, size = await render_pool.run(
+                render_job, kind, report_request, self.store.path(job_id, ".pdf"),
+                self.store.path(job_id, ".progress"), wait=True, timeout=JOB_TIMEOUT, memory=memory)
+        except Exception as e:
+            self.store.update(job_id, status="failed", finished=time.time(), error=str(e) or type(e).__name__)
+            return
+        stats["memory_estimate"] = memory
+        observe_render(kind, stats, time.perf_counter() - start, size)
+        self.store.update(job_id, status="done", finished=time.time(), pages=stats["pages"], bytes=size)
+        if time.monotonic() - self._last_purge > 60:
+            self._last_purge = time.monotonic()
+            await asyncio.to_thread(self.store.purge_expired)
 
-        self.set_y(70)  # Start right at 70 instead of 60
-        self.set_x(50)  # Move content start to the right of the vertical line
-        self.set_font("helvetica", "", 10)
-        self.set_text_color(0, 0, 0)
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
 
-        y_position = self.get_y()
-        for label, field in patient_fields:
-            self.set_font("helvetica", "B", 10)
-            self.set_y(y_position)
-            self.set_x(50)  # Adjusted from 75
-            self.set_text_color(*self.secondary_color)
-            self.cell(40, 8, label, 0, 0)
-            self.set_font("helvetica", "", 10)
-            self.set_text_color(0, 0, 0)
-            self.set_x(90)  # Adjusted from 115
-            self.multi_cell(100, 8, str(self.patient_data.get(field, '')))  # Increased width from 80 to 100
-            y_position += 15
+    def stats(self):
+        return {"workers": self.workers, "queued": self._queue.qsize() if self._queue else 0,
+                "max_queued": self.max_queued}
 
-        # Advice (Medications Table)
-        self.ln(5)
-        self.set_font("helvetica", "B", 14)
-        self.set_text_color(*self.primary_color)
-        self.cell(0, 10, "Advice", 0, 1)
 
-        # Prepare table data
-        table_data = [
-            ["S.No.", "Medicine Name", "Dosage", "Details"]
-        ]
-        for i, med in enumerate(self.advice_data):
-            table_data.append([
-                str(i + 1),
-                med.get('name', ''),
-                str(med.get('dosage', '')),
-                med.get('details', '')
-            ])
+job_store = JobStore()
+job_queue = JobQueue(job_store)
 
-        self.create_table(table_data, align_data='C', align_header='C', cell_width='even')
 
-        if output_path:
-            return self.output(output_path)
-        else:
-            return bytes(self.output(dest='S'))
+def job_status(job):
+    """Public view of a job record"""
+    body = {key: job[key] for key in ("id", "report_type", "status", "pages_rendered", "bytes", "error")}
+    for key in ("created", "started", "finished"):
+        body[key] = datetime.fromtimestamp(job[key], timezone.utc).isoformat() if job[key] else None
+    body["status_url"] = f"/jobs/{job['id']}"
+    body["result_url"] = f"/jobs/{job['id']}/result"
+    return body
 
 
-class PreviousPatientReport(PatientReport):
-    
-    def header(self):
-        # Override the default header method to use our custom previous reports header
-        # self.ln(10)
-        margin = 10
-        # Set green background for header
-        self.set_fill_color(*self.primary_color)
-        self.rect(0, 0, self.w, 40, 'F')
-        
-        # Add white text
-        self.set_y(15)
-        self.set_font("helvetica", "B", 18)
-        self.set_text_color(255, 255, 255)
-        self.cell(0, 10, "Previous Consultations", 0, 1, 'C')
-        
-        # Logo with white background
-        if self.logo_data:
-            self.set_fill_color(255, 255, 255)
-            self.rect(margin, margin, 35, 35, 'F')
-            self.image(self.logo_data, margin+2.5, margin+2.5, 30)
+@app.post("/jobs", status_code=202)
+async def create_job_route(request: Request, report_type: str = "main"):
+    """
+    Queue a render and return at once with the job id; poll GET /jobs/{id} and
+    fetch the PDF from GET /jobs/{id}/result. For renders that take longer than
+    a request may.
+    """
+    try:
+        if report_type not in report_classes:
+            raise ValueError(f"Unknown report_type: {report_type}")
+        report_request = await read_report_request(request)
+        job = await job_queue.submit(report_type, report_request)
+        job["pages_rendered"] = None
+        return JSONResponse(status_code=202, content=job_status(job),
+                            headers={"Location": f"/jobs/{job['id']}"})
+    except ValidationError as e:
+        return render_error_response(e)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        return render_error_response(e)
 
-    
+@app.get("/jobs/{job_id}")
+async def job_status_route(job_id: str):
+    """Status of a job, with pages rendered so far while it runs."""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job"})
+    return job_status(job)
 
-    def footer(self):
-        # Override the default footer method to use our custom previous reports footer
-        self.set_fill_color(*self.light_grey)
-        self.rect(0, self.h - 15, self.w, 15, 'F')
-        
-        self.set_y(self.h - 12)
-        self.set_font("helvetica", "I", 8)
-        self.set_text_color(0,0,0)
-        self.cell(0, 10, "Page " + str(self.page_no()), 0, 0, "C")
-        # self.ln(30)
+@app.get("/jobs/{job_id}/result")
+async def job_result_route(job_id: str):
+    """The rendered PDF of a finished job; 409 while the job is queued, running or failed."""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job"})
+    if job["status"] != "done":
+        return JSONResponse(status_code=409, content=job_status(job))
+    return FileResponse(job_store.path(job_id, ".pdf"), media_type="application/pdf",
+                        filename=f"{job['report_type']}_report_{job_id}.pdf")
 
-    def generate_report(self):
-        """Generate previous reports PDF and return as bytes"""
-        self.add_page()
-        
-        start_y = self.get_y() + 30
-        self.set_y(start_y)
-        
-        self.set_fill_color(*self.light_accent)
-        self.rect(10, start_y, self.w - 20, 10, 'F')
+@app.get("/admin/jobs")
+async def job_queue_stats():
+    """Reports job queue depth."""
+    return job_queue.stats()
 
-        # Patient info header
-        self.set_font("helvetica", "B", 10)
-        self.set_text_color(*self.primary_color)
-        self.cell(80, 10, "Patient Name:", 0, 0, 'L')
-        self.cell(60, 10, "UHID:", 0, 0, 'L')
-        self.cell(40, 10, "Age/Sex:", 0, 1, 'L')
+LETTERHEAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+LETTERHEAD_IMAGE_FIELDS = ("logo_data", "watermark_logo")
 
-        # Info line
-        self.set_draw_color(*self.primary_color)
-        self.line(10, start_y + 10, self.w - 10, start_y + 10)
 
-        # Fill in patient details
-        self.set_y(start_y + 15)
-        self.set_font("helvetica", "", 10)
-        self.set_text_color(0, 0, 0)
-        self.cell(80, 10, self.patient_data.get('name', ''), 0, 0, 'L')
-        self.cell(60, 10, self.patient_data.get('uhid', ''), 0, 0, 'L')
-        self.cell(40, 10, str(self.patient_data.get('age', '') + '/' + self.patient_data.get('sex', '')), 0, 1, 'L')
+class LetterheadStore:
+    """
+    File-backed letterhead registry. <id>.json holds a letterhead as the report
+    request fields it stands for, <sha256>.image each distinct logo it uses. Ids
+    are content hashes, so registering the same letterhead twice gives the same id.
+    A process keeps the letterheads it has looked up resident; their images are
+    plain files, so asset_cache decodes each once and never re-reads it. Images
+    outlive their last letterhead by LETTERHEAD_IMAGE_GRACE, as requests resolved
+    before a delete still name their paths.
+    """
 
-        self.ln(10)
+    def __init__(self, directory=LETTERHEAD_DIR):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._resident = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
 
-        # Previous Consultations - formatted as blocks
-        self.set_font("helvetica", "B", 14)
-        self.set_text_color(*self.primary_color)
-        self.cell(0, 10, "Previous Consultations", 0, 1)
+    def path(self, name):
+        return os.path.join(self.directory, name)
 
-        self.set_font("helvetica", "", 10)
-        self.set_text_color(0, 0, 0)
+    def register(self, letterhead):
+        """
+        Store a Letterhead; returns (id, fields). Every logo is decoded before anything is
+        written, so one that is not a readable image raises and leaves no letterhead behind.
+        """
+        if letterhead.logo_data == "":
+            raise ValueError("logo_data must be an image")  # an empty watermark_logo means none
+        record = letterhead.model_dump(exclude=set(LETTERHEAD_IMAGE_FIELDS))
+        images = {}
+        for key in LETTERHEAD_IMAGE_FIELDS:
+            source = getattr(letterhead, key)
+            if source is None:
+                continue  # reports keep their default
+            if source:
+                # Inline images only: a server path would let a client register any readable file
+                data = read_image_source(source, allow_paths=False)
+                # Fails on anything but an image, and keeps it decoded in every variant a report may use
+                for variant in ("logo", "watermark") if key == "watermark_logo" else ("logo",):
+                    asset_cache.get(data, variant)
+                source = f"{hashlib.sha256(data).hexdigest()}.image"
+                images[source] = data
+            record[key] = source
+        encoded = json.dumps(record, sort_keys=True).encode()
+        letterhead_id = hashlib.sha256(encoded).hexdigest()[:32]
+        with self._lock:  # delete() must not remove an image between here and the record
+            for name, data in images.items():
+                if os.path.exists(self.path(name)):
+                    os.utime(self.path(name))  # not expired, should it be a deleted letterhead's
+                else:
+                    write_atomic(self.path(name), data)
+            if not os.path.exists(self.path(f"{letterhead_id}.json")):
+                write_atomic(self.path(f"{letterhead_id}.json"), encoded)
+            self._remove_unused_images(self._images_in_use())
+        return letterhead_id, self.get(letterhead_id)
 
-        for report in self.previous_reports:
-            # Check for page break
-            if self.get_y() + 30 > self.h - self.b_margin:
-                self.add_page()
-                self.set_y(50)
+    def get(self, letterhead_id):
+        """The report request fields of a letterhead, or None if there is no such letterhead"""
+        with self._lock:
+            fields = self._resident.get(letterhead_id)
+        # Another process may have deleted it since
+        if fields is not None and os.path.exists(self.path(f"{letterhead_id}.json")):
+            with self._lock:
+                self.hits += 1
+            return fields
+        if not LETTERHEAD_ID_PATTERN.fullmatch(letterhead_id):
+            return None
+        try:
+            with open(self.path(f"{letterhead_id}.json"), "rb") as f:
+                fields = json.load(f)
+        except FileNotFoundError:
+            return None
+        for key in LETTERHEAD_IMAGE_FIELDS:
+            if fields.get(key):
+                fields[key] = self.path(fields[key])
+        with self._lock:
+            self.misses += 1
+            self._resident[letterhead_id] = fields
+        return fields
 
-            date_hospital = f"{report.get('date', '')} - {report.get('hospital', '')}"
-            consultation = report.get('consultation', '')
+    def delete(self, letterhead_id):
+        """
+        Remove a letterhead; False if unknown. Every process rejects it from its next
+        lookup on. Images no other letterhead uses are removed after LETTERHEAD_IMAGE_GRACE.
+        """
+        if not LETTERHEAD_ID_PATTERN.fullmatch(letterhead_id):
+            return False
+        with self._lock:
+            self._resident.pop(letterhead_id, None)
+            try:
+                with open(self.path(f"{letterhead_id}.json"), "rb") as f:
+                    record = json.load(f)
+                os.remove(self.path(f"{letterhead_id}.json"))
+            except FileNotFoundError:
+                return False
+            in_use = self._images_in_use()
+            for key in LETTERHEAD_IMAGE_FIELDS:
+                name = record.get(key)
+                if name and name not in in_use:
+                    os.utime(self.path(name))  # the grace period starts now
+            self._remove_unused_images(in_use)
+        return True
 
-            # Calculate rectangle height more accurately
-            available_width = self.w - 30  # Width of the rectangle minus some padding
-            line_height = 8  # Height of each line
-            
-            # Function to calculate lines needed for text
-            def calculate_text_height(text, width):
-                if not text:
-                    return 0
-                    
-                # Split text into paragraphs
-                paragraphs = text.split('\n')
-                total_lines = 0
-                
-                for paragraph in paragraphs:
-                    # Skip empty paragraphs
-                    if not paragraph.strip():
-                        total_lines += 1
-                        continue
-                        
-                    # Calculate how many lines this paragraph will take
-                    text_width = self.get_string_width(paragraph)
-                    # More accurate calculation - use ceiling division
-                    lines_needed = max(1, (text_width / width) if text_width <= width else (text_width / width))
-                    # Round up only if there's a partial line
-                    total_lines += math.ceil(lines_needed)
-                    
-                return total_lines * line_height
-            
-            # Calculate the total height needed
-            text_height = calculate_text_height(consultation, available_width)
+    def _images_in_use(self):
+        in_use = set()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                with open(entry.path, "rb") as f:
+                    record = json.load(f)
+                in_use.update(record.get(key) for key in LETTERHEAD_IMAGE_FIELDS)
+        return in_use
 
-    # Add header height (for date/hospital) + padding - reduce values
-            rect_height = 10 + text_height + 5
+    def _remove_unused_images(self, in_use):
+        # Caller holds self._lock
+        expired = time.time() - LETTERHEAD_IMAGE_GRACE
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".image") and entry.name not in in_use and entry.stat().st_mtime < expired:
+                os.remove(entry.path)
 
-            # Ensure minimum rectangle height - reduce for small content
-            min_height = 20 if text_height < 10 else 30
-            rect_height = max(rect_height, min_height)
-            
-            current_y = self.get_y()
-            
-            # Draw rounded rectangle
-            self.set_fill_color(*self.light_accent)
-            self.rounded_rect(10, current_y, self.w - 20, rect_height, 5, 'F')
+    def stats(self):
+        registered = sum(1 for entry in os.scandir(self.directory) if entry.name.endswith(".json"))
+        with self._lock:
+            return {"registered": registered, "resident": len(self._resident),
+                    "hits": self.hits, "misses": self.misses}
 
-            # Date and hospital on one line
-            self.set_font("helvetica", "B", 12)
-            self.set_text_color(*self.secondary_color)
-            self.cell(0, 10, date_hospital, 0, 1, 'L')
 
-            # Consultation description below
-            self.set_font("helvetica", "", 10)
-            self.set_text_color(0, 0, 0)
-            self.multi_cell(available_width, line_height, consultation, 0, 'L')
+letterhead_store = LetterheadStore()
 
-            # Position for next item - calculate properly
-            self.set_y(current_y + rect_height + 5)
 
-        return bytes(self.output(dest='S'))
+def letterhead_status(letterhead_id, fields):
+    """Public view of a letterhead: its text blocks, and its logos by content hash"""
+    body = {"id": letterhead_id, "url": f"/letterheads/{letterhead_id}"}
+    body.update((key, fields[key]) for key in ("hospital_data", "doctor_data"))
+    for key in LETTERHEAD_IMAGE_FIELDS:
+        body[f"{key}_sha256"] = os.path.basename(fields.get(key) or "").removesuffix(".image") or None
+    return body
 
-    def rounded_rect(self, x, y, w, h, r, style=None):
-        """Draw a rectangle with rounded corners.
-        
-        Args:
-            x, y: top-left corner coordinates
-            w, h: width and height
-            r: radius of the rounded corners
-            style: 'F' for filled, 'S' for stroke (outline), 'DF' or 'FD' for both
-        """
-        # Ensure radius doesn't exceed dimensions
-        r = min(r, min(w, h) / 2)
-        
-        # Start at top-right corner after the rounded part
-        hp = self.h  # Page height
-        k = self.k   # Scale factor
-        
-        # Move to position just after the top-left rounded corner
-        self._out(f'{(x+r)*k:.2f} {(hp-y)*k:.2f} m')
-        
-        # Draw top border line (to top-right corner minus radius)
-        self._out(f'{(x+w-r)*k:.2f} {(hp-y)*k:.2f} l')
-        
-        # Draw quarter circle for top-right rounded corner
-        self._out(f'{(x+w-r)*k:.2f} {(hp-y)*k:.2f} {(x+w)*k:.2f} {(hp-y)*k:.2f} {(x+w)*k:.2f} {(hp-(y+r))*k:.2f} c')
-        
-        # Draw right border line (to bottom-right corner minus radius)
-        self._out(f'{(x+w)*k:.2f} {(hp-(y+h-r))*k:.2f} l')
-        
-        # Draw quarter circle for bottom-right rounded corner
-        self._out(f'{(x+w)*k:.2f} {(hp-(y+h-r))*k:.2f} {(x+w)*k:.2f} {(hp-(y+h))*k:.2f} {(x+w-r)*k:.2f} {(hp-(y+h))*k:.2f} c')
-        
-        # Draw bottom border line (to bottom-left corner minus radius)
-        self._out(f'{(x+r)*k:.2f} {(hp-(y+h))*k:.2f} l')
-        
-        # Draw quarter circle for bottom-left rounded corner
-        self._out(f'{(x+r)*k:.2f} {(hp-(y+h))*k:.2f} {x*k:.2f} {(hp-(y+h))*k:.2f} {x*k:.2f} {(hp-(y+h-r))*k:.2f} c')
-        
-        # Draw left border line (to top-left corner minus radius)
-        self._out(f'{x*k:.2f} {(hp-(y+r))*k:.2f} l')
-        
-        # Draw quarter circle for top-left rounded corner
-        self._out(f'{x*k:.2f} {(hp-(y+r))*k:.2f} {x*k:.2f} {(hp-y)*k:.2f} {(x+r)*k:.2f} {(hp-y)*k:.2f} c')
-        
-        # Close path and apply style
-        if style == 'F':
-            self._out('f')  # Fill
-        elif style == 'S':
-            self._out('S')  # Stroke
-        else:  # 'FD' or 'DF'
-            self._out('B')  # Both fill and stroke
 
-# Function to generate report from JSON data
-def generate_main_report_from_json(json_data):
-    report = MainPatientReport(json_data)
-    return report.generate_main_report()
+@app.post("/letterheads", status_code=201)
+async def create_letterhead_route(request: Request):
+    """
+    Register a letterhead: hospital_data, doctor_data, logo_data and watermark_logo
+    as in a report request. Reports then send {"letterhead": id} instead of those
+    fields; any of them a report still sends overrides the letterhead's.
+    """
+    try:
+        letterhead = Letterhead.model_validate_json(await request.body())
+    except ValidationError as e:
+        return render_error_response(e)
+    try:
+        letterhead_id, fields = await asyncio.to_thread(letterhead_store.register, letterhead)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": f"Unreadable logo: {e}"})
+    try:
+        # register() decoded the logos here; do the same in the render workers now rather than in their first report
+        report_request = parse_report_request({"letterhead": letterhead_id})
+        await render_pool.warm_up(preload_assets, report_request)
+    except Exception as e:
+        return render_error_response(e)
+    return JSONResponse(status_code=201, content=letterhead_status(letterhead_id, fields),
+                        headers={"Location": f"/letterheads/{letterhead_id}"})
 
-def generate_previous_reports_from_json(json_data):
-    # Create a completely separate instance for previous reports
-    report = PreviousPatientReport(json_data)
-    return report.generate_report()
+@app.get("/letterheads/{letterhead_id}")
+async def letterhead_route(letterhead_id: str):
+    """A registered letterhead."""
+    fields = await asyncio.to_thread(letterhead_store.get, letterhead_id)
+    if fields is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown letterhead"})
+    return letterhead_status(letterhead_id, fields)
 
+@app.delete("/letterheads/{letterhead_id}", status_code=204)
+async def delete_letterhead_route(letterhead_id: str):
+    """Unregister a letterhead; reports naming it are then rejected."""
+    if not await asyncio.to_thread(letterhead_store.delete, letterhead_id):
+        return JSONResponse(status_code=404, content={"error": "Unknown letterhead"})
+    return Response(status_code=204)
 
-@app.post("/generate_main_report")
-async def generate_main_report_route(request: Request):
-    try:
-        json_data = await request.json()
-        if not json_data:
-            raise HTTPException(status_code=400, detail="No JSON data provided")
+@app.get("/admin/letterheads")
+async def letterhead_stats():
+    """Reports registered letterheads and lookups (resident counts are this process only)."""
+    return await asyncio.to_thread(letterhead_store.stats)
 
-        main_report_bytes = generate_main_report_from_json(json_data)
+@app.get("/ready")
+async def readiness():
+    """Readiness probe: 503 until the startup warmup has finished, then 200 with its phase timings."""
+    if not warmup.ready:
+        return JSONResponse(status_code=503, content=warmup.status(), headers={"Retry-After": "1"})
+    return warmup.status()
 
-        return Response(content=main_report_bytes, media_type="application/pdf", headers={"Content-Disposition": "attachment; filename=main_report.pdf"})
+@app.get("/admin/render_pool")
+async def render_pool_stats():
+    """Reports render pool queue depth and outcome counters."""
+    return render_pool.stats()
 
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+@app.get("/admin/render_memory")
+async def render_memory_stats():
+    """Reports render memory admission and how estimates compare with traced peaks."""
+    pool = render_pool.stats()
+    return {
+        "budget": pool["memory_budget"],
+        "max_request": render_pool.max_request_memory,
+        "reserved": pool["memory_reserved"],
+        "waiting": pool["waiting_for_memory"],
+        "too_large": pool["too_large"],
+        "calibration": memory_calibration.stats(),
+    }
 
-@app.post("/generate_previous_reports")
-async def generate_previous_reports_route(request: Request):
-    try:
-        json_data = await request.json()
-        if not json_data:
-            raise HTTPException(status_code=400, detail="No JSON data provided")
+@app.get("/admin/report_cache")
+async def report_cache_stats():
+    """Reports rendered-PDF cache hit rate and eviction counters."""
+    return result_cache.stats()
 
-        previous_reports_bytes = generate_previous_reports_from_json(json_data)
+@app.get("/admin/asset_cache")
+async def asset_cache_stats():
+    """Reports decoded logo cache counters and bytes saved by image normalization (this process only)."""
+    return asset_cache.stats()
 
-        return Response(content=previous_reports_bytes, media_type="application/pdf", headers={"Content-Disposition": "attachment; filename=previous_reports.pdf"})
+@app.get("/admin/font_cache")
+async def font_cache_stats():
+    """Reports parsed fonts and subsetted font program cache counters (this process only)."""
+    return font_cache.stats()
 
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: render stage histograms, pages, output size, cache and pool counters."""
+    return Response(content=metrics_text(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def read_root():
@@ -810,6 +4397,141 @@ async def generate_report_head(request: Request):
     """Handles HEAD requests for the /generate_report endpoint."""
     return Response(status_code=200)
 
+@app.post("/generate_report")
+async def generate_report_route(request: Request):
+    """Main report and previous consultations rendered into one PDF."""
+    try:
+        report_request = await read_report_request(request)
+
+        return await render_pdf_response(request, "combined", report_request, "patient_report.pdf")
+
+    except Exception as e:
+        return render_error_response(e)
+
+
+# Bulk rendering without the HTTP server: python -m r_g render INPUT --output DIR
+
+def iter_cli_payloads(source):
+    """
+    (name, payload) for each report in source: a directory of .json files (payload
+    is the file path), a JSONL file or "-" for JSONL on stdin (payload is the line).
+    Names are stable between runs, so a rerun finds the PDFs it already wrote.
+    """
+    if source != "-" and os.path.isdir(source):
+        for entry in sorted(os.scandir(source), key=lambda entry: entry.name):
+            if entry.is_file() and entry.name.endswith(".json"):
+                yield entry.name[:-len(".json")], entry.path
+        return
+    stem = "stdin" if source == "-" else os.path.splitext(os.path.basename(source))[0]
+    f = sys.stdin.buffer if source == "-" else open(source, "rb")
+    try:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                yield f"{stem}-{line_number:06d}", line
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def render_cli_item(kind, payload, target):
+    """
+    Render one payload (JSON bytes, or a str path to a JSON file) to target.
+    Returns (seconds, pages, size, error); errors are returned as text because
+    validation errors do not survive the trip back from a worker process.
+    """
+    start = time.perf_counter()
+    try:
+        if isinstance(payload, str):
+            with open(payload, "rb") as f:
+                payload = f.read()
+        pdf_bytes, stats = render_report(kind, parse_report_request(payload))
+        write_atomic(target, pdf_bytes)
+    except ValidationError as e:
+        fields = "; ".join(": ".join(filter(None, (".".join(map(str, error["loc"])), error["msg"])))
+                           for error in e.errors()[:3])
+        return time.perf_counter() - start, None, None, f"{validation_error_body(e)['error']}: {fields}"
+    except Exception as e:
+        return time.perf_counter() - start, None, None, f"{type(e).__name__}: {e}"
+    return time.perf_counter() - start, stats["pages"], len(pdf_bytes), None
+
+
+def preload_default_assets():
+    preload_assets(ReportRequest())
+
+
+def render_cli(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m r_g render",
+                                     description="Render report payloads to PDF files without the HTTP server")
+    parser.add_argument("input", help="directory of .json files, a JSONL file, or - for JSONL on stdin")
+    parser.add_argument("--output", "-o", default="reports", help="directory for the PDFs (default: reports)")
+    parser.add_argument("--kind", choices=tuple(report_classes), default="combined",
+                        help="report to render (default: combined, as /generate_report)")
+    parser.add_argument("--workers", "-j", type=int, default=RENDER_WORKERS,
+                        help="worker processes; 0 renders in this process (default: RENDER_WORKERS)")
+    parser.add_argument("--force", action="store_true", help="render again even if the PDF already exists")
+    args = parser.parse_args(argv)
+    # Run as __main__, the report code's own fpdf deprecation warnings would be shown for every worker
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+    os.makedirs(args.output, exist_ok=True)
+    for entry in os.scandir(args.output):
+        if entry.name.endswith(".tmp"):
+            os.remove(entry.path)  # left by a run that died mid-write
+
+    # Decoded before the pool forks, so every worker starts with the default logo and fonts
+    preload_default_assets()
+    if args.workers > 0:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=preload_default_assets)
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    rendered = skipped = failed = pages = size = 0
+    timings = []
+    pending = {}
+
+    def collect(futures):
+        nonlocal rendered, failed, pages, size
+        for future in futures:
+            name = pending.pop(future)
+            seconds, page_count, pdf_size, error = future.result()
+            timings.append((seconds, name))
+            if error:
+                failed += 1
+                print(f"{name}\tfailed\t{seconds * 1000:.0f} ms\t{error}", flush=True)
+            else:
+                rendered += 1
+                pages += page_count
+                size += pdf_size
+                print(f"{name}\tok\t{seconds * 1000:.0f} ms\t{page_count} pages\t{pdf_size} bytes", flush=True)
+
+    start = time.perf_counter()
+    with executor:
+        for name, payload in iter_cli_payloads(args.input):
+            target = os.path.join(args.output, f"{name}.pdf")
+            if not args.force and os.path.exists(target):
+                skipped += 1  # PDFs are renamed into place complete, so an existing one is done
+                continue
+            pending[executor.submit(render_cli_item, args.kind, payload, target)] = name
+            # Bounded, so a large JSONL input is not read into memory ahead of the workers
+            if len(pending) >= max(args.workers, 1) * 4:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        collect(wait(pending).done)
+    elapsed = time.perf_counter() - start
+
+    print(f"{rendered} rendered, {skipped} skipped (already done), {failed} failed in {elapsed:.1f} s: "
+          f"{rendered / elapsed:.1f} reports/s, {pages / elapsed:.1f} pages/s, {size / elapsed / 1e6:.1f} MB/s",
+          file=sys.stderr)
+    if timings:
+        timings.sort()
+        p50 = timings[len(timings) // 2][0]
+        p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)][0]
+        print(f"per report: p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, "
+              f"slowest {timings[-1][0] * 1000:.0f} ms ({timings[-1][1]})", file=sys.stderr)
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["render"]:
+        sys.exit(render_cli(sys.argv[2:]))
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file